@@ -5,6 +5,8 @@ import torch
 import torch.nn.functional as F
 
 from anarcii.classifii import model
+from anarcii.inference.model import quantize_int8
+from anarcii.inference.model_loader import model_registry
 from anarcii.inference.utils import dataloader
 from anarcii.input_data_processing.tokeniser import Tokeniser
 
@@ -35,8 +37,9 @@ class TypeTokeniser(Tokeniser):
 
 
 class TypeLoader:
-    def __init__(self, device):
+    def __init__(self, device, precision="fp32"):
         self.device = device
+        self.precision = precision
         self.script_dir = os.path.dirname(os.path.abspath(__file__))
         params = self._load_params()
 
@@ -88,16 +91,27 @@ class TypeLoader:
         )
 
         S2S.eval()
+
+        if self.precision == "int8":
+            S2S = quantize_int8(S2S)
+
         return S2S
 
 
 class Classifii:
-    def __init__(self, batch_size, device):
+    def __init__(
+        self, batch_size, device, max_tokens=None, bucket_width=None, precision="fp32"
+    ):
         self.batch_size = batch_size
         self.device = device
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
         self.aa = TypeTokeniser("protein")
         self.num = TypeTokeniser("number")
-        self.model = TypeLoader(self.device).model
+        self.model = model_registry.get(
+            ("classifii", str(device), precision),
+            lambda: TypeLoader(device, precision).model,
+        )
 
     def __call__(self, sequences: dict[str, str]) -> dict[str, dict[str, str]]:
         tokenized_seqs = []
@@ -112,7 +126,12 @@ class Classifii:
                 )
                 tokenized_seqs.append(torch.from_numpy(self.aa.encode(["F"])))
 
-        dl = dataloader(self.batch_size, tokenized_seqs)
+        dl = dataloader(
+            self.batch_size,
+            tokenized_seqs,
+            max_tokens=self.max_tokens,
+            bucket_width=self.bucket_width,
+        )
         classes = self._classify(dl)
 
         grouped_sequences = {type_tokens[key]: {} for key in set(classes)}
@@ -128,11 +147,17 @@ class Classifii:
                 src = X.to(self.device)
                 src_mask = self.model.make_src_mask(src)
                 enc_src = self.model.encoder(src, src_mask)
+                enc_key_values = self.model.decoder.project_encoder(enc_src)
 
+                # A single step from the start token needs no causal mask.
                 input = src[:, 0].unsqueeze(1)
-                trg_pad_mask, trg_causal_mask = self.model.make_trg_mask(input)
                 output = self.model.decoder(
-                    input, enc_src, trg_pad_mask, trg_causal_mask, src_mask
+                    input,
+                    enc_src,
+                    input == self.model.trg_pad_idx,
+                    None,
+                    src_mask,
+                    enc_key_values=enc_key_values,
                 )
 
                 probs = F.softmax(output, dim=-1)
@@ -1,5 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from anarcii.inference.model import convert_multihead_attn_state_dict
 
 seq_max_len = 240
 
@@ -92,50 +95,137 @@ class EncoderMultiHeadAttentionLayer(nn.Module):
     def __init__(self, hid_dim, n_heads, dropout, device):
         super().__init__()
 
-        # Initialize the built-in multi-head attention layer
-        self.multihead_attn = nn.MultiheadAttention(
-            hid_dim, n_heads, dropout=dropout, batch_first=True
-        )
+        # Separate query and key/value projections, so that the keys and values of the
+        # encoder output can be projected once per batch (see `project_key_value`).
+        # Being `nn.Linear` layers, the projections can also be quantised.
+        self.q_proj = nn.Linear(hid_dim, hid_dim)
+        self.kv_proj = nn.Linear(hid_dim, 2 * hid_dim)
+        self.out_proj = nn.Linear(hid_dim, hid_dim)
+        self.dropout_p = dropout
+        self.hid_dim = hid_dim
+        self.n_heads = n_heads
+        self.head_dim = hid_dim // n_heads
 
         # Ensure the multi-head attention layer and additional layers are moved to the
         # correct device
         self.device = device
         self.to(device)
 
-    def forward(self, query, key, value, mask):
-        # Forward pass through the built-in MultiheadAttention layer
-        attn_output, attn_output_weights = self.multihead_attn(
-            query, key, value, key_padding_mask=mask
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints hold the weights of the built-in multi-head attention layer.
+        convert_multihead_attn_state_dict(
+            state_dict,
+            prefix,
+            {
+                "q_proj": slice(None, self.hid_dim),
+                "kv_proj": slice(self.hid_dim, None),
+            },
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_key_value(self, enc_src):
+        """
+        Project the encoder output to the keys and values of encoder-decoder
+        attention.  These are the same at every decoding step, so can be computed once
+        per batch and passed to `forward` as `key_value`.
+        """
+        # enc_src = [batch size, src len, hid dim]
+        batch_size, src_len, _ = enc_src.shape
+
+        k, v = (
+            self.kv_proj(enc_src)
+            .view(batch_size, src_len, 2 * self.n_heads, self.head_dim)
+            .transpose(1, 2)
+            .chunk(2, dim=1)
+        )
+        # k = v = [batch size, n heads, src len, head dim]
+
+        return k, v
+
+    def forward(self, query, key, value, mask, key_value=None):
+        # query = [batch size, query len, hid dim]
+        # key = value = [batch size, key len, hid dim]
+        # mask = [batch size, key len]
+        batch_size, query_len, _ = query.shape
+
+        if key_value is None:
+            # The key and value are always the same tensor.
+            key_value = self.project_key_value(key)
+        k, v = key_value
+
+        q = (
+            self.q_proj(query)
+            .view(batch_size, query_len, self.n_heads, self.head_dim)
+            .transpose(1, 2)
+        )
+        # q = [batch size, n heads, query len, head dim]
+
+        # The padding mask is True where attention is not allowed
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=~mask[:, None, None, :],
+            dropout_p=self.dropout_p if self.training else 0.0,
         )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, query_len, -1)
 
-        return attn_output, attn_output_weights
+        # Attention weights are not computed.
+        return self.out_proj(attn_output), None
 
 
 class DecoderMultiHeadAttentionLayer(nn.Module):
     def __init__(self, hid_dim, n_heads, dropout, device):
         super().__init__()
 
-        # Initialize the built-in multi-head attention layer
-        self.multihead_attn = nn.MultiheadAttention(
-            hid_dim, n_heads, dropout=dropout, batch_first=True
-        )
+        # Being `nn.Linear` layers, the projections can be quantised.
+        self.in_proj = nn.Linear(hid_dim, 3 * hid_dim)
+        self.out_proj = nn.Linear(hid_dim, hid_dim)
+        self.dropout_p = dropout
+        self.n_heads = n_heads
+        self.head_dim = hid_dim // n_heads
 
         # Ensure the multi-head attention layer and additional layers are moved to the
         # correct device
         self.device = device
         self.to(device)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints hold the weights of the built-in multi-head attention layer.
+        convert_multihead_attn_state_dict(state_dict, prefix, {"in_proj": slice(None)})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, query, key, value, trg_pad_mask, trg_causal_mask):
-        # Forward pass through the built-in MultiheadAttention layer
-        attn_output, attn_output_weights = self.multihead_attn(
-            query,
-            key,
-            value,
-            key_padding_mask=trg_pad_mask,
-            attn_mask=trg_causal_mask,
-            is_causal=True,
+        # query = key = value = [batch size, trg len, hid dim]
+        # trg_pad_mask = [batch size, trg len]
+        # trg_causal_mask = [trg len, trg len] or None, for a single token
+        batch_size, query_len, _ = query.shape
+
+        q, k, v = (
+            self.in_proj(query)
+            .view(batch_size, query_len, 3 * self.n_heads, self.head_dim)
+            .transpose(1, 2)
+            .chunk(3, dim=1)
         )
-        return attn_output, attn_output_weights
+        # q = k = v = [batch size, n heads, trg len, head dim]
+
+        # Masks are True where attention is not allowed.  A single query may attend
+        # to every key, so there is no causal mask.
+        mask = trg_pad_mask[:, None, None, :]
+        if trg_causal_mask is not None and query_len > 1:
+            mask = mask | trg_causal_mask
+
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=~mask,
+            dropout_p=self.dropout_p if self.training else 0.0,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, query_len, -1)
+
+        # Attention weights are not computed.
+        return self.out_proj(attn_output), None
 
 
 class PositionwiseFeedforwardLayer(nn.Module):
@@ -177,7 +267,9 @@ class DecoderLayer(nn.Module):
         )
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, trg, enc_src, trg_pad_mask, trg_causal_mask, src_mask):
+    def forward(
+        self, trg, enc_src, trg_pad_mask, trg_causal_mask, src_mask, enc_key_value=None
+    ):
         # trg = [batch size, trg len, hid dim]
         # enc_src = [batch size, src len, hid dim]
 
@@ -191,7 +283,9 @@ class DecoderLayer(nn.Module):
         # trg = [batch size, trg len, hid dim]
 
         # encoder attention
-        _trg, attention = self.encoder_attention(trg, enc_src, enc_src, src_mask)
+        _trg, attention = self.encoder_attention(
+            trg, enc_src, enc_src, src_mask, key_value=enc_key_value
+        )
 
         # dropout, residual connection and layer norm
         trg = self.enc_attn_layer_norm(trg + self.dropout(_trg))
@@ -239,7 +333,24 @@ class Decoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.scale = torch.sqrt(torch.FloatTensor([hid_dim])).to(device)
 
-    def forward(self, trg, enc_src, trg_pad_mask, trg_causal_mask, src_mask):
+    def project_encoder(self, enc_src):
+        """
+        Compute the encoder-decoder attention keys and values of each decoder layer.
+        Pass the result to `forward` as `enc_key_values` to reuse them.
+        """
+        return [
+            layer.encoder_attention.project_key_value(enc_src) for layer in self.layers
+        ]
+
+    def forward(
+        self,
+        trg,
+        enc_src,
+        trg_pad_mask,
+        trg_causal_mask,
+        src_mask,
+        enc_key_values=None,
+    ):
         # trg = [batch size, trg len]
         # enc_src = [batch size, src len, hid dim]
         # src_mask = [batch size, src len]
@@ -267,8 +378,18 @@ class Decoder(nn.Module):
         )
         # trg = [batch size, trg len, hid dim]
 
-        for layer in self.layers:
-            trg, _ = layer(trg, enc_src, trg_pad_mask, trg_causal_mask, src_mask)
+        if enc_key_values is None:
+            enc_key_values = [None] * len(self.layers)
+
+        for layer, enc_key_value in zip(self.layers, enc_key_values, strict=True):
+            trg, _ = layer(
+                trg,
+                enc_src,
+                trg_pad_mask,
+                trg_causal_mask,
+                src_mask,
+                enc_key_value=enc_key_value,
+            )
 
         # trg = [batch size, trg len, hid dim]
         # attention = [batch size, n heads, trg len, src len]
@@ -29,6 +29,23 @@ parser.add_argument(
     metavar="N",
     help="Batch size for processing (default: 512).",
 )
+parser.add_argument(
+    "--max_tokens",
+    type=int,
+    default=None,
+    metavar="N",
+    help=(
+        "Batch by a budget of N padded tokens (batch size × longest sequence length) "
+        "instead of a fixed batch size."
+    ),
+)
+parser.add_argument(
+    "--bucket_width",
+    type=int,
+    default=None,
+    metavar="N",
+    help="With --max_tokens, also split batches into sequence length buckets of N.",
+)
 parser.add_argument(
     "-c",
     "--cpu",
@@ -54,13 +71,140 @@ parser.add_argument(
         "saving the numbered sequences in MessagePack file (default: 102400)."
     ),
 )
+parser.add_argument(
+    "--max_trailing_skips",
+    type=int,
+    default=None,
+    metavar="N",
+    help=(
+        "Stop decoding a sequence once it has been numbered to IMGT 127/128 and then "
+        "predicted N <SKIP> tokens, e.g. for long constant-region tails."
+    ),
+)
 parser.add_argument(
     "-m",
     "--mode",
     type=str,
     default="accuracy",
-    choices=["accuracy", "speed"],
-    help="Mode for running the model (default: accuracy).",
+    choices=["accuracy", "speed", "speculative", "cascade"],
+    help=(
+        "Mode for running the model (default: accuracy).  speculative gives the "
+        "numbering of accuracy mode, with tokens drafted by the speed model, and is "
+        "only faster at small batch sizes (e.g. -b 8 or less).  cascade "
+        "numbers with the speed model, then numbers again with the accuracy model "
+        "sequences that fail or score near the cutoff."
+    ),
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="fp32",
+    choices=["fp32", "int8"],
+    help=(
+        "Numerical precision of the model (default: fp32).  int8 dynamically quantises "
+        "the linear layers and runs on CPU, but is not a drop-in replacement: in tests "
+        "it numbers 69-99.8%% of sequences the same as fp32, fewest for long "
+        "sequences and shark VNARs."
+    ),
+)
+parser.add_argument(
+    "--dtype",
+    type=str,
+    default="float32",
+    choices=["float32", "bfloat16"],
+    help=(
+        "Floating point type to run the numbering models in (default: float32).  "
+        "With bfloat16, sequences scoring near the cutoff are re-run in float32."
+    ),
+)
+parser.add_argument(
+    "--draft_cache",
+    action="store_true",
+    help=(
+        "Draft the numbering of each sequence from an earlier sequence of the same "
+        "length and framework anchors, and check it in one pass of the model."
+    ),
+)
+parser.add_argument(
+    "--constrained",
+    action="store_true",
+    help=(
+        "Only predict tokens that continue a valid IMGT numbering, e.g. increasing "
+        "numbers and insertions only where they are allowed."
+    ),
+)
+parser.add_argument(
+    "--score_gate",
+    type=float,
+    default=None,
+    metavar="MARGIN",
+    help=(
+        "Stop decoding a sequence after the chain token if it scores below the cutoff "
+        "by more than MARGIN, and report it as failed."
+    ),
+)
+parser.add_argument(
+    "--packed",
+    action="store_true",
+    help=(
+        "Run the encoder on the residues of each batch only, not on padding, which "
+        "is faster for sequences of mixed lengths."
+    ),
+)
+parser.add_argument(
+    "--global_sort",
+    action="store_true",
+    help=(
+        "When the input exceeds --max_seqs_len, chunk it by sequence length rather "
+        "than input order, for well-packed batches.  Output is in input order."
+    ),
+)
+parser.add_argument(
+    "--window_search",
+    type=str,
+    default="exhaustive",
+    choices=["exhaustive", "coarse", "anchors"],
+    help=(
+        "How to search long sequences without a CWC pattern for the domain: score "
+        "every sliding window, scan coarsely and refine around the best, or score "
+        "windows at conserved framework residues first (default: exhaustive)."
+    ),
+)
+parser.add_argument(
+    "--multi_domain",
+    action="store_true",
+    help=(
+        "Number every V domain of sequences longer than 200 residues, e.g. both "
+        "domains of an scFv.  Domains are named NAME|domain-N."
+    ),
+)
+parser.add_argument(
+    "--compile",
+    action="store_true",
+    help=(
+        "Compile the numbering models with torch.compile.  Compiled kernels are cached "
+        "on disk, so only the first run pays the compilation time."
+    ),
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    default="torch",
+    choices=["torch", "onnxruntime"],
+    help=(
+        "Run the numbering models with PyTorch or onnxruntime (default: torch).  "
+        "onnxruntime runs on CPU and needs --onnx_dir."
+    ),
+)
+parser.add_argument(
+    "--onnx_dir",
+    type=str,
+    default=None,
+    metavar="DIR",
+    help=(
+        "Directory of the ONNX models, as exported by "
+        "`python -m anarcii.inference.onnx_export DIR`."
+    ),
 )
 parser.add_argument(
     "--scheme",
@@ -94,11 +238,26 @@ def main(args=None):
     model = Anarcii(
         seq_type=args.seq_type,
         batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        bucket_width=args.bucket_width,
         cpu=args.cpu,
         ncpu=args.ncpu,
         mode=args.mode,
+        precision=args.precision,
+        compile=args.compile,
+        dtype=args.dtype,
+        draft_cache=args.draft_cache,
+        constrained=args.constrained,
+        score_gate=args.score_gate,
+        packed=args.packed,
+        global_sort=args.global_sort,
+        window_search=args.window_search,
+        multi_domain=args.multi_domain,
+        backend=args.backend,
+        onnx_dir=args.onnx_dir,
         verbose=args.verbose,
         max_seqs_len=args.max_seqs_len,
+        max_trailing_skips=args.max_trailing_skips,
     )
 
     try:
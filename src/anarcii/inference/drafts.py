@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from anarcii.input_data_processing.tokeniser import NumberingTokeniser
+
+
+class NumberingDrafts:
+    """
+    The predicted numbering tokens of numbered sequences, kept to draft the numbering
+    of later sequences for `ModelRunner`.
+
+    Sequences of the same length with cysteines and tryptophans at the same positions
+    (the conserved framework anchors, e.g. IMGT C23, W41 and C104) almost always
+    share a numbering layout.  The latest numbering of each such signature is kept,
+    for up to `max_size` signatures, dropping the least recently used first.
+
+    Drafts are only proposals: `ModelRunner` checks them against the model.  Keep
+    one `NumberingDrafts` per sequence type and mode.
+    """
+
+    def __init__(self, sequence_type, max_size=100_000):
+        if sequence_type in ["antibody", "shark"]:
+            sequence_tokeniser = NumberingTokeniser("protein_antibody")
+        elif sequence_type == "tcr":
+            sequence_tokeniser = NumberingTokeniser("protein_tcr")
+        else:
+            raise ValueError(f"Invalid model type: {sequence_type}")
+
+        self.anchor_ids = [sequence_tokeniser.char_to_int[c] for c in "CW"]
+        self.end_id = sequence_tokeniser.char_to_int[sequence_tokeniser.end]
+        self.max_size = max_size
+        self.tracks = OrderedDict()
+
+    def _signatures(self, src_ids):
+        # The length of each sequence, then the positions of its anchor residues.
+        lengths = (src_ids == self.end_id).argmax(1)
+        is_anchor = np.isin(src_ids, self.anchor_ids)
+        return [
+            (int(length), *np.flatnonzero(anchors[:length]).tolist())
+            for length, anchors in zip(lengths, is_anchor, strict=True)
+        ]
+
+    def lookup(self, src, pad_id):
+        """
+        Draft the numbering of a batch of tokenised sequences, `src`.
+
+        Returns the drafted tokens, of shape [batch size, src len + 1] and padded with
+        `pad_id`, and whether a draft was found for each sequence.
+        """
+        src_ids = src.cpu().numpy()
+        drafts = np.full((len(src_ids), src_ids.shape[1] + 1), pad_id)
+        found = np.zeros(len(src_ids), dtype=bool)
+
+        for i, key in enumerate(self._signatures(src_ids)):
+            track = self.tracks.get(key)
+            if track is not None:
+                self.tracks.move_to_end(key)
+                drafts[i, : len(track)] = track
+                found[i] = True
+
+        return torch.from_numpy(drafts).to(src.device), found
+
+    def add(self, src, max_input):
+        """Keep the predicted tokens, `max_input`, of a batch of sequences, `src`."""
+        src_ids = src.cpu().numpy()
+        pred_ids = max_input.cpu().numpy()
+
+        for track, key in zip(pred_ids, self._signatures(src_ids), strict=True):
+            # Predictions are read up to the position after the input <EOS>.
+            self.tracks[key] = track[: key[0] + 2]
+            self.tracks.move_to_end(key)
+
+        while len(self.tracks) > self.max_size:
+            self.tracks.popitem(last=False)
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import torch
+
+
+def _n_bytes(tensor):
+    return tensor.nelement() * tensor.element_size()
+
+
+class EncoderStates:
+    """
+    The encoder outputs of sequences scored by `WindowFinder`, kept for the
+    `TorchEngine` that numbers them with the same model, so that a window selected
+    for numbering is not encoded twice.
+
+    Sequences are keyed by their tokens.  Up to `max_bytes` of encoder outputs are
+    kept, dropping the least recently used first.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.states = OrderedDict()
+
+    @staticmethod
+    def _keys(src, src_mask):
+        # The tokens of each sequence, without padding, and its length.
+        lengths = (~src_mask).sum(1).tolist()
+        return [
+            (tokens[:length].tobytes(), length)
+            for tokens, length in zip(src.cpu().numpy(), lengths, strict=True)
+        ]
+
+    def add(self, src, src_mask, enc_src):
+        """Keep the encoder outputs, `enc_src`, of a batch of sequences, `src`."""
+        for i, (key, length) in enumerate(self._keys(src, src_mask)):
+            if key in self.states:
+                self.n_bytes -= _n_bytes(self.states[key])
+            # Copy, so as not to hold on to the whole batch.
+            self.states[key] = enc_src[i, :length].clone()
+            self.states.move_to_end(key)
+            self.n_bytes += _n_bytes(self.states[key])
+
+        while self.n_bytes > self.max_bytes:
+            _, state = self.states.popitem(last=False)
+            self.n_bytes -= _n_bytes(state)
+
+    def lookup(self, src, src_mask):
+        """
+        The kept encoder outputs of a batch of sequences, `src`, of shape [batch size,
+        src len, hid dim] and zero elsewhere, and whether each sequence was found.
+        Returns `None` for the outputs if no sequence was found.
+        """
+        enc_src = None
+        found = torch.zeros(src.shape[0], dtype=torch.bool, device=src.device)
+
+        for i, (key, _) in enumerate(self._keys(src, src_mask)):
+            state = self.states.get(key)
+            if state is None:
+                continue
+            self.states.move_to_end(key)
+            if enc_src is None:
+                enc_src = state.new_zeros(*src.shape, state.shape[-1])
+            enc_src[i, : len(state)] = state
+            found[i] = True
+
+        return enc_src, found
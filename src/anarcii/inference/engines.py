@@ -0,0 +1,187 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .onnx_export import onnx_model_paths
+
+
+class TorchEngine:
+    """
+    Run the encoder and the incremental decoder of a numbering model with PyTorch.
+
+    `encode` starts a batch, `step` predicts the next token of every sequence in the
+    batch, `select` drops sequences from the batch and `truncate` discards cached
+    tokens, e.g. rejected drafts of speculative decoding.
+
+    With a `dtype` other than float32, the model runs under autocast in that dtype.
+    With `packed`, the encoder skips padding tokens, see `Encoder.forward`.  With
+    `encoder_states`, an `EncoderStates` of the same model, sequences already encoded
+    are not encoded again.
+    """
+
+    def __init__(self, model, dtype=torch.float32, packed=False, encoder_states=None):
+        self.model = model
+        self.dtype = dtype
+        self.packed = packed
+        self.encoder_states = encoder_states
+
+    def _autocast(self):
+        return torch.autocast(
+            torch.device(self.model.device).type,
+            dtype=self.dtype,
+            enabled=self.dtype != torch.float32,
+        )
+
+    def encode(self, src, max_length):
+        """Encode a batch of tokenised sequences and preallocate the decoder cache."""
+        with self._autocast():
+            self.src_mask = self.model.make_src_mask(src)
+            self.enc_src = self._encode(src)
+            # Encoder-decoder attention keys/values are the same at every step.
+            self.enc_key_values = self.model.decoder.project_encoder(
+                self.enc_src, self.src_mask if self.packed else None
+            )
+        self.cache = self.model.decoder.init_cache(
+            src.shape[0], max_length, dtype=self.enc_key_values[0][0].dtype
+        )
+
+    def _encode(self, src):
+        if self.encoder_states is not None:
+            enc_src, found = self.encoder_states.lookup(src, self.src_mask)
+            if enc_src is not None:
+                # Encode only the sequences not found.
+                if not found.all():
+                    missing = ~found
+                    enc_src[missing] = self.model.encoder(
+                        src[missing], self.src_mask[missing], packed=self.packed
+                    ).to(enc_src.dtype)
+                return enc_src
+
+        return self.model.encoder(src, self.src_mask, packed=self.packed)
+
+    @property
+    def length(self):
+        """The number of tokens in the decoder cache."""
+        return self.cache[0].length
+
+    def step(self, trg):
+        """
+        Decode the tokens of `trg` (the tokens so far, of shape [batch size, trg len])
+        that are not yet cached, usually only the last.  Returns the logits of shape
+        [batch size, new len, vocab], predicting the token after each new token.
+        """
+        # The causal mask of the new tokens is built by the decoder.  A single new
+        # token needs none.
+        trg_pad_mask = trg == self.model.trg_pad_idx
+
+        with self._autocast():
+            output, self.cache = self.model.decoder(
+                trg[:, self.length :],
+                self.enc_src,
+                trg_pad_mask,
+                None,
+                self.src_mask,
+                self.cache,
+                enc_key_values=self.enc_key_values,
+            )
+        return output.float()
+
+    def select(self, index):
+        """Keep only the batch rows in `index`, e.g. to drop finished sequences."""
+        self.src_mask = self.src_mask[index]
+        self.enc_src = self.enc_src[index]
+        self.enc_key_values = [(k[index], v[index]) for k, v in self.enc_key_values]
+        for layer_cache in self.cache:
+            layer_cache.select(index)
+
+    def truncate(self, length):
+        """Discard the cached tokens after the first `length`."""
+        for layer_cache in self.cache:
+            layer_cache.truncate(length)
+
+
+class OnnxEngine:
+    """
+    Run the encoder and the incremental decoder of a numbering model with
+    onnxruntime, on CPU, from the graphs written by `anarcii.inference.onnx_export`.
+
+    The interface is that of `TorchEngine`.  Inputs and outputs are torch tensors on
+    the CPU.
+    """
+
+    def __init__(self, onnx_dir, sequence_type, mode, src_pad_idx=0, trg_pad_idx=0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "The onnxruntime backend requires the onnxruntime package."
+            ) from e
+
+        if onnx_dir is None:
+            raise ValueError("The onnxruntime backend requires an onnx_dir.")
+
+        encoder_path, decoder_path = onnx_model_paths(onnx_dir, sequence_type, mode)
+        for path in (encoder_path, decoder_path):
+            if not Path(path).exists():
+                raise FileNotFoundError(
+                    f"ONNX model not found: {path}.  Export it with "
+                    "`python -m anarcii.inference.onnx_export`."
+                )
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(
+            str(encoder_path), options, providers=providers
+        )
+        self.decoder = ort.InferenceSession(
+            str(decoder_path), options, providers=providers
+        )
+
+        self.src_pad_idx = src_pad_idx
+        self.trg_pad_idx = trg_pad_idx
+        # past_keys = [n layers, batch size, n heads, trg len, head dim]
+        past_keys = next(x for x in self.decoder.get_inputs() if x.name == "past_keys")
+        self.n_layers, _, self.n_heads, _, self.head_dim = past_keys.shape
+
+    def encode(self, src, max_length):
+        """Encode a batch of tokenised sequences and start an empty decoder cache."""
+        src = src.numpy().astype(np.int64)
+        self.src_mask = src == self.src_pad_idx
+        self.enc_keys, self.enc_values = self.encoder.run(None, {"src": src})
+
+        empty_shape = (self.n_layers, len(src), self.n_heads, 0, self.head_dim)
+        self.past_keys = np.zeros(empty_shape, dtype=np.float32)
+        self.past_values = np.zeros(empty_shape, dtype=np.float32)
+
+    def step(self, trg):
+        """
+        Decode the last token of `trg` (the tokens so far, of shape
+        [batch size, trg len]), returning the logits of shape [batch size, 1, vocab].
+        """
+        trg = trg.numpy().astype(np.int64)
+        logits, self.past_keys, self.past_values = self.decoder.run(
+            None,
+            {
+                "trg": trg[:, -1:],
+                "position": np.array([trg.shape[1] - 1], dtype=np.int64),
+                "trg_pad_mask": trg == self.trg_pad_idx,
+                "src_mask": self.src_mask,
+                "enc_keys": self.enc_keys,
+                "enc_values": self.enc_values,
+                "past_keys": self.past_keys,
+                "past_values": self.past_values,
+            },
+        )
+        return torch.from_numpy(logits)
+
+    def select(self, index):
+        """Keep only the batch rows in `index`, e.g. to drop finished sequences."""
+        index = index.numpy()
+        self.src_mask = self.src_mask[index]
+        self.enc_keys = self.enc_keys[:, index]
+        self.enc_values = self.enc_values[:, index]
+        self.past_keys = self.past_keys[:, index]
+        self.past_values = self.past_values[:, index]
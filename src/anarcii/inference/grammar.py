@@ -0,0 +1,81 @@
+import torch
+
+from .utils import forbidden_cdr_insertions
+
+
+class NumberingGrammar:
+    """
+    The valid sequences of numbering tokens, for constrained decoding.
+
+    A prediction is a chain token, then <SKIP> tokens for residues before the domain,
+    then the numbered region and then <SKIP> tokens for residues after it, up to
+    <EOS>.  In the numbered region, IMGT numbers strictly increase and runs of
+    insertions (X) follow a number where insertions are allowed.  These are the
+    predictions that post-processing accepts without a numbering error.
+
+    The state of each sequence is its last token (with a separate state for <SKIP>
+    after the numbered region) and its last number.  `transitions` tabulates the
+    tokens allowed after each state, and `mask` further requires numbers to be
+    greater than the last.
+    """
+
+    def __init__(self, number_tokeniser, device):
+        nt = number_tokeniser
+        vocab_size = len(nt.tokens)
+
+        pad, start, end, skip, x = (
+            nt.char_to_int[c] for c in (nt.pad, nt.start, nt.end, nt.skip, "X")
+        )
+        number_ids = [nt.char_to_int[n] for n in range(1, 129)]
+        # The chain tokens follow X in the vocabulary.
+        chain_ids = list(range(x + 1, vocab_size))
+
+        # The extra state, after the last token, is <SKIP> after the numbered region.
+        self.trailing_skip = vocab_size
+        transitions = torch.zeros(vocab_size + 1, vocab_size, dtype=torch.bool)
+
+        transitions[start, chain_ids] = True
+        for state in [*chain_ids, skip]:
+            transitions[state, [skip, *number_ids, end]] = True
+        for n, state in enumerate(number_ids, start=1):
+            transitions[state, [skip, *number_ids, end]] = True
+            transitions[state, x] = n not in forbidden_cdr_insertions
+        transitions[x, [x, skip, *number_ids, end]] = True
+        transitions[self.trailing_skip, [skip, end]] = True
+        # Completed sequences are padded regardless.
+        transitions[[pad, end]] = True
+
+        self.transitions = transitions.to(device)
+        self.start, self.skip = start, skip
+        self.first_number, self.last_number = number_ids[0], number_ids[-1]
+        self.vocab_ids = torch.arange(vocab_size, device=device)
+
+    def initial_state(self, batch_size, device):
+        """The state of sequences with only the <SOS> token."""
+        last_token = torch.full((batch_size,), self.start, device=device)
+        last_number = torch.zeros(batch_size, dtype=torch.long, device=device)
+        return last_token, last_number
+
+    def mask(self, state):
+        """The tokens allowed next, of shape [batch size, vocab]."""
+        last_token, last_number = state
+        allowed = self.transitions[last_token]
+
+        # Numbers must be greater than the last.
+        is_number = (self.vocab_ids >= self.first_number) & (
+            self.vocab_ids <= self.last_number
+        )
+        allowed &= ~(is_number & (self.vocab_ids <= last_number[:, None]))
+        return allowed
+
+    def update(self, state, tokens):
+        """The state after the next tokens, of shape [batch size]."""
+        last_token, last_number = state
+
+        started = last_number > 0
+        is_number = (tokens >= self.first_number) & (tokens <= self.last_number)
+        last_number = torch.where(is_number, tokens, last_number)
+        last_token = torch.where(
+            started & (tokens == self.skip), self.trailing_skip, tokens
+        )
+        return last_token, last_number
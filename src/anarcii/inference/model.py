@@ -1,9 +1,82 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 seq_max_len = 210
 
 
+class KeyValueCache:
+    """
+    Projected self-attention keys and values for one decoder layer.
+
+    The buffers are preallocated with shape [batch size, n heads, max len, head dim]
+    and, at each decoding step, only the projections of the new tokens are written.
+    """
+
+    def __init__(
+        self, batch_size, n_heads, max_length, head_dim, device, dtype=torch.float
+    ):
+        self.key = torch.zeros(
+            batch_size, n_heads, max_length, head_dim, device=device, dtype=dtype
+        )
+        self.value = torch.zeros_like(self.key)
+        # Number of tokens already cached
+        self.length = 0
+
+    def update(self, key, value):
+        # key = value = [batch size, n heads, new len, head dim]
+        start = self.length
+        self.length += key.shape[2]
+
+        self.key[:, :, start : self.length] = key
+        self.value[:, :, start : self.length] = value
+
+        # Return the full history, including the new tokens
+        return self.key[:, :, : self.length], self.value[:, :, : self.length]
+
+    def select(self, index):
+        """Keep only the batch rows in `index`, e.g. to drop finished sequences."""
+        self.key = self.key[index]
+        self.value = self.value[index]
+
+    def truncate(self, length):
+        """Discard the cached tokens after the first `length`, e.g. rejected drafts."""
+        self.length = min(self.length, length)
+
+
+def incremental_causal_mask(cached_length, new_length, device):
+    """
+    The causal mask of `new_length` tokens that follow `cached_length` tokens already
+    in the key/value cache, of shape [new len, cached len + new len].  True where
+    attention is not allowed.
+
+    A single new token may attend to every token, so needs no mask and None is
+    returned.
+    """
+    if new_length == 1:
+        return None
+
+    return torch.ones(
+        new_length, cached_length + new_length, dtype=torch.bool, device=device
+    ).triu(cached_length + 1)
+
+
+def packed_index(mask):
+    """
+    The flat positions, in a batch of shape [batch size, src len], of the tokens that
+    are not padding (`mask` is True for padding).  Position-wise layers can be run on
+    just these tokens, packed into a tensor of shape [n tokens, hid dim].
+    """
+    return torch.nonzero(~mask.flatten()).squeeze(1)
+
+
+def unpack(packed, index, shape):
+    """Scatter packed tokens back to a zero-padded batch of `shape` [batch, len]."""
+    padded = packed.new_zeros(shape[0] * shape[1], packed.shape[-1])
+    padded[index] = packed
+    return padded.view(*shape, -1)
+
+
 class EncoderLayer(nn.Module):
     def __init__(self, hid_dim, n_heads, pf_dim, dropout, device):
         super().__init__()
@@ -18,12 +91,13 @@ class EncoderLayer(nn.Module):
         )
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, src, src_mask):
-        # src = [batch size, src len, hid dim]
+    def forward(self, src, src_mask, index=None):
+        # src = [batch size, src len, hid dim], or [n tokens, hid dim] if packed
         # src_mask = [batch size, src len]
+        # index = the positions of the packed tokens, see `packed_index`
 
         # self attention
-        _src, _ = self.self_attention(src, src, src, src_mask)
+        _src, _ = self.self_attention(src, src, src, src_mask, index=index)
 
         # dropout, residual connection and layer norm
         src = self.self_attn_layer_norm(src + self.dropout(_src))
@@ -65,7 +139,11 @@ class Encoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.scale = torch.sqrt(torch.FloatTensor([hid_dim])).to(device)
 
-    def forward(self, src, src_mask):
+    def forward(self, src, src_mask, packed=False):
+        """
+        With `packed`, the layers are run on the tokens that are not padding only,
+        and the output is zero at padding positions.
+        """
         # src = [batch size, src len]
         # src_mask = [batch size, src len]
         batch_size = src.shape[0]
@@ -81,6 +159,16 @@ class Encoder(nn.Module):
         )
         # src = [batch size, src len, hid dim]
 
+        if packed:
+            index = packed_index(src_mask)
+            src = src.flatten(0, 1)[index]
+            # src = [n tokens, hid dim]
+
+            for layer in self.layers:
+                src = layer(src, src_mask, index)
+
+            return unpack(src, index, (batch_size, src_len))
+
         for layer in self.layers:
             src = layer(src, src_mask)
 
@@ -88,63 +176,219 @@ class Encoder(nn.Module):
         return src
 
 
+def convert_multihead_attn_state_dict(state_dict, prefix, in_proj_rows):
+    """
+    Convert, in place, the weights of a checkpoint saved with `nn.MultiheadAttention`
+    (under `<prefix>multihead_attn.`) to the `nn.Linear` projections of an attention
+    layer.  `in_proj_rows` maps the name of each input projection to the slice of rows
+    of the packed query/key/value weights that it holds.
+    """
+    old_prefix = prefix + "multihead_attn."
+    if old_prefix + "in_proj_weight" not in state_dict:
+        return
+
+    weight = state_dict.pop(old_prefix + "in_proj_weight")
+    bias = state_dict.pop(old_prefix + "in_proj_bias")
+    for name, rows in in_proj_rows.items():
+        state_dict[f"{prefix}{name}.weight"] = weight[rows]
+        state_dict[f"{prefix}{name}.bias"] = bias[rows]
+
+    for param in ("weight", "bias"):
+        state_dict[f"{prefix}out_proj.{param}"] = state_dict.pop(
+            f"{old_prefix}out_proj.{param}"
+        )
+
+
 class EncoderMultiHeadAttentionLayer(nn.Module):
     def __init__(self, hid_dim, n_heads, dropout, device):
         super().__init__()
 
-        # Initialize the built-in multi-head attention layer
-        self.multihead_attn = nn.MultiheadAttention(
-            hid_dim, n_heads, dropout=dropout, batch_first=True
-        )
+        # Separate query and key/value projections, so that the keys and values of the
+        # encoder output can be projected once per batch (see `project_key_value`).
+        # Being `nn.Linear` layers, the projections can also be quantised.
+        self.q_proj = nn.Linear(hid_dim, hid_dim)
+        self.kv_proj = nn.Linear(hid_dim, 2 * hid_dim)
+        self.out_proj = nn.Linear(hid_dim, hid_dim)
+        self.dropout_p = dropout
+        self.hid_dim = hid_dim
+        self.n_heads = n_heads
+        self.head_dim = hid_dim // n_heads
 
         # Ensure the multi-head attention layer and additional layers are moved to the
         # correct device
         self.device = device
         self.to(device)
 
-    def forward(self, query, key, value, mask):
-        # Forward pass through the built-in MultiheadAttention layer
-        attn_output, attn_output_weights = self.multihead_attn(
-            query, key, value, key_padding_mask=mask
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints hold the weights of the built-in multi-head attention layer.
+        convert_multihead_attn_state_dict(
+            state_dict,
+            prefix,
+            {
+                "q_proj": slice(None, self.hid_dim),
+                "kv_proj": slice(self.hid_dim, None),
+            },
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_key_value(self, enc_src, mask=None):
+        """
+        Project the encoder output to the keys and values of encoder-decoder
+        attention.  These are the same at every decoding step, so can be computed once
+        per batch and passed to `forward` as `key_value`.
+
+        Given the padding `mask`, only the tokens that are not padding are projected.
+        """
+        # enc_src = [batch size, src len, hid dim]
+        batch_size, src_len, _ = enc_src.shape
+
+        if mask is None:
+            kv = self.kv_proj(enc_src)
+        else:
+            index = packed_index(mask)
+            kv = unpack(
+                self.kv_proj(enc_src.flatten(0, 1)[index]), index, (batch_size, src_len)
+            )
+
+        k, v = (
+            kv.view(batch_size, src_len, 2 * self.n_heads, self.head_dim)
+            .transpose(1, 2)
+            .chunk(2, dim=1)
+        )
+        # k = v = [batch size, n heads, src len, head dim]
+
+        return k, v
+
+    def forward(self, query, key, value, mask, key_value=None, index=None):
+        # query = [batch size, query len, hid dim]
+        # key = value = [batch size, key len, hid dim]
+        # mask = [batch size, key len]
+        if index is not None:
+            return self._forward_packed(query, mask, index), None
+
+        batch_size, query_len, _ = query.shape
+
+        if key_value is None:
+            # The key and value are always the same tensor.
+            key_value = self.project_key_value(key)
+        k, v = key_value
+
+        q = (
+            self.q_proj(query)
+            .view(batch_size, query_len, self.n_heads, self.head_dim)
+            .transpose(1, 2)
+        )
+        # q = [batch size, n heads, query len, head dim]
+
+        # The padding mask is True where attention is not allowed
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=~mask[:, None, None, :],
+            dropout_p=self.dropout_p if self.training else 0.0,
         )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, query_len, -1)
+
+        # Attention weights are not computed.
+        return self.out_proj(attn_output), None
 
-        return attn_output, attn_output_weights
+    def _forward_packed(self, src, mask, index):
+        """
+        Self-attention of packed tokens, see `packed_index`.  The projections are
+        computed for the packed tokens only.  Attention is computed on the padded
+        batch, with padding masked, and only the outputs of the packed tokens kept.
+        """
+        # src = [n tokens, hid dim]
+        # mask = [batch size, src len]
+        batch_size, src_len = mask.shape
+        shape = (batch_size, src_len)
+
+        q = (
+            unpack(self.q_proj(src), index, shape)
+            .view(batch_size, src_len, self.n_heads, self.head_dim)
+            .transpose(1, 2)
+        )
+        k, v = (
+            unpack(self.kv_proj(src), index, shape)
+            .view(batch_size, src_len, 2 * self.n_heads, self.head_dim)
+            .transpose(1, 2)
+            .chunk(2, dim=1)
+        )
+        # q = k = v = [batch size, n heads, src len, head dim]
+
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=~mask[:, None, None, :],
+            dropout_p=self.dropout_p if self.training else 0.0,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size * src_len, -1)
+
+        return self.out_proj(attn_output[index])
 
 
 class DecoderMultiHeadAttentionLayer(nn.Module):
     def __init__(self, hid_dim, n_heads, dropout, device):
         super().__init__()
 
-        # Initialize the built-in multi-head attention layer
-        self.multihead_attn = nn.MultiheadAttention(
-            hid_dim, n_heads, dropout=dropout, batch_first=True
-        )
+        # The attention is computed below, to allow incremental decoding with
+        # projected keys and values.  Being `nn.Linear` layers, the projections can
+        # also be quantised.
+        self.in_proj = nn.Linear(hid_dim, 3 * hid_dim)
+        self.out_proj = nn.Linear(hid_dim, hid_dim)
+        self.dropout_p = dropout
+        self.n_heads = n_heads
+        self.head_dim = hid_dim // n_heads
 
         # Ensure the multi-head attention layer and additional layers are moved to the
         # correct device
         self.device = device
         self.to(device)
 
-    def forward(self, query, key, value, trg_pad_mask, trg_causal_mask, past_key_value):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints hold the weights of the built-in multi-head attention layer.
+        convert_multihead_attn_state_dict(state_dict, prefix, {"in_proj": slice(None)})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, query, trg_pad_mask, trg_causal_mask, past_key_value=None):
+        # query = [batch size, query len, hid dim]
+        # trg_pad_mask = [batch size, key len]
+        # trg_causal_mask = [query len, key len] or None
+        batch_size, query_len, _ = query.shape
+
+        # Project only the new tokens
+        q, k, v = (
+            self.in_proj(query)
+            .view(batch_size, query_len, 3 * self.n_heads, self.head_dim)
+            .transpose(1, 2)
+            .chunk(3, dim=1)
+        )
+        # q = k = v = [batch size, n heads, query len, head dim]
+
         if past_key_value is not None:
-            past_key, past_value = past_key_value
-            # Concatenate along the sequence length dimension (dim=1)
-            key = torch.cat([past_key, key], dim=1)
-            value = torch.cat([past_value, value], dim=1)
-
-        # Forward pass through the built-in MultiheadAttention layer
-        attn_output, attn_output_weights = self.multihead_attn(
-            query,
-            key,
-            value,
-            key_padding_mask=trg_pad_mask,
-            attn_mask=trg_causal_mask,
-            is_causal=True,  # add this if supported
+            # Write the new keys/values to the cache and attend to the full history
+            k, v = past_key_value.update(k, v)
+
+        # Masks are True where attention is not allowed.  A single query may attend
+        # to every key, so there is no causal mask.
+        mask = trg_pad_mask[:, None, None, :]
+        if trg_causal_mask is not None:
+            mask = mask | trg_causal_mask
+        # mask = [batch size, 1, query len or 1, key len]
+
+        attn_output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=~mask,
+            dropout_p=self.dropout_p if self.training else 0.0,
         )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, query_len, -1)
+        # attn_output = [batch size, query len, hid dim]
 
-        # Update the cache with the new key/value (now including history)
-        new_key_value = (key, value)
-        return attn_output, attn_output_weights, new_key_value
+        return self.out_proj(attn_output), past_key_value
 
 
 class PositionwiseFeedforwardLayer(nn.Module):
@@ -194,36 +438,20 @@ class DecoderLayer(nn.Module):
         trg_causal_mask,
         src_mask,
         self_attn_cache=None,
+        enc_key_value=None,
     ):
-        if self_attn_cache is not None:
-            # Number of tokens already cached
-            cached_length = self_attn_cache[0].shape[1]
-            # Number of new tokens (typically 1 during inference)
-            new_length = trg.shape[1]  # usually 1
-            total_length = cached_length + new_length
-
-            # Create a full causal mask for the concatenated sequence:
-            full_causal_mask = ~torch.tril(
-                torch.ones((total_length, total_length), device=trg.device)
-            ).bool()
-
-            # Slice out the rows for the new tokens: shape [new_length, total_length]
-            trg_causal_mask = full_causal_mask[
-                cached_length : cached_length + new_length, :
-            ]
-        else:
-            trg_len = trg.shape[1]
-            trg_causal_mask = ~torch.tril(
-                torch.ones((trg_len, trg_len), device=trg.device)
-            ).bool()
+        # trg_causal_mask = [trg len, cached len + trg len] or None, for a single
+        # token.  See `incremental_causal_mask`.
 
         # Self-attention with caching support
-        _trg, _, new_self_cache = self.self_attention(
-            trg, trg, trg, trg_pad_mask, trg_causal_mask, past_key_value=self_attn_cache
+        _trg, new_self_cache = self.self_attention(
+            trg, trg_pad_mask, trg_causal_mask, past_key_value=self_attn_cache
         )
         trg = self.self_attn_layer_norm(trg + self.dropout(_trg))
 
-        _trg, attention = self.encoder_attention(trg, enc_src, enc_src, src_mask)
+        _trg, attention = self.encoder_attention(
+            trg, enc_src, enc_src, src_mask, key_value=enc_key_value
+        )
         trg = self.enc_attn_layer_norm(trg + self.dropout(_trg))
 
         _trg = self.positionwise_feedforward(trg)
@@ -248,6 +476,8 @@ class Decoder(nn.Module):
 
         self.device = device
         self.output_dim = output_dim
+        self.hid_dim = hid_dim
+        self.n_heads = n_heads
         self.tok_embedding = nn.Embedding(output_dim, hid_dim)
         self.pos_embedding = nn.Embedding(max_length, hid_dim)
 
@@ -262,59 +492,107 @@ class Decoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.scale = torch.sqrt(torch.FloatTensor([hid_dim])).to(device)
 
+    def init_cache(self, batch_size, max_length, dtype=torch.float):
+        """
+        Preallocate a self-attention key/value cache for each decoder layer, large
+        enough to hold `max_length` tokens.
+        """
+        return [
+            KeyValueCache(
+                batch_size,
+                self.n_heads,
+                max_length,
+                self.hid_dim // self.n_heads,
+                self.device,
+                dtype,
+            )
+            for _ in self.layers
+        ]
+
+    def project_encoder(self, enc_src, src_mask=None):
+        """
+        Compute the encoder-decoder attention keys and values of each decoder layer.
+        Pass the result to `forward` as `enc_key_values` to reuse them at every step.
+        Given `src_mask`, padding tokens are not projected.
+        """
+        return [
+            layer.encoder_attention.project_key_value(enc_src, src_mask)
+            for layer in self.layers
+        ]
+
     def forward(
-        self, trg, enc_src, trg_pad_mask, trg_causal_mask, src_mask, caches=None
+        self,
+        trg,
+        enc_src,
+        trg_pad_mask,
+        trg_causal_mask,
+        src_mask,
+        caches=None,
+        enc_key_values=None,
     ):
         """
-        Optionally accepts a list 'caches' of length equal to the number of decoder
-        layers. Each element in caches is the cached (key, value) tuple for that layer's
-        self-attention. The method returns both the output logits and the new list of
-        caches.
+        Optionally accepts a list 'caches' of KeyValueCache objects, one per decoder
+        layer, as created by `init_cache`.  Each holds the projected self-attention
+        keys and values of the tokens processed so far, and is updated in place with
+        those of `trg`.  The method returns both the output logits and the caches.
+
+        Likewise, 'enc_key_values' optionally holds the per-layer encoder-decoder
+        attention keys and values from `project_encoder`.  Otherwise, they are
+        projected from 'enc_src'.
+
+        With caches, 'trg_causal_mask' is ignored (and may be None): the mask of the
+        new tokens is built by `incremental_causal_mask`.
         """
         batch_size = trg.shape[0]
         trg_len = trg.shape[1]
 
-        # If caches are provided and not None, we assume that each cache already
-        # contains the tokens processed so far. Thus, the new token should get a
-        # position equal to the current cache length.
-        if caches is not None and caches[0] is not None:
-            # caches[0] is a tuple (past_key, past_value) for the first layer.
-            # Its shape is (batch_size, L_cached, hid_dim).
-            cache_len = caches[0][0].shape[1]
-            # For the current trg (typically shape (batch_size, 1) during inference),
-            # assign position = cache_len.
-            pos = torch.full(
-                (batch_size, trg_len), cache_len, device=self.device, dtype=torch.long
-            )
-        else:
-            pos = (
-                torch.arange(0, trg_len, device=self.device)
-                .unsqueeze(0)
-                .repeat(batch_size, 1)
-            )
+        # If caches are provided, they already contain the tokens processed so far.
+        # Thus, the new tokens are positioned after the current cache length.
+        cache_len = caches[0].length if caches is not None else 0
+        pos = (
+            torch.arange(cache_len, cache_len + trg_len, device=self.device)
+            .unsqueeze(0)
+            .repeat(batch_size, 1)
+        )
 
         trg = self.dropout(
             (self.tok_embedding(trg) * self.scale) + self.pos_embedding(pos)
         )
 
-        new_caches = []
-        # If no caches are provided, initialize with None for each layer.
-        if caches is None:
-            caches = [None] * len(self.layers)
+        if caches is not None:
+            # The new tokens attend to the cached tokens and causally to each other.
+            trg_causal_mask = incremental_causal_mask(cache_len, trg_len, self.device)
+
+        # If no caches are provided, run without caching.
+        layer_caches = caches if caches is not None else [None] * len(self.layers)
+        if enc_key_values is None:
+            enc_key_values = [None] * len(self.layers)
 
-        for i, layer in enumerate(self.layers):
-            trg, attention, new_cache = layer(
+        for layer, cache, enc_key_value in zip(
+            self.layers, layer_caches, enc_key_values, strict=True
+        ):
+            trg, _, _ = layer(
                 trg,
                 enc_src,
                 trg_pad_mask,
                 trg_causal_mask,
                 src_mask,
-                self_attn_cache=caches[i],
+                self_attn_cache=cache,
+                enc_key_value=enc_key_value,
             )
-            new_caches.append(new_cache)
 
         output = self.fc_out(trg)
-        return output, new_caches
+        return output, caches
+
+
+def quantize_int8(model):
+    """
+    Return a copy of `model` with every `nn.Linear` layer (the attention projections,
+    the feedforward layers and the output layer) dynamically quantised to int8.
+    Weights are stored as int8 and activations are quantised on the fly, so the
+    quantised model only runs on CPU.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
 
 
 class S2S(nn.Module):
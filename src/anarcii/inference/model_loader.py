@@ -1,17 +1,139 @@
 import importlib.resources as pkg_resources
 import json
 import os
+from collections import OrderedDict
+from pathlib import Path
 
 import torch
 
 from . import model
 
+# Compiled kernels are cached here, unless another directory is given.
+default_compile_cache_dir = Path.home() / ".cache" / "anarcii" / "torch_compile"
+
+
+def configure_compile_cache(cache_dir=None):
+    """
+    Cache the kernels compiled by `torch.compile` on disk, so that later processes
+    load them instead of compiling again.
+    """
+    cache_dir = Path(cache_dir or default_compile_cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+
+    import torch._inductor.config
+
+    torch._inductor.config.fx_graph_cache = True
+    # A graph is compiled for each length bucket and batch size.
+    torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 64)
+
+
+class ModelRegistry:
+    """
+    The models loaded in this process, so that each is loaded once and shared by
+    every `ModelRunner`, `WindowFinder` and `Classifii`, across chunks, calls and
+    `Anarcii` instances.
+
+    Models are keyed by what they were loaded with, e.g. sequence type, mode, device
+    and precision.  With `max_models`, the least recently used models are dropped
+    beyond that number, e.g. for memory-constrained workers.  For the models of this
+    process, see `set_max_models`.
+    """
+
+    def __init__(self, max_models=None):
+        self.max_models = max_models
+        self.models = OrderedDict()
+
+    def get(self, key, load):
+        """The model for `key`, loaded with `load()` if it is not already."""
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        model = self.models[key] = load()
+        self.evict()
+        return model
+
+    def evict(self):
+        """Drop the least recently used models beyond `max_models`."""
+        while self.max_models is not None and len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+
+    def clear(self):
+        self.models.clear()
+
+
+# The models loaded in this process.
+model_registry = ModelRegistry()
+
+
+def set_max_models(max_models=None):
+    """
+    Keep at most `max_models` models loaded in this process, for every `Anarcii`
+    instance, dropping the least recently used.  `None` sets no limit.
+    """
+    model_registry.max_models = max_models
+    model_registry.evict()
+
+
+def load_model(
+    sequence_type,
+    mode,
+    device,
+    precision="fp32",
+    compile=False,
+    compile_cache_dir=None,
+):
+    """
+    The numbering model of a sequence type and mode, loaded with `Loader` on first
+    use and then shared from `model_registry`.
+    """
+    # Speculative mode verifies with the accuracy model, the only shark model.
+    if sequence_type == "shark" or mode == "speculative":
+        mode = "accuracy"
+    # Cascade mode numbers with the speed model first.
+    elif mode == "cascade":
+        mode = "speed"
+    key = ("numbering", sequence_type, mode, str(device), precision, compile)
+
+    return model_registry.get(
+        key,
+        lambda: (
+            Loader(
+                sequence_type,
+                mode,
+                device,
+                precision,
+                compile=compile,
+                compile_cache_dir=compile_cache_dir,
+            ).model
+        ),
+    )
+
 
 class Loader:
-    def __init__(self, sequence_type, mode, device):
+    def __init__(
+        self,
+        sequence_type,
+        mode,
+        device,
+        precision="fp32",
+        compile=False,
+        compile_cache_dir=None,
+    ):
         self.device = device
         self.type = sequence_type
         self.mode = mode
+        self.precision = precision
+        self.compile = compile
+        self.compile_cache_dir = compile_cache_dir
+
+        if self.precision not in ("fp32", "int8"):
+            raise ValueError(
+                "Invalid precision specified. Choose either 'fp32' or 'int8'."
+            )
+        if self.precision == "int8" and torch.device(self.device).type != "cpu":
+            raise ValueError("int8 precision is only supported on CPU.")
 
         # Based on the user inputs this loads the model parameters
         params = self._load_params()
@@ -34,12 +156,13 @@ class Loader:
             param_filename = f"{self.type}_4_2_128_512.json"
         elif self.mode == "speed":
             param_filename = f"{self.type}_4_1_128_512.json"
-        elif self.mode == "accuracy":
+        elif self.mode in ("accuracy", "speculative"):
+            # Speculative decoding verifies with the accuracy model.
             param_filename = f"{self.type}_4_2_128_512.json"
         else:
             raise ValueError(
-                "Invalid mode specified. Choose either 'speed' or 'accuracy' or "
-                "'shark' (aliases 'vnar', 'vhh')."
+                "Invalid mode specified. Choose either 'speed', 'accuracy', "
+                "'speculative' or 'shark' (aliases 'vnar', 'vhh')."
             )
 
         param_path = pkg_resources.files("anarcii.models").joinpath(
@@ -98,4 +221,24 @@ class Loader:
 
         S2S.eval()
 
+        if self.precision == "int8":
+            S2S = model.quantize_int8(S2S)
+
+        if self.compile:
+            self._compile_model(S2S)
+
         return S2S
+
+    def _compile_model(self, S2S):
+        """
+        Compile the encoder and decoder with `torch.compile`, in place.
+
+        The encoder is compiled for static shapes, so its inputs should be padded to
+        length buckets (see `pad_to_length_bucket`).  The decoder is run one step at a
+        time with a growing key/value cache, so it is compiled for dynamic shapes.
+        The methods of both are still available on the compiled modules.
+        """
+        configure_compile_cache(self.compile_cache_dir)
+
+        S2S.encoder = torch.compile(S2S.encoder, dynamic=False)
+        S2S.decoder = torch.compile(S2S.decoder, dynamic=True)
@@ -1,10 +1,24 @@
+import numpy as np
 import torch
 
 from anarcii.input_data_processing import TokenisedSequence
 from anarcii.input_data_processing.tokeniser import NumberingTokeniser
 
-from .model_loader import Loader
-from .utils import build_inward_list, dataloader
+from .drafts import NumberingDrafts
+from .encoder_states import EncoderStates
+from .engines import OnnxEngine, TorchEngine
+from .grammar import NumberingGrammar
+from .model import seq_max_len
+from .model_loader import load_model
+from .utils import (
+    alphabet,
+    build_inward_list,
+    cdr_instertion_starts,
+    dataloader,
+    forbidden_cdr_insertions,
+    inward_label_tables,
+    pad_to_length_bucket,
+)
 
 # NEED TO COME BACK TO THIS CODE AND LOOK AT THE TRY EXCEPT LOOPS....
 # SOMETHING SHOULD BE MODIFIED TO REDUCE THEM....
@@ -13,6 +27,26 @@ from .utils import build_inward_list, dataloader
 # A cutoff score to consider a sequence as well numbered by the language model.
 CUTOFF_SCORE = 15
 
+# Drop completed sequences from the decoding batch once they make up this fraction.
+COMPACTION_FRACTION = 0.25
+
+# With a compiled model, inputs are padded to a multiple of this length.
+COMPILE_BUCKET_WIDTH = 16
+
+# In reduced precision, sequences scoring within this margin of the cutoff score are
+# numbered again in fp32.
+FP32_RERUN_MARGIN = 1.0
+
+# In speculative mode, the number of tokens drafted by the speed model per round.
+DRAFT_TOKENS = 8
+
+# In cascade mode, sequences that the speed model scores within this margin above the
+# cutoff score are numbered again by the accuracy model.
+CASCADE_MARGIN = 3.0
+
+# The error of sequences rejected by the score gate.
+GATED_ERROR = "Chain token score below the score gate."
+
 
 class ModelRunner:
     """
@@ -38,14 +72,107 @@ class ModelRunner:
     Finally the sequence is appended with empty labels to ensure that the returned
     result contains all integer labels from 1 to 128.
 
+    The inference loop tracks which sequences in a batch are complete (they have
+    predicted <EOS> or reached the end of the input), drops them from the working
+    batch and stops as soon as every sequence is done.  Optionally,
+    `max_trailing_skips` also marks a sequence as done once it has been numbered to the
+    end of the domain (IMGT 127/128) and has then predicted that many consecutive
+    <SKIP> tokens, so constant-region tails are not decoded residue by residue.
+
+    Batches hold `batch_size` sequences, unless `max_tokens` is given, in which case
+    the length-sorted sequences are packed into batches of at most `max_tokens` padded
+    tokens (optionally also split into length buckets of `bucket_width`).
+
+    The model is run with PyTorch, or with `backend="onnxruntime"`, from the ONNX
+    graphs in `onnx_dir` (see `anarcii.inference.onnx_export`).
+
+    With `dtype="bfloat16"`, the model runs under autocast in bfloat16, and sequences
+    scoring near `CUTOFF_SCORE` are numbered again in fp32.
+
+    With `compile`, the model is compiled with `torch.compile` and inputs are padded
+    to length buckets, see `warmup`.
+
+    With `mode="speculative"`, the speed model drafts tokens that the accuracy model
+    verifies several at a time, see `_speculate`.  The numbering is that of accuracy
+    mode.  The whole batch advances by its shortest accepted draft, so this only pays
+    off at small batch sizes.  There is only one shark model, which is then simply run
+    as in accuracy mode.
+
+    With `drafts`, a `NumberingDrafts` of earlier results, a sequence that shares the
+    length and framework anchors of one already numbered is first checked against
+    that numbering in a single teacher-forced pass, see `_decode_with_drafts`.
+
+    With `constrained`, each decoding step only predicts tokens that continue a valid
+    numbering, see `NumberingGrammar`, so predictions are not discarded for errors
+    such as duplicate numbers or forbidden insertions.
+
+    With `score_gate`, a sequence whose first decoding step (the chain token) scores
+    below `CUTOFF_SCORE` by more than this margin is not decoded any further and is
+    reported as failed, which saves most of the work on sequences that are not
+    antigen receptor domains.  `n_gated` counts them.
+
+    With `mode="cascade"`, sequences are numbered by the speed model, then those that
+    fail, have a numbering error or score less than `cascade_margin` above
+    `CUTOFF_SCORE` are numbered again by the accuracy model, see `_cascade`.  The
+    "model" of each result is that which numbered it.
+
+    With `packed`, the encoder runs its position-wise layers on the tokens of each
+    batch that are not padding only, which saves most of its work on batches of
+    mixed lengths.  It does not apply with `compile`, which needs static shapes.
+
+    With `encoder_states`, an `EncoderStates` filled by a `WindowFinder` sharing the
+    model, windows of long sequences that were scored as they are numbered are not
+    encoded again.
+
     """
 
-    def __init__(self, sequence_type, mode, batch_size, device, verbose):
+    def __init__(
+        self,
+        sequence_type,
+        mode,
+        batch_size,
+        device,
+        verbose,
+        max_trailing_skips: int | None = None,
+        max_tokens: int | None = None,
+        bucket_width: int | None = None,
+        precision: str = "fp32",
+        compile: bool = False,
+        compile_cache_dir=None,
+        backend: str = "torch",
+        onnx_dir=None,
+        dtype: str = "float32",
+        drafts: NumberingDrafts | None = None,
+        constrained: bool = False,
+        score_gate: float | None = None,
+        cascade_margin: float = CASCADE_MARGIN,
+        packed: bool = False,
+        encoder_states: EncoderStates | None = None,
+    ):
         self.type = sequence_type.lower()
         self.mode = mode.lower()
         self.batch_size = batch_size
         self.device = device
         self.verbose = verbose
+        self.max_trailing_skips = max_trailing_skips
+        if max_trailing_skips is not None and max_trailing_skips < 1:
+            raise ValueError("max_trailing_skips must be at least 1.")
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.precision = precision
+        self.compile = compile
+        self.compile_cache_dir = compile_cache_dir
+        self.backend = backend.lower()
+        self.onnx_dir = onnx_dir
+        self.dtype = dtype.lower()
+        self.drafts = drafts
+        self.n_drafts_accepted = 0
+        self.constrained = constrained
+        self.score_gate = score_gate
+        self.n_gated = 0
+        self.cascade_margin = cascade_margin
+        self.packed = packed
+        self.encoder_states = encoder_states
 
         if self.type in ["antibody", "shark"]:
             self.sequence_tokeniser = NumberingTokeniser("protein_antibody")
@@ -83,12 +210,123 @@ class ModelRunner:
             .unsqueeze(0)
             .to(self.device)
         )
+        # The last IMGT numbers of a domain, beyond which only <SKIP> is expected.
+        self.end_tokens = (
+            torch.tensor(self.number_tokeniser.encode([127, 128]))
+            .unsqueeze(0)
+            .to(self.device)
+        )
+
+        self.grammar = None
+        if self.constrained:
+            if self.mode == "speculative" or self.drafts is not None:
+                raise ValueError(
+                    "Constrained decoding does not apply to speculative mode or drafts."
+                )
+            self.grammar = NumberingGrammar(self.number_tokeniser, self.device)
+
+        if self.dtype not in ("float32", "bfloat16"):
+            raise ValueError(
+                "Invalid dtype specified. Choose either 'float32' or 'bfloat16'."
+            )
+
+        # With reduced precision, an fp32 engine re-runs sequences near the cutoff.
+        self.fp32_engine = None
+        self.n_fp32_reruns = 0
+        # In speculative mode, an engine running the speed model drafts tokens.
+        self.draft_engine = None
+        self.n_drafted = self.n_accepted = 0
+        # In cascade mode, an engine running the accuracy model numbers again the
+        # sequences that the speed model does not number well.
+        self.cascade_engine = None
+        self.n_cascaded = 0
+
+        if self.backend == "torch":
+            if self.packed and self.compile:
+                raise ValueError("Packed encoding does not apply with compile.")
+            dtype = getattr(torch, self.dtype)
+            self.model = self._load_model()
+            self.engine = TorchEngine(
+                self.model,
+                dtype,
+                packed=self.packed,
+                encoder_states=self.encoder_states,
+            )
+            if self.dtype != "float32":
+                self.fp32_engine = TorchEngine(
+                    self.model, packed=self.packed, encoder_states=self.encoder_states
+                )
+            if self.mode == "speculative" and self.type != "shark":
+                draft_model = self._load_model("speed")
+                self.draft_engine = TorchEngine(draft_model, dtype, packed=self.packed)
+            if self.mode == "cascade" and self.type != "shark":
+                accuracy_model = self._load_model("accuracy")
+                self.cascade_engine = TorchEngine(
+                    accuracy_model, dtype, packed=self.packed
+                )
+        elif self.backend == "onnxruntime":
+            if torch.device(self.device).type != "cpu":
+                raise ValueError("The onnxruntime backend only runs on CPU.")
+            if (
+                self.precision != "fp32"
+                or self.compile
+                or self.dtype != "float32"
+                or self.packed
+            ):
+                raise ValueError(
+                    "precision, compile, dtype and packed only apply to the torch "
+                    "backend."
+                )
+            if self.mode == "speculative" or self.drafts is not None:
+                raise ValueError(
+                    "Speculative mode and drafts only apply to the torch backend."
+                )
+            self.model = None
+            mode = "speed" if self.mode == "cascade" else self.mode
+            self.engine = OnnxEngine(self.onnx_dir, self.type, mode)
+            if self.mode == "cascade" and self.type != "shark":
+                self.cascade_engine = OnnxEngine(self.onnx_dir, self.type, "accuracy")
+        else:
+            raise ValueError(
+                "Invalid backend specified. Choose either 'torch' or 'onnxruntime'."
+            )
+
+    def _load_model(self, mode=None):
+        return load_model(
+            self.type,
+            mode or self.mode,
+            self.device,
+            self.precision,
+            compile=self.compile,
+            compile_cache_dir=self.compile_cache_dir,
+        )
 
-        self.model = self._load_model()
+    def warmup(self):
+        """
+        Compile the model ahead of numbering, e.g. before a server takes traffic, by
+        numbering a dummy batch of each input length bucket.  Compiled kernels are
+        cached on disk, so warming up is quicker in later processes.  Without
+        `compile`, this does nothing.
+        """
+        if not self.compile:
+            return
+
+        aa = self.sequence_tokeniser
+        # The lengths produced by `pad_to_length_bucket`.
+        bucket_lengths = [
+            *range(COMPILE_BUCKET_WIDTH, seq_max_len - 1, COMPILE_BUCKET_WIDTH),
+            seq_max_len - 1,
+        ]
+        with torch.no_grad():
+            for length in bucket_lengths:
+                batch_size = self.batch_size
+                if self.max_tokens:
+                    batch_size = max(1, self.max_tokens // length)
 
-    def _load_model(self):
-        model_loader = Loader(self.type, self.mode, self.device)
-        return model_loader.model
+                # <SOS>, a run of alanines, <EOS>
+                tokens = aa.encode([aa.start, *"A" * (length - 2), aa.end])
+                src = torch.from_numpy(tokens).repeat(batch_size, 1).to(self.device)
+                self._decode_batch(src)
 
     def __call__(self, tokenised_seqs: dict[str, TokenisedSequence], offsets):
         """
@@ -99,7 +337,12 @@ class ModelRunner:
 
         # NB: Provide a list of recommended batch sizes based on RAM and architecture
 
-        dl = dataloader(self.batch_size, list(tokenised_seqs.values()))
+        dl = dataloader(
+            self.batch_size,
+            list(tokenised_seqs.values()),
+            max_tokens=self.max_tokens,
+            bucket_width=self.bucket_width,
+        )
         numbering = dict(zip(tokenised_seqs, self._predict_numbering(dl), strict=False))
 
         # Add offsets, where necessary.
@@ -112,480 +355,741 @@ class ModelRunner:
 
         return numbering
 
-    def _predict_numbering(self, dl):
+    def _decode_batch(self, src, engine=None, verified_logits=None):
         """
-        1 Runs the autoregressive inference loop which takes batches of sequences and
-        predicts for the whole batch
+        Run the autoregressive inference loop for a batch of tokenised sequences, with
+        `engine` (by default, that of the runner).
 
-        2 Converts token values to word and transfer to CPU  (if running on GPU)
+        Sequences are dropped from the working batch as they complete, so that the
+        remaining decoding steps are only spent on the sequences still being numbered.
 
-        3 Works out the valid indicies - IMGT integer numbers predicted by the model
+        Returns the predicted tokens, starting with the <SOS> token, of shape
+        [batch size, src len + 1] and the score of each prediction, of shape
+        [batch size, src len].  Positions after a sequence completed are left as
+        <PAD> tokens with a score of zero.
 
-        4 find the EOS predicted by the model and the EOS of the input sequence
+        In speculative mode, with the runner's engine, each step may predict several
+        tokens, see `_speculate`.  With constrained decoding, invalid tokens are masked
+        from the logits of each step, see `NumberingGrammar`.
 
-        5 iterates through each batch of predictions
-            5A - check score is valid
-            5B - if valid iterate over individual seq.
-            5C - forward fill to end of the sequence for missed numbering
-            5D - back fill for the start if the seq
-            5E - Fill in up to 1 (starting IMGT residue) with gaps
-            5F - Add gaps to nums where we are missing a number in the middle (27, 29)
+        `verified_logits`, of shape [batch size, n, vocab], are those of the first n
+        tokens from a teacher-forced pass of `engine`, see `_verify_drafts`.  They are
+        used in place of the first n steps.  The engine then already holds the encoded
+        batch, and the first n tokens in its cache.
+        """
+        batch_size = src.shape[0]
+        trg_len = src.shape[1] + 1  # Need to add 1 to include chain ID
+
+        # Only the runner's own engine is verified against drafts, not the fp32 re-run.
+        draft_engine = self.draft_engine if engine is None else None
+        engine = engine or self.engine
+        if verified_logits is None:
+            engine.encode(src, trg_len)
+        if draft_engine is not None:
+            draft_engine.encode(src, trg_len)
+
+        max_input = torch.zeros(
+            batch_size, trg_len, device=self.device, dtype=torch.long
+        )
+        max_input[:, 0] = src[:, 0]
 
-        6 Populate the meta data dict and add to alignment
+        scores = torch.zeros(
+            batch_size, trg_len - 1, device=self.device, dtype=torch.float
+        )
 
-        Return the
-        """
-        if self.verbose:
-            print(f"Making predictions on {len(dl)} batches.")
+        # Predictions are read up to the position after the <EOS> of the input, so a
+        # sequence is complete once that position has been predicted.
+        src_eos_positions = torch.argmax((src == self.eos_token).to(torch.int64), dim=1)
+
+        # The working batch: the row indices of the sequences still being decoded,
+        # their tokens so far and their completion state.
+        active = torch.arange(batch_size, device=self.device)
+        decoded = max_input.clone()
+        finished = torch.zeros(batch_size, device=self.device, dtype=torch.bool)
+        past_end = torch.zeros_like(finished)
+        trailing_skips = torch.zeros_like(src_eos_positions)
+        if self.grammar is not None:
+            grammar_state = self.grammar.initial_state(batch_size, self.device)
+
+        t = 1  # The position of the next token
+        while t < trg_len:
+            if verified_logits is not None and t == 1:
+                output = verified_logits
+            elif draft_engine is None:
+                output = engine.step(decoded[:, :t])
+                if self.grammar is not None:
+                    allowed = self.grammar.mask(grammar_state).unsqueeze(1)
+                    output = output.masked_fill(~allowed, float("-inf"))
+            else:
+                output = self._speculate(
+                    engine, draft_engine, decoded[:, :t], finished, trg_len
+                )
+            # output = [batch size, n new tokens, vocab]
+
+            pred_tokens = output.argmax(2)
+            pred_scores = output.topk(1, dim=2).values.squeeze(2)
+
+            for pred_token, step_scores in zip(
+                pred_tokens.split(1, dim=1), pred_scores.split(1, dim=1), strict=True
+            ):
+                # Sequences that completed at an earlier step, but are yet to be
+                # dropped from the working batch, are padded from here on.
+                done = finished.unsqueeze(1)
+                pred_token = pred_token.masked_fill(done, self.pad_token.item())
+                step_scores = step_scores.masked_fill(done, 0.0)
+
+                decoded[:, t : t + 1] = pred_token
+                max_input[active, t : t + 1] = pred_token
+                scores[active, t - 1 : t] = step_scores
+
+                finished |= (pred_token == self.eos_token).squeeze(1)
+                finished |= src_eos_positions < t
+
+                if self.score_gate is not None and t == 1:
+                    # Stop at the chain token if it scores too low.
+                    finished |= step_scores.squeeze(1) < self._gate_cutoff
+
+                if self.grammar is not None:
+                    grammar_state = self.grammar.update(
+                        grammar_state, pred_token.squeeze(1)
+                    )
 
-        numbering = []
+                if self.max_trailing_skips is not None:
+                    is_skip = (pred_token == self.skip_token).squeeze(1)
+                    past_end |= (pred_token == self.end_tokens).any(dim=1)
+                    trailing_skips = torch.where(
+                        past_end & is_skip, trailing_skips + 1, 0
+                    )
+                    finished |= trailing_skips >= self.max_trailing_skips
 
-        num = 0
+                t += 1
 
-        pad_token = self.pad_token
-        sos_token = self.sos_token
-        eos_token = self.eos_token
-        skip_token = self.skip_token
-        x_token = self.x_token
+            n_finished = int(finished.sum())
+            if n_finished == len(active):
+                break
 
-        ### 1 RUN AUTOREGRESSIVE INFERENCE LOOP OVER BATCHES
+            # Compacting copies the caches, so wait for enough rows to finish.
+            if n_finished >= COMPACTION_FRACTION * len(active):
+                keep = torch.nonzero(~finished).squeeze(1)
 
-        with torch.no_grad():
-            for X in dl:
-                src = X.to(self.device)
-                batch_size = src.shape[0]
-                trg_len = src.shape[1] + 1  # Need to add 1 to include chain ID
+                active = active[keep]
+                decoded = decoded[keep]
+                engine.select(keep)
+                if draft_engine is not None:
+                    draft_engine.select(keep)
 
-                src_mask = self.model.make_src_mask(src)
-                enc_src = self.model.encoder(src, src_mask)
+                src_eos_positions = src_eos_positions[keep]
+                finished = finished[keep]
+                past_end = past_end[keep]
+                trailing_skips = trailing_skips[keep]
+                if self.grammar is not None:
+                    grammar_state = tuple(s[keep] for s in grammar_state)
 
-                input = src[:, 0].unsqueeze(1)
-                mask_input = src[:, 0].unsqueeze(1)
-                cache = None
+        return max_input, scores
 
-                max_input = torch.zeros(
-                    batch_size, trg_len, device=self.device, dtype=torch.long
-                )
-                max_input[:, 0] = src[:, 0]
+    @property
+    def _gate_cutoff(self):
+        return CUTOFF_SCORE - self.score_gate
 
-                scores = torch.zeros(
-                    batch_size, trg_len - 1, device=self.device, dtype=torch.float
-                )
+    def _speculate(self, engine, draft_engine, trg, finished, max_length):
+        """
+        One round of speculative decoding, following the tokens so far, `trg`.
+
+        The draft engine (the speed model) greedily proposes up to `DRAFT_TOKENS`
+        tokens, which `engine` (the accuracy model) then decodes in a single
+        teacher-forced pass.  Up to the first draft that it disagrees with, its
+        predictions are those of greedy decoding, as is its prediction in place of
+        that draft.  The working batch advances together, by the fewest such tokens of
+        the sequences not yet `finished`, and the caches of both engines are truncated
+        to the accepted tokens.
+
+        Returns the logits of the accepted tokens, of shape
+        [batch size, n accepted, vocab].
+        """
+        t = trg.shape[1]
+        n_draft = min(DRAFT_TOKENS, max_length - t)
 
-                for t in range(1, trg_len):
-                    trg_pad_mask, trg_causal_mask = self.model.make_trg_mask(mask_input)
+        # The first step also decodes the tokens accepted in the last round.
+        drafted = trg
+        for _ in range(n_draft):
+            draft_token = draft_engine.step(drafted)[:, -1:].argmax(2)
+            drafted = torch.cat([drafted, draft_token], dim=1)
 
-                    output, cache = self.model.decoder(
-                        input, enc_src, trg_pad_mask, trg_causal_mask, src_mask, cache
-                    )
+        output = engine.step(drafted)
+        # output = [batch size, n draft + 1, vocab], predicting positions t to t + n draft
 
-                    pred_token = output.argmax(2)[:, -1].unsqueeze(1)
+        mismatch = output[:, :-1].argmax(2) != drafted[:, t:]
+        n_matching = torch.where(
+            mismatch.any(1), mismatch.to(torch.int64).argmax(1), n_draft
+        )
+        # The drafts accepted by every sequence, and the following prediction.
+        n_matching = int(n_matching[~finished].min())
+        n_accepted = min(n_matching + 1, max_length - t)
 
-                    scores[:, t - 1 : t] = output.topk(1, dim=2).values.squeeze(1)
+        self.n_drafted += n_draft
+        self.n_accepted += min(n_matching, n_accepted)
 
-                    max_input[:, t : t + 1] = pred_token
+        # The last accepted token is decoded in the next round.
+        engine.truncate(t + n_accepted - 1)
+        draft_engine.truncate(t + n_accepted - 1)
 
-                    mask_input = max_input[:, : t + 1]
+        return output[:, :n_accepted]
 
-                    input = pred_token
+    def _verify_drafts(self, src, drafts):
+        """
+        Check the drafted tokens of a batch, of shape [batch size, src len + 1], in one
+        teacher-forced pass of the decoder of the runner's engine.
 
-                ### 2 tokenise and transfer the batch to cpu
+        Returns the logits predicting each position after <SOS>, of shape
+        [batch size, src len, vocab], and, for each sequence, the number of these that
+        are those of greedy decoding: up to and including the first position where the
+        prediction differs from the draft.
+        """
+        self.engine.encode(src, drafts.shape[1])
+        output = self.engine.step(drafts[:, :-1])
 
-                src_tokens = self.sequence_tokeniser.tokens[src.to("cpu")]
-                pred_tokens = self.number_tokeniser.tokens[max_input.to("cpu")]
+        mismatch = output.argmax(2) != drafts[:, 1:]
+        n_verified = torch.where(
+            mismatch.any(1), mismatch.to(torch.int64).argmax(1) + 1, mismatch.shape[1]
+        )
+        return output, n_verified
 
-                ### 3 work out IMGT integer values predicted by model
+    def _decode_with_drafts(self, src):
+        """
+        Decode a batch, as `_decode_batch`, starting from the numbering drafted by
+        `self.drafts` where there is one.
 
-                scores = scores.squeeze(
-                    -1
-                )  # Remove the last dim; shape becomes [batch_size, trg_len]
+        The drafted sequences are checked in one teacher-forced pass.  Those whose
+        draft holds up to where the sequence is complete need no more decoding.  The
+        others are decoded greedily from the first position where any of them differs
+        from its draft, reusing the cache of the pass up to there.
+        """
+        batch_size = src.shape[0]
+        trg_len = src.shape[1] + 1
 
-                mask = (
-                    (max_input != skip_token)
-                    & (max_input != x_token)
-                    & (max_input != pad_token)
-                    & (max_input != sos_token)
-                )
+        drafts, found = self.drafts.lookup(src, self.pad_token.item())
+        if not found.any():
+            return self._decode_batch(src)
 
-                ### 4 Find the predicted end of sequence by model,
-                # find actual end of input
+        max_input = torch.zeros(
+            batch_size, trg_len, device=self.device, dtype=torch.long
+        )
+        scores = torch.zeros(
+            batch_size, trg_len - 1, device=self.device, dtype=torch.float
+        )
 
-                # Find first `True` (eos_token) along last dim (trg_len)
-                eos_positions = max_input == eos_token
-                # Get the indices (trg_len), for each batch
-                first_eos_positions = torch.argmax(eos_positions.to(torch.int64), dim=1)
+        undrafted = torch.from_numpy(np.flatnonzero(~found)).to(self.device)
+        if len(undrafted):
+            max_input[undrafted], scores[undrafted] = self._decode_batch(src[undrafted])
 
-                # Same logic to find SRC EOS position
-                src_eos_matrix = src == eos_token
-                src_eos_positions = torch.argmax(src_eos_matrix.to(torch.int64), dim=1)
+        drafted = torch.from_numpy(np.flatnonzero(found)).to(self.device)
+        src = src[drafted]
+        logits, n_verified = self._verify_drafts(src, drafts[drafted])
 
-                # Check if no EOS token is found for each batch
-                no_eos_found = ~(eos_positions.any(dim=1))
-                # True if no EOS token is found in the row
-                # Set the position to trg_len if no EOS is found
+        # A sequence is complete at the first predicted <EOS>, or the position after
+        # the input <EOS>.
+        predicted = logits.argmax(2)
+        is_eos = predicted == self.eos_token
+        completed_at = torch.where(
+            is_eos.any(1), is_eos.to(torch.int64).argmax(1) + 1, trg_len
+        )
+        src_eos_positions = torch.argmax((src == self.eos_token).to(torch.int64), dim=1)
+        completed_at = torch.minimum(completed_at, src_eos_positions + 1)
+        verified = completed_at <= n_verified
+        self.n_drafts_accepted += int(verified.sum())
+
+        # Complete sequences are read from the verifying pass alone.
+        rows = torch.nonzero(verified).squeeze(1)
+        if len(rows):
+            max_input[drafted[rows]], scores[drafted[rows]] = self._decode_batch(
+                src[rows], self.engine, verified_logits=logits[rows]
+            )
+
+        # The others continue from the first position where any differs.
+        rows = torch.nonzero(~verified).squeeze(1)
+        if len(rows):
+            n = int(n_verified[rows].min())
+            self.engine.select(rows)
+            self.engine.truncate(n)
+            max_input[drafted[rows]], scores[drafted[rows]] = self._decode_batch(
+                src[rows], self.engine, verified_logits=logits[rows, :n]
+            )
+
+        return max_input, scores
 
-                first_eos_positions[no_eos_found] = torch.tensor(
-                    trg_len - 1, device=self.device
-                )
+    def _predict_numbering(self, dl):
+        """
+        1 Runs the autoregressive inference loop which takes batches of sequences and
+        predicts for the whole batch
 
-                ### 5   Iterate through each seq in batch
+        2 Translates the predicted tokens of each batch to IMGT numbering, see
+        `_format_batch`.
 
-                for batch_no in range(batch_size):
-                    error_occurred = False
-                    num += 1
-                    error_msg = None
+        Return the list of numbering results, one per sequence, in batch order.
+        """
+        if self.verbose:
+            print(f"Making predictions on {len(dl)} batches.")
 
-                    # eos_position = first_eos_positions[batch_no]
+        numbering = []
 
-                    # Code fix here. Ensure that if model has numbered beyond SRC EOS
-                    # Then stop.
-                    eos_position = min(
-                        first_eos_positions[batch_no], src_eos_positions[batch_no] + 1
+        with torch.no_grad():
+            for X in dl:
+                src = X.to(self.device)
+                if self.compile:
+                    # Limit the input shapes that the compiled model sees.
+                    src = pad_to_length_bucket(
+                        src, COMPILE_BUCKET_WIDTH, seq_max_len - 1
                     )
 
-                    valid_indices = torch.arange(eos_position, device=self.device)[
-                        mask[batch_no, :eos_position]
+                ### 1 RUN AUTOREGRESSIVE INFERENCE LOOP OVER THE BATCH
+                if self.drafts is not None:
+                    max_input, scores = self._decode_with_drafts(src)
+                else:
+                    max_input, scores = self._decode_batch(src)
+
+                ### 2 TRANSLATE THE PREDICTED TOKENS TO NUMBERING
+                batch_numbering = self._format_batch(src, max_input, scores)
+
+                if self.drafts is not None:
+                    # Keep the successful numbering to draft that of later sequences.
+                    numbered = [
+                        i
+                        for i, result in enumerate(batch_numbering)
+                        if result["error"] is None
                     ]
-                    valid_scores = scores[batch_no, valid_indices]
+                    self.drafts.add(src[numbered], max_input[numbered])
+
+                if self.fp32_engine is not None:
+                    self._rerun_near_cutoff(src, batch_numbering)
+
+                if self.mode == "cascade":
+                    self._cascade(src, batch_numbering)
+
+                numbering.extend(batch_numbering)
+
+        if self.verbose and self.fp32_engine is not None:
+            print(f"Re-ran {self.n_fp32_reruns} sequences near the cutoff in fp32.")
+        if self.verbose and self.cascade_engine is not None:
+            print(
+                f"Numbered {self.n_cascaded} sequences again with the accuracy model."
+            )
+        if self.verbose and self.score_gate is not None:
+            print(f"Gated {self.n_gated} sequences after the first decoding step.")
+        if self.verbose and self.drafts is not None:
+            print(f"Numbered {self.n_drafts_accepted} sequences as drafted.")
+        if self.verbose and self.draft_engine is not None:
+            print(
+                f"Accepted {self.n_accepted} of {self.n_drafted} tokens drafted by the "
+                "speed model."
+            )
 
-                    ### 5A   Check score is valid
+        return numbering
 
-                    if len(valid_indices) >= 50:
-                        normalized_score = valid_scores.mean().item()
-                    else:
-                        normalized_score = 0.0
-                        error_msg = "Less than 50 non insertion residues numbered."
-
-                    if normalized_score < CUTOFF_SCORE:
-                        numbering.append(
-                            {
-                                "numbering": None,
-                                "chain_type": "F",
-                                "score": normalized_score,
-                                "query_start": None,
-                                "query_end": None,
-                                "error": error_msg or "Score less than cut off.",
-                                "scheme": "imgt",
-                            }
-                        )
-                        # skip the rest of the loop.
-                        continue
-
-                    ### 5B   Begin populating the numbering labels but iterating over
-                    # each seq
-
-                    residues, nums = [], []
-                    backfill_residues = []
-
-                    started = False
-                    in_x_run, x_count = False, 0
-                    start_index = None
-                    end_index = None
-
-                    # SRC is missing chain token + 1
-                    src_eos_position = src_eos_positions[batch_no].item() + 1
-                    eos_position = eos_position.item()
-
-                    for seq_position in range(2, eos_position):
-                        ###      Break at actual EOS  in the input sequence
-                        if src_tokens[batch_no, seq_position - 1] == "<EOS>":
-                            # The end index position in the sequence
-                            # -3 is to accomodate the shifted register due to -
-                            #  the <SOS>, chain token and python zero
-                            end_index = seq_position - 3
-                            break
-
-                        ###      Break at SKIP tokens if numbering has started
-                        elif (
-                            pred_tokens[batch_no, seq_position] == "<SKIP>" and started
-                        ):  # Break if hitting a skip post at the end.
-                            end_index = seq_position - 3
-                            break
-
-                        ###      Work out when numbering begins, ignore SKIP tokens if
-                        ###      not started
-                        elif (
-                            pred_tokens[batch_no, seq_position] == "<SKIP>"
-                            and not started
-                        ):  # Append as backfill up to the start.
-                            backfill_residues.append(
-                                src_tokens[batch_no, seq_position - 1]
-                            )
-                            continue
-
-                        ###      If an instertion X is called, log as  in a run of X
-                        elif pred_tokens[batch_no, seq_position] == "X":
-                            x_count += 1
-                            in_x_run = True
-
-                        ###      If breaking out of a X run, construct the labels
-                        elif (
-                            isinstance(pred_tokens[batch_no, seq_position], int)
-                            and in_x_run
-                        ):
-                            # This code breaks if we have a junk seq that
-                            # has predicted runs of X (insertions)
-                            # that are not bookended with integers
-                            try:
-                                construction = build_inward_list(
-                                    length=x_count,
-                                    # number before X began
-                                    start_num=int(
-                                        pred_tokens[
-                                            batch_no, (seq_position - (x_count + 1))
-                                        ]
-                                    ),
-                                    # current number
-                                    end_num=int(pred_tokens[batch_no, seq_position]),
-                                )
-
-                                # Add the construction over the previous sequence
-                                nums[(seq_position - x_count) : seq_position] = (
-                                    construction
-                                )
-                                # add the end
-                                nums.append(
-                                    (int(pred_tokens[batch_no, seq_position]), " ")
-                                )
-                                in_x_run = False
-                                x_count = 0
-
-                            except ValueError as e:
-                                # Capture the error message from the exception
-                                captured_error = str(e)
-                                numbering.append(
-                                    {
-                                        "numbering": None,
-                                        "chain_type": "F",
-                                        "score": normalized_score,
-                                        "query_start": None,
-                                        "query_end": None,
-                                        "error": "Could not apply numbering: "
-                                        f"{captured_error}",
-                                        "scheme": "imgt",
-                                    }
-                                )
-                                error_occurred = True
-                                break
-
-                        ###      No conditions have been found - it is a number label,
-                        # append to nums
-                        else:
-                            try:
-                                nums.append(
-                                    (int(pred_tokens[batch_no, seq_position]), " ")
-                                )
-                            except ValueError as e:
-                                # Capture the error message from the exception
-                                captured_error = str(e)
-                                numbering.append(
-                                    {
-                                        "numbering": None,
-                                        "chain_type": "F",
-                                        "score": normalized_score,
-                                        "query_start": None,
-                                        "query_end": None,
-                                        "error": "Could not apply numbering: "
-                                        f"{captured_error}",
-                                        "scheme": "imgt",
-                                    }
-                                )
-                                error_occurred = True
-                                break
-
-                        ###      After each iteration through the sequence append the
-                        # sequence residue
-                        residues.append(src_tokens[batch_no, seq_position - 1])
-
-                        if not started:
-                            start_index = seq_position - 2
-                        started = True
-
-                    if error_occurred:
-                        continue
-
-                    # Assign an end index before entering forwardfill
-                    if not end_index:
-                        end_index = eos_position - 3
-                        # eos_position - 1: Moves to the token before <EOS>,
-                        # excluding the <EOS> marker itself.
-                        # Subtracting an additional 1 for SOS and 1 for CLS:
-                        # Adjusts further to skip over these two tokens.
-
-                    ## Check for duplicates
-                    if len(nums) != len(set(nums)):
-                        numbering.append(
-                            {
-                                "numbering": None,
-                                "chain_type": "F",
-                                "score": normalized_score,
-                                "query_start": None,
-                                "query_end": None,
-                                "error": "Model predicted duplicate numbers",
-                                "scheme": "imgt",
-                            }
-                        )
-                        # break out of the loop
-                        continue
+    def _rerun_near_cutoff(self, src, batch_numbering):
+        """
+        Number again in fp32 the sequences of a batch whose score, from reduced
+        precision, is within `FP32_RERUN_MARGIN` of `CUTOFF_SCORE`.  Whether these
+        sequences pass the cutoff is then the same as in fp32.  Results are replaced in
+        `batch_numbering`, in place.
+        """
+        rerun = [
+            i
+            for i, result in enumerate(batch_numbering)
+            if abs(result["score"] - CUTOFF_SCORE) < FP32_RERUN_MARGIN
+        ]
+        if not rerun:
+            return
+
+        rerun_src = src[rerun]
+        max_input, scores = self._decode_batch(rerun_src, self.fp32_engine)
+        rerun_numbering = self._format_batch(rerun_src, max_input, scores)
+
+        for i, result in zip(rerun, rerun_numbering, strict=True):
+            batch_numbering[i] = result
+        self.n_fp32_reruns += len(rerun)
+
+    def _cascade(self, src, batch_numbering):
+        """
+        Number again with the accuracy model the sequences of a batch that the speed
+        model failed to number (except those rejected by the score gate), or scored
+        less than `cascade_margin` above `CUTOFF_SCORE`.  Results are replaced in
+        `batch_numbering`, in place, and labelled with the model that numbered them.
+        """
+        # There is only one shark model.
+        model = "accuracy" if self.cascade_engine is None else "speed"
+        for result in batch_numbering:
+            result["model"] = model
+
+        if self.cascade_engine is None:
+            return
+
+        rerun = [
+            i
+            for i, result in enumerate(batch_numbering)
+            if (result["error"] is not None and result["error"] != GATED_ERROR)
+            or result["score"] < CUTOFF_SCORE + self.cascade_margin
+        ]
+        if not rerun:
+            return
+
+        rerun_src = src[rerun]
+        max_input, scores = self._decode_batch(rerun_src, self.cascade_engine)
+        rerun_numbering = self._format_batch(rerun_src, max_input, scores)
+
+        for i, result in zip(rerun, rerun_numbering, strict=True):
+            result["model"] = "accuracy"
+            batch_numbering[i] = result
+        self.n_cascaded += len(rerun)
+
+    def _format_batch(self, src, max_input, scores):
+        """
+        Translate the predicted tokens of a batch to IMGT numbering.
 
-                    ### 5C   Perform forward fill to end of the sequence, if
-                    # missed numbering
+        The predictions are processed as integer token IDs with NumPy, on the whole
+        batch at once where possible:
 
-                    ##  ANARCII sometimes doesn't continue numbering to end of seq
-                    # Solution: Identify residues remaining after the EOS
-                    # Decide forward fill to 127 (KL) /128 (H) needs to occur.
+        3 Work out the valid indices - IMGT integer numbers predicted by the model
 
-                    # The last number depends on chain type - check type here.
-                    if pred_tokens[batch_no, 1] in ["H", "A", "G"]:
-                        last_num = 128
-                    else:
-                        last_num = 127
+        4 Find the EOS predicted by the model and the EOS of the input sequence
 
-                    try:
-                        last_predicted_num = int(
-                            pred_tokens[batch_no, eos_position - 1]
-                        )
-                    except ValueError:
-                        last_predicted_num = last_num
-
-                    ### DEBUG ONLY ###
-                    # if src_tokens[batch_no, eos_position - 1] == "<PAD>":
-                    #     print(src_tokens[batch_no, :])
-                    #     print(pred_tokens[batch_no, :])
-
-                    # print(src_tokens[batch_no, eos_position - 1])
-                    # print(last_num, last_predicted_num)
-                    # print(last_predicted_num != last_num)
-
-                    if (
-                        src_tokens[batch_no, eos_position - 1] not in ["<EOS>", "<PAD>"]
-                        and last_predicted_num != last_num
-                        and last_predicted_num > 119
-                    ):
-                        # How far is EOS from 128?
-                        missing_count = last_num - int(
-                            pred_tokens[batch_no, eos_position - 1]
-                        )
+        5 For every sequence in the batch
+            5A - check score is valid
+            5B - find where numbering starts and ends (the first non-<SKIP> token
+                 and the next <SKIP> or EOS).  Label runs of insertions [X] from the
+                 tabulated `build_inward_list` and check for errors.
+            5C - forward fill to end of the sequence for missed numbering
+            5D - back fill for the start if the seq
+            5E - Fill in up to 1 (starting IMGT residue) with gaps
+            5F - Add gaps to nums where we are missing a number in the middle (27, 29)
+
+        6 Populate the meta data dict
+
+        Return a list of result dicts, one per sequence in the batch.
+        """
+        aa = self.sequence_tokeniser
+        nt = self.number_tokeniser
+
+        src_ids = src.cpu().numpy()
+        pred_ids = max_input.cpu().numpy()
+        batch_size, trg_len = pred_ids.shape
+        positions = np.arange(trg_len)
+
+        # IMGT numbers 1-128 are consecutive in the vocabulary.
+        first_number_id = nt.char_to_int[1]
+        is_num = (pred_ids >= first_number_id) & (pred_ids <= nt.char_to_int[128])
+        numbers = pred_ids - first_number_id + 1
+        is_skip = pred_ids == nt.char_to_int[nt.skip]
+        is_x = pred_ids == nt.char_to_int["X"]
+
+        # The residue numbered by the token at each position; the predictions are one
+        # place ahead of the input sequence, because of the chain token.
+        residue_ids = np.zeros_like(src_ids, shape=pred_ids.shape)
+        residue_ids[:, 1:] = src_ids
+
+        ### 4 Find the predicted end of sequence by model, find actual end of input
+
+        is_eos = pred_ids == nt.char_to_int[nt.end]
+        # Set the position to trg_len - 1 if no EOS is found
+        first_eos_positions = np.where(is_eos.any(1), is_eos.argmax(1), trg_len - 1)
+        src_eos_positions = (src_ids == aa.char_to_int[aa.end]).argmax(1)
+        # Ensure that if model has numbered beyond SRC EOS, then stop.
+        eos_positions = np.minimum(first_eos_positions, src_eos_positions + 1)
+        before_eos = positions < eos_positions[:, None]
+
+        ### 3 Work out IMGT integer values predicted by model
+
+        not_numbers = [nt.char_to_int[c] for c in (nt.skip, "X", nt.pad, nt.start)]
+        valid = before_eos & ~np.isin(pred_ids, not_numbers)
+        n_valid = valid.sum(1)
+        valid_scores = torch.from_numpy(valid[:, :-1])
+        scores = scores.cpu()
+
+        # Sequences that stopped decoding at the chain token, see `score_gate`.
+        if self.score_gate is not None:
+            gated = (scores[:, 0] < self._gate_cutoff).numpy()
+        else:
+            gated = np.zeros(batch_size, dtype=bool)
+
+        ### 5B Find the numbered region of each sequence
+
+        # Numbering begins at the first token after the chain token that is not
+        # <SKIP>.  The preceding residues are kept for backfill.
+        in_loop = before_eos & (positions >= 2)
+        numbered = in_loop & ~is_skip
+        start_positions = np.where(numbered.any(1), numbered.argmax(1), eos_positions)
+        # Break at SKIP tokens if numbering has started, otherwise at the EOS.
+        trailing = in_loop & is_skip & (positions > start_positions[:, None])
+        end_positions = np.where(trailing.any(1), trailing.argmax(1), eos_positions)
+        # The end index position in the sequence.  -3 is to accomodate the shifted
+        # register due to the <SOS>, chain token and python zero.  (An end index of
+        # zero is replaced with that of the EOS.)
+        end_indices = np.where(end_positions == 3, eos_positions, end_positions) - 3
+        in_region = (positions >= start_positions[:, None]) & (
+            positions < end_positions[:, None]
+        )
+
+        # Runs of insertions (X) in the numbered region.  For each position, find the
+        # last position before it and the first position after it that is not an X.
+        in_x_run = in_region & is_x
+        last_non_x = np.maximum.accumulate(np.where(in_x_run, 0, positions), axis=1)
+        next_non_x = np.minimum.accumulate(
+            np.where(in_x_run, trg_len, positions)[:, ::-1], axis=1
+        )[:, ::-1]
+        # An X run that is not closed by a number before the end of the region is left
+        # without numbers.
+        closed = in_x_run & (next_non_x < end_positions[:, None])
+
+        # The number before and after each X run, read at the closing position.
+        run_before = np.zeros_like(last_non_x)
+        run_before[:, 1:] = last_non_x[:, :-1]
+        closes_run = np.zeros_like(in_x_run)
+        closes_run[:, 1:] = in_region[:, 1:] & is_num[:, 1:] & in_x_run[:, :-1]
+        before_is_num = np.take_along_axis(is_num, run_before, 1)
+        before_num = np.take_along_axis(numbers, run_before, 1)
+
+        # Errors: tokens in the numbered region that are not numbers or insertions,
+        # X runs that do not follow a number and forbidden CDR insertions.
+        run_errors = closes_run & (
+            ~before_is_num | np.isin(before_num, forbidden_cdr_insertions)
+        )
+        errors = (in_region & ~is_x & ~is_num) | run_errors
+
+        # Label the insertions from the tabulated `build_inward_list`.
+        run_start = np.where(closed, last_non_x, 0)
+        run_end = np.where(closed, next_non_x, 0)
+        start_num = np.take_along_axis(numbers, run_start, 1)
+        end_num = np.take_along_axis(numbers, run_end, 1)
+        in_cdr = np.isin(start_num, cdr_instertion_starts).astype(np.int64)
+        run_length = np.where(closed, run_end - run_start - 1, 0)
+        run_offset = np.where(closed, positions - run_start - 1, 0)
+
+        letters, uses_end = inward_label_tables(seq_max_len)
+        insertion_letters = letters[in_cdr, run_length, run_offset]
+        insertion_nums = np.where(
+            uses_end[in_cdr, run_length, run_offset], end_num, start_num
+        )
+
+        # Labels: the IMGT number and an index into `alphabet` offset by 1, with 0 for
+        # no insertion letter.
+        label_nums = np.where(closed, insertion_nums, numbers)
+        label_letters = np.where(closed, insertion_letters + 1, 0)
+        labelled = in_region & (is_num | closed)
+
+        ### 5C Perform forward fill to end of the sequence, if missed numbering
 
-                        # How much is left of the source to number?
-                        seq_remainder = int(src_eos_position) - int(eos_position)
-
-                        missing_end_nums = [
-                            (x, " ")
-                            for x in range(last_predicted_num + 1, last_num + 1)
-                        ]
-
-                        missing_end_nums = missing_end_nums[:seq_remainder]
-
-                        # # DEBUG PURPOSE ONLY
-                        # print("\n")
-                        # for i in range(
-                        #     eos_position-3,
-                        #     eos_position + min(missing_count, seq_remainder)):
-                        #     print(
-                        #         "\t", src_tokens[batch_no, i + 0],
-                        #         "\t", pred_tokens[batch_no, i + 1],
-                        #     )
-
-                        missing_end_residues = []
-                        for i in range(
-                            eos_position,
-                            eos_position + min(missing_count, seq_remainder),
-                        ):
-                            missing_end_residues.append(src_tokens[batch_no, i - 1])
-
-                        # print("Last:\t", last_num)
-                        # print("Last pred num:\t", last_predicted_num)
-                        # print("Missing count:\t", missing_count)
-
-                        # print("Missing num:\t", missing_end_nums)
-                        # print("Missing res:\t", missing_end_residues)
-
-                        # # Append the misssing labels to seq and nums:
-                        nums = nums + missing_end_nums
-                        residues = residues + missing_end_residues
-
-                        end_index = end_index + len(missing_end_nums)
-
-                    ### 5D   Perform backfill for missed start of sequence, if missed
-                    # numbering
-
-                    # This step ensures that first and last nums will always be
-                    # integers - does not proceed if not.
-                    try:
-                        first_num = int(nums[0][0])  # get first number
-                        last_num = int(nums[-1][0])  # get last number
-                    except (IndexError, ValueError) as e:
-                        # When numbering has failed, `nums` is an empty list.
-                        # For some non-antibody/TCR sequences that the model does not
-                        # recognise, the first number can be a string, like an EOS or
-                        # an X token. End the loop here and move on to the next seq
-                        # in the batch.
-                        captured_error = str(e)
-                        numbering.append(
-                            {
-                                "numbering": None,
-                                "chain_type": "F",
-                                "score": normalized_score,
-                                "query_start": None,
-                                "query_end": None,
-                                "error": f"Could not apply numbering: {captured_error}",
-                                "scheme": "imgt",
-                            }
+        ##  ANARCII sometimes doesn't continue numbering to end of seq
+        # Solution: Identify residues remaining after the EOS
+        # Decide forward fill to 127 (KL) /128 (H) needs to occur.
+
+        # The last number depends on chain type - check type here.
+        chain_ids = pred_ids[:, 1]
+        last_nums = np.where(
+            np.isin(chain_ids, [nt.char_to_int.get(c, -1) for c in "HAG"]), 128, 127
+        )
+        last_index = eos_positions[:, None] - 1
+        last_is_num = np.take_along_axis(is_num, last_index, 1)[:, 0]
+        last_predicted_nums = np.where(
+            last_is_num, np.take_along_axis(numbers, last_index, 1)[:, 0], last_nums
+        )
+        last_residues = np.take_along_axis(residue_ids, eos_positions[:, None], 1)
+        forward_fill = (
+            ~np.isin(
+                last_residues[:, 0], [aa.char_to_int[aa.end], aa.char_to_int[aa.pad]]
+            )
+            & (last_predicted_nums != last_nums)
+            & (last_predicted_nums > 119)
+        )
+        # How far is EOS from 128?  How much is left of the source to number?
+        n_forward_fill = np.where(
+            forward_fill,
+            np.clip(
+                np.minimum(
+                    last_nums - last_predicted_nums,
+                    src_eos_positions + 1 - eos_positions,
+                ),
+                0,
+                None,
+            ),
+            0,
+        )
+
+        ### 5 Assemble the numbering of each seq in the batch
+
+        # Residue tokens, with an extra token for gaps.
+        residue_tokens = np.append(aa.tokens, "-")
+        gap_id = len(aa.tokens)
+        insertion_tokens = np.array([" ", *alphabet], dtype=object)
+
+        numbering = []
+        for batch_no in range(batch_size):
+            error_msg = None
+
+            ### 5A   Check score is valid
+
+            if gated[batch_no]:
+                self.n_gated += 1
+                numbering.append(
+                    failed_numbering(scores[batch_no, 0].item(), GATED_ERROR)
+                )
+                continue
+
+            if n_valid[batch_no] >= 50:
+                normalized_score = (
+                    scores[batch_no][valid_scores[batch_no]].mean().item()
+                )
+            else:
+                normalized_score = 0.0
+                error_msg = "Less than 50 non insertion residues numbered."
+
+            if normalized_score < CUTOFF_SCORE:
+                numbering.append(
+                    failed_numbering(
+                        normalized_score, error_msg or "Score less than cut off."
+                    )
+                )
+                continue
+
+            if errors[batch_no].any():
+                error_position = errors[batch_no].argmax()
+                pred = nt.tokens[pred_ids[batch_no]]
+                # Reproduce the error raised when converting the tokens to numbers.
+                try:
+                    if run_errors[batch_no, error_position]:
+                        before = run_before[batch_no, error_position]
+                        build_inward_list(
+                            length=error_position - before - 1,
+                            start_num=int(pred[before]),
+                            end_num=int(pred[error_position]),
                         )
-                        continue
-
-                    # Should not do this before 10 in case of failure to
-                    # identify the gap.
-                    if first_num > 1 and first_num < 9 and len(backfill_residues) > 0:
-                        # This creates a list from 1 to first_num - 1
-                        vals = list(range(1, first_num))
-                        # the problem here is if there is a lot of junk...
-                        vals = vals[-len(backfill_residues) :]
-                        nums = [(i, " ") for i in vals] + nums
-                        residues = list(backfill_residues[-len(vals) :]) + residues
-
-                        # Adjust the start index for the backfill
-                        start_index = start_index - len(vals)
-
-                    ### 5E Fill in up to 1 (starting IMGT residue) with gaps
-                    first_num = int(nums[0][0])  # get first number again - may change
-                    for missing_num in range(
-                        first_num - 1, 0, -1
-                    ):  # Start from first_num - 1, stop at 1, step by -1
-                        nums.insert(0, (missing_num, " "))
-                        residues.insert(0, "-")
-
-                    ### 5F Add gaps to nums where we are missing a number:
-                    # e.g. predicted labels are 91 L, 93 K. convert to >>
-                    # 91 L, 92 -, 93 K
-                    i = 1
-                    while i < len(nums):
-                        if (int(nums[i][0]) - 1) > int(nums[i - 1][0]):
-                            nums.insert(i, (int(nums[i - 1][0]) + 1, " "))
-                            residues.insert(i, "-")
-                        else:
-                            i += 1  # Only increment if no insertion is made
-
-                    # Ensure the last number is 128 >>>>>
-                    last_num = int(nums[-1][0])
-                    for missing_num in range(last_num + 1, 129):
-                        nums.append((missing_num, " "))
-                        residues.append("-")
-
-                    ### 6 Populate the meta data dict and append to alignment list
-
-                    # Successful - append.
-                    numbering.append(
-                        {
-                            "numbering": list(zip(nums, residues, strict=False)),
-                            "chain_type": str(pred_tokens[batch_no, 1]),
-                            "score": normalized_score,
-                            "query_start": start_index,
-                            "query_end": end_index,
-                            "error": None,
-                            "scheme": "imgt",
-                        }
+                    else:
+                        int(pred[error_position])
+                except ValueError as e:
+                    error_msg = f"Could not apply numbering: {e}"
+
+                numbering.append(failed_numbering(normalized_score, error_msg))
+                continue
+
+            region = slice(start_positions[batch_no], end_positions[batch_no])
+            keep = labelled[batch_no, region]
+            nums = label_nums[batch_no, region][keep]
+            nums_letters = label_letters[batch_no, region][keep]
+            # Residues of an unclosed X run remain at the end, without numbers.
+            residues = residue_ids[batch_no, region]
+
+            ## Check for duplicates
+            if np.unique(nums * len(insertion_tokens) + nums_letters).size < nums.size:
+                numbering.append(
+                    failed_numbering(
+                        normalized_score, "Model predicted duplicate numbers"
+                    )
+                )
+                continue
+
+            ### 5C   Append the missing labels to seq and nums
+
+            n_fill = n_forward_fill[batch_no]
+            eos_position = eos_positions[batch_no]
+            fill_start = last_predicted_nums[batch_no] + 1
+            nums = np.concatenate([nums, np.arange(fill_start, fill_start + n_fill)])
+            nums_letters = np.concatenate([nums_letters, np.zeros(n_fill, np.int64)])
+            residues = np.concatenate(
+                [residues, residue_ids[batch_no, eos_position : eos_position + n_fill]]
+            )
+            end_index = end_indices[batch_no] + n_fill
+            start_index = start_positions[batch_no] - 2
+
+            ### 5D   Perform backfill for missed start of sequence, if missed
+            # numbering
+
+            # When numbering has failed, `nums` is empty.
+            if not nums.size:
+                numbering.append(
+                    failed_numbering(
+                        normalized_score,
+                        "Could not apply numbering: list index out of range",
                     )
+                )
+                continue
+
+            # Should not do this before 10 in case of failure to identify the gap.
+            backfill_residues = residue_ids[batch_no, 2 : start_positions[batch_no]]
+            first_num = nums[0]
+            if 1 < first_num < 9 and backfill_residues.size:
+                # Number back from first_num - 1, as far as there are residues.
+                n_backfill = min(first_num - 1, backfill_residues.size)
+                nums = np.concatenate(
+                    [np.arange(first_num - n_backfill, first_num), nums]
+                )
+                nums_letters = np.concatenate(
+                    [np.zeros(n_backfill, np.int64), nums_letters]
+                )
+                residues = np.concatenate([backfill_residues[-n_backfill:], residues])
+
+                # Adjust the start index for the backfill
+                start_index = start_index - n_backfill
+
+            ### 5E/5F Fill in up to 1 (starting IMGT residue) with gaps and add
+            # gaps to nums where we are missing a number: e.g. predicted labels are
+            # 91 L, 93 K. convert to >> 91 L, 92 -, 93 K
+
+            # Residues of an unclosed X run follow the numbered residues.
+            unnumbered_residues = residues[nums.size :]
+
+            # Numbers missing before each label, counting from 0 for the first.
+            gaps = np.maximum(np.diff(nums, prepend=0) - 1, 0)
+            block_ends = np.cumsum(gaps + 1) - 1
+            n_labels = block_ends[-1] + 1
+            filled_nums = (
+                np.repeat(nums - gaps, gaps + 1)
+                + np.arange(n_labels)
+                - np.repeat(block_ends - gaps, gaps + 1)
+            )
+            filled_letters = np.zeros(n_labels, np.int64)
+            filled_letters[block_ends] = nums_letters
+            filled_residues = np.full(n_labels, gap_id)
+            filled_residues[block_ends] = residues[: nums.size]
+
+            # Ensure the last number is 128 >>>>>
+            n_end = 128 - filled_nums[-1]
+            nums = np.concatenate([filled_nums, np.arange(129 - n_end, 129)])
+            nums_letters = np.concatenate([filled_letters, np.zeros(n_end, np.int64)])
+            # Unnumbered residues are paired with the last numbers, displacing gaps.
+            residues = np.concatenate(
+                [filled_residues, unnumbered_residues, np.full(n_end, gap_id)]
+            )[: nums.size]
+
+            ### 6 Populate the meta data dict and append to alignment list
+
+            labels = zip(
+                nums.tolist(), insertion_tokens[nums_letters].tolist(), strict=True
+            )
+
+            # Successful - append.
+            numbering.append(
+                {
+                    "numbering": list(
+                        zip(labels, residue_tokens[residues].tolist(), strict=True)
+                    ),
+                    "chain_type": str(nt.tokens[chain_ids[batch_no]]),
+                    "score": normalized_score,
+                    "query_start": int(start_index),
+                    "query_end": int(end_index),
+                    "error": None,
+                    "scheme": "imgt",
+                }
+            )
+
+        return numbering
+
 
-            return numbering
+def failed_numbering(score, error):
+    """The result for a sequence that could not be numbered."""
+    return {
+        "numbering": None,
+        "chain_type": "F",
+        "score": score,
+        "query_start": None,
+        "query_end": None,
+        "error": error,
+        "scheme": "imgt",
+    }
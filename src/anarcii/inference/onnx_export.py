@@ -0,0 +1,232 @@
+"""
+Export the numbering models to ONNX, for `ModelRunner(backend="onnxruntime")`.
+
+    python -m anarcii.inference.onnx_export OUTPUT_DIR
+
+For each sequence type and mode, two graphs are written:
+
+* <type>_<mode>_encoder.onnx - from the tokenised sequences `src`, computes the
+  encoder-decoder attention keys and values of every decoder layer.
+
+* <type>_<mode>_decoder.onnx - a single incremental decoding step.  Takes the last
+  predicted token, its position, the padding masks, the encoder keys/values and the
+  self-attention keys/values of the previous tokens (the cache).  Returns the logits
+  of the next token and the self-attention keys/values including the new token.
+"""
+
+import argparse
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .model_loader import Loader
+
+# The ONNX opset to export to.
+OPSET_VERSION = 17
+
+
+def onnx_model_paths(onnx_dir, sequence_type, mode):
+    """The paths of the encoder and decoder graphs of a model."""
+    stem = Path(onnx_dir) / f"{sequence_type}_{mode}"
+    return (
+        stem.with_name(f"{stem.name}_encoder.onnx"),
+        stem.with_name(f"{stem.name}_decoder.onnx"),
+    )
+
+
+class EncoderExport(nn.Module):
+    """The encoder, with the encoder-decoder attention projections of the decoder."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src):
+        # src = [batch size, src len]
+        src_mask = self.model.make_src_mask(src)
+        enc_src = self.model.encoder(src, src_mask)
+
+        keys, values = zip(*self.model.decoder.project_encoder(enc_src), strict=True)
+        # keys = values = [n layers, batch size, n heads, src len, head dim]
+        return torch.stack(keys), torch.stack(values)
+
+
+class DecoderStepExport(nn.Module):
+    """
+    One step of the decoder, with the self-attention key/value cache as explicit
+    inputs and outputs.  With a single query token, no causal mask is needed.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.decoder
+
+    def forward(
+        self,
+        trg,
+        position,
+        trg_pad_mask,
+        src_mask,
+        enc_keys,
+        enc_values,
+        past_keys,
+        past_values,
+    ):
+        # trg = [batch size, 1]
+        # position = [1]
+        # trg_pad_mask = [batch size, past len + 1]
+        # src_mask = [batch size, src len]
+        # enc_keys = enc_values = [n layers, batch size, n heads, src len, head dim]
+        # past_keys = past_values = [n layers, batch size, n heads, past len, head dim]
+        decoder = self.decoder
+
+        trg = (decoder.tok_embedding(trg) * decoder.scale) + decoder.pos_embedding(
+            position
+        ).unsqueeze(0)
+        # trg = [batch size, 1, hid dim]
+
+        present_keys, present_values = [], []
+        for i, layer in enumerate(decoder.layers):
+            attn = layer.self_attention
+
+            q, k, v = (
+                attn.in_proj(trg)
+                .view(-1, 1, 3 * attn.n_heads, attn.head_dim)
+                .transpose(1, 2)
+                .chunk(3, dim=1)
+            )
+            k = torch.cat([past_keys[i], k], dim=2)
+            v = torch.cat([past_values[i], v], dim=2)
+            present_keys.append(k)
+            present_values.append(v)
+
+            # The padding mask is True where attention is not allowed
+            _trg = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=~trg_pad_mask[:, None, None, :]
+            )
+            _trg = attn.out_proj(_trg.transpose(1, 2).reshape(trg.shape))
+            trg = layer.self_attn_layer_norm(trg + _trg)
+
+            _trg, _ = layer.encoder_attention(
+                trg, None, None, src_mask, key_value=(enc_keys[i], enc_values[i])
+            )
+            trg = layer.enc_attn_layer_norm(trg + _trg)
+
+            _trg = layer.positionwise_feedforward(trg)
+            trg = layer.ff_layer_norm(trg + _trg)
+
+        logits = decoder.fc_out(trg)
+        # logits = [batch size, 1, output dim]
+
+        return logits, torch.stack(present_keys), torch.stack(present_values)
+
+
+def export_onnx(onnx_dir, sequence_type, mode):
+    """Export the encoder and decoder step of a numbering model to ONNX."""
+    model = Loader(sequence_type, mode, torch.device("cpu")).model
+    decoder = model.decoder
+    n_layers = len(decoder.layers)
+    n_heads = decoder.n_heads
+    head_dim = decoder.hid_dim // n_heads
+
+    encoder_path, decoder_path = onnx_model_paths(onnx_dir, sequence_type, mode)
+    encoder_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Example inputs, with sizes that the exported graphs keep dynamic.
+    batch_size, src_len, past_len = 2, 12, 3
+    src = torch.ones(batch_size, src_len, dtype=torch.long)
+    kv_shape = (n_layers, batch_size, n_heads, past_len, head_dim)
+    enc_shape = (n_layers, batch_size, n_heads, src_len, head_dim)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            EncoderExport(model),
+            (src,),
+            encoder_path,
+            input_names=["src"],
+            output_names=["enc_keys", "enc_values"],
+            dynamic_axes={
+                "src": {0: "batch", 1: "src_len"},
+                "enc_keys": {1: "batch", 3: "src_len"},
+                "enc_values": {1: "batch", 3: "src_len"},
+            },
+            opset_version=OPSET_VERSION,
+        )
+
+        torch.onnx.export(
+            DecoderStepExport(model),
+            (
+                torch.ones(batch_size, 1, dtype=torch.long),
+                torch.tensor([past_len], dtype=torch.long),
+                torch.zeros(batch_size, past_len + 1, dtype=torch.bool),
+                torch.zeros(batch_size, src_len, dtype=torch.bool),
+                torch.zeros(enc_shape),
+                torch.zeros(enc_shape),
+                torch.zeros(kv_shape),
+                torch.zeros(kv_shape),
+            ),
+            decoder_path,
+            input_names=[
+                "trg",
+                "position",
+                "trg_pad_mask",
+                "src_mask",
+                "enc_keys",
+                "enc_values",
+                "past_keys",
+                "past_values",
+            ],
+            output_names=["logits", "present_keys", "present_values"],
+            dynamic_axes={
+                "trg": {0: "batch"},
+                "trg_pad_mask": {0: "batch", 1: "trg_len"},
+                "src_mask": {0: "batch", 1: "src_len"},
+                "enc_keys": {1: "batch", 3: "src_len"},
+                "enc_values": {1: "batch", 3: "src_len"},
+                "past_keys": {1: "batch", 3: "past_len"},
+                "past_values": {1: "batch", 3: "past_len"},
+                "logits": {0: "batch"},
+                "present_keys": {1: "batch", 3: "trg_len"},
+                "present_values": {1: "batch", 3: "trg_len"},
+            },
+            opset_version=OPSET_VERSION,
+        )
+
+    return encoder_path, decoder_path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Export the ANARCII numbering models to ONNX."
+    )
+    parser.add_argument("output_dir", type=str, help="Directory for the ONNX files.")
+    parser.add_argument(
+        "-t",
+        "--seq_type",
+        type=str,
+        nargs="+",
+        default=["antibody", "tcr", "shark"],
+        choices=["antibody", "tcr", "shark"],
+        help="Sequence types to export (default: all).",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=str,
+        nargs="+",
+        default=["accuracy", "speed"],
+        choices=["accuracy", "speed"],
+        help="Modes to export (default: both).",
+    )
+    args = parser.parse_args(args)
+
+    for sequence_type in args.seq_type:
+        for mode in args.mode:
+            for path in export_onnx(args.output_dir, sequence_type, mode):
+                print(f"Exported {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import string
+from functools import cache
 
+import numpy as np
+import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader
 
@@ -28,20 +31,86 @@ def collate_fn(batch):
     return pad_sequence(batch, batch_first=True, padding_value=0)
 
 
-def dataloader(batch_size, tokenised_seqs):
+def token_budget_batches(lengths, max_tokens, bucket_width=None):
+    """
+    Group consecutive sequences into batches of at most `max_tokens` padded tokens.
+
+    A batch is padded to its longest sequence, so it holds batch size × longest
+    length tokens.  Sequences should be sorted by length (as done by
+    `SequenceProcessor`) for the batches to be well packed.  Batches are made of
+    consecutive sequences, so the input order is preserved.
+
+    Parameters:
+    - lengths (list of int): Length of each tokenised sequence.
+    - max_tokens (int): Budget of padded tokens per batch.  A sequence longer than the
+    budget is placed in a batch of its own.
+    - bucket_width (int, optional): If given, also start a new batch whenever the
+    sequence length moves into another bucket of this width.
+
+    Returns:
+    - list of lists of int: The indices of the sequences in each batch.
+    """
+    batches = []
+    batch, batch_len, bucket = [], 0, None
+    for index, length in enumerate(lengths):
+        new_bucket = length // bucket_width if bucket_width else None
+        padded_len = max(batch_len, length)
+        if batch and (
+            padded_len * (len(batch) + 1) > max_tokens or new_bucket != bucket
+        ):
+            batches.append(batch)
+            batch, padded_len = [], length
+        batch.append(index)
+        batch_len, bucket = padded_len, new_bucket
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def dataloader(batch_size, tokenised_seqs, max_tokens=None, bucket_width=None):
     """
     Returns a DataLoader that batches sequences dynamically.
 
     Parameters:
     - batch_size (int): Number of sequences per batch.
     - tokenised_seqs (list of tensors): Tokenized sequences.
+    - max_tokens (int, optional): If given, batch by a budget of padded tokens
+    instead of `batch_size`, see `token_budget_batches`.
+    - bucket_width (int, optional): Width of the length buckets used with
+    `max_tokens`.
 
     Returns:
     - DataLoader: Batches of shape [batch_size, max_seq_len].
     """
+    if max_tokens:
+        batches = token_budget_batches(
+            [len(seq) for seq in tokenised_seqs], max_tokens, bucket_width
+        )
+        return DataLoader(tokenised_seqs, batch_sampler=batches, collate_fn=collate_fn)
+
     return DataLoader(tokenised_seqs, batch_size=batch_size, collate_fn=collate_fn)
 
 
+def pad_to_length_bucket(src, bucket_width, max_length):
+    """
+    Pad a batch of tokenised sequences with <PAD> tokens, to the next multiple of
+    `bucket_width` but no further than `max_length`.  Compiled models then only see a
+    small, fixed set of input lengths.
+
+    Parameters:
+    - src (tensor): Batch of shape [batch_size, max_seq_len].
+    - bucket_width (int): Width of the length buckets.
+    - max_length (int): Longest length to pad to.
+
+    Returns:
+    - tensor: Batch of shape [batch_size, bucket length].
+    """
+    length = src.shape[1]
+    bucket_length = -(length // -bucket_width) * bucket_width
+    bucket_length = max(length, min(bucket_length, max_length))
+    return F.pad(src, (0, bucket_length - length), value=0)
+
+
 def build_inward_list(length: int, start_num: int, end_num: int):
     """
     IMGT numbering is such that insertions are numbered differently depending
@@ -101,3 +170,34 @@ def build_inward_list(length: int, start_num: int, end_num: int):
 
     else:
         raise ValueError("Error in converting predicted insertions labels.")
+
+
+@cache
+def inward_label_tables(max_length: int):
+    """
+    Tabulate `build_inward_list` for every length of X run up to `max_length`, so that
+    insertion labels can be looked up for a whole batch at once.
+
+    Parameters:
+    - max_length (int): The longest X run to tabulate.
+
+    Returns:
+    - tuple of two arrays of shape [2, max_length + 1, max_length], indexed by
+    [run is at a CDR insertion start, run length, position in run]:
+        * the index into `alphabet` of the insertion letter.
+        * whether the label takes the number after the run (end_num), rather than the
+        number before it (start_num).
+    """
+    letters = np.zeros((2, max_length + 1, max_length), dtype=np.int64)
+    uses_end = np.zeros((2, max_length + 1, max_length), dtype=bool)
+
+    # Any allowed non-CDR insertion start and any CDR insertion start, respectively.
+    start_nums = allowed_non_cdr_instertions[0], cdr_instertion_starts[0]
+    for in_cdr, start_num in enumerate(start_nums):
+        for length in range(1, max_length + 1):
+            labels = build_inward_list(length, start_num, start_num + 1)
+            for i, (number, letter) in enumerate(labels):
+                letters[in_cdr, length, i] = alphabet.index(letter)
+                uses_end[in_cdr, length, i] = number != start_num
+
+    return letters, uses_end
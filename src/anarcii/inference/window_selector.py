@@ -4,8 +4,10 @@ import torch
 # import matplotlib.pyplot as plt
 from anarcii.input_data_processing.tokeniser import NumberingTokeniser
 
-from .model_loader import Loader
-from .utils import dataloader
+from .model import seq_max_len
+from .model_loader import load_model
+from .model_runner import COMPILE_BUCKET_WIDTH
+from .utils import dataloader, pad_to_length_bucket
 
 
 def first_index_above_threshold(preds, threshold=25):
@@ -15,7 +17,7 @@ def first_index_above_threshold(preds, threshold=25):
     return None
 
 
-def detect_peaks(data, threshold=25, min_distance=50):
+def detect_peaks(data, threshold=25, min_distance=50, verbose=False):
     peaks = []
     peak_values = []
 
@@ -27,26 +29,58 @@ def detect_peaks(data, threshold=25, min_distance=50):
                 peaks.append(i)
                 peak_values.append(data[i])
 
-    print(
-        "Number of high scoring chains found: ",
-        len(peaks),
-        "\n",
-        "Indices: ",
-        peaks,
-        "\n",
-        "Values: ",
-        peak_values,
-    )
+    if verbose:
+        print(
+            "Number of high scoring chains found: ",
+            len(peaks),
+            "\n",
+            "Indices: ",
+            peaks,
+            "\n",
+            "Values: ",
+            peak_values,
+        )
 
     return peaks
 
 
 class WindowFinder:
-    def __init__(self, sequence_type, mode, batch_size, device):
+    """
+    Score candidate windows of long sequences by the likelihood of the first decoding
+    step (the chain token) of the numbering model.
+
+    Pass the `model` of the `ModelRunner` that numbers the selected windows to share
+    it, otherwise the numbering model is loaded.  With `encoder_states`, the encoder
+    outputs of selected sequences can be kept there for the `ModelRunner` to reuse,
+    see `keep_states`.
+
+    With `compile`, if the model is compiled, inputs are padded to the length buckets
+    of `ModelRunner`, so that window scoring does not compile the encoder for more
+    shapes.
+    """
+
+    def __init__(
+        self,
+        sequence_type,
+        mode,
+        batch_size,
+        device,
+        max_tokens=None,
+        bucket_width=None,
+        precision="fp32",
+        model=None,
+        encoder_states=None,
+        compile=False,
+    ):
         self.type = sequence_type.lower()
         self.mode = mode.lower()
         self.batch_size = batch_size
         self.device = device
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.precision = precision
+        self.encoder_states = encoder_states
+        self.compile = compile
 
         if self.type in ["antibody", "shark"]:
             self.sequence_tokeniser = NumberingTokeniser("protein_antibody")
@@ -58,11 +92,10 @@ class WindowFinder:
         else:
             raise ValueError(f"Invalid model type: {self.type}")
 
-        self.model = self._load_model()
+        self.model = model if model is not None else self._load_model()
 
     def _load_model(self):
-        model_loader = Loader(self.type, self.mode, self.device)
-        return model_loader.model
+        return load_model(self.type, self.mode, self.device, self.precision)
 
     def __call__(self, list_of_seqs, fallback: bool = False):
         """
@@ -75,20 +108,51 @@ class WindowFinder:
                       return `None`.
 
         """
-        dl = dataloader(self.batch_size, list_of_seqs)
+        return self.select(self.score(list_of_seqs), fallback)
+
+    def score(self, list_of_seqs, states=None):
+        """
+        Score tokenised sequences, e.g. the candidate windows of many long sequences
+        at once.  Sequences are batched in order of length, and the scores returned in
+        input order.
+
+        With `states`, a dict, each sequence and its encoder output are also put there
+        by its index in `list_of_seqs`, for `keep_states`.
+        """
+        order = sorted(range(len(list_of_seqs)), key=lambda i: len(list_of_seqs[i]))
+        dl = dataloader(
+            self.batch_size,
+            [list_of_seqs[i] for i in order],
+            max_tokens=self.max_tokens,
+            bucket_width=self.bucket_width,
+        )
         preds = []
         with torch.no_grad():
             for X in dl:
                 src = X.to(self.device)
+                if self.compile:
+                    src = pad_to_length_bucket(
+                        src, COMPILE_BUCKET_WIDTH, seq_max_len - 1
+                    )
                 batch_size = src.shape[0]
 
                 src_mask = self.model.make_src_mask(src)
                 enc_src = self.model.encoder(src, src_mask)
+                if states is not None:
+                    batch_order = order[len(preds) : len(preds) + batch_size]
+                    for batch_no, index in enumerate(batch_order):
+                        seq = list_of_seqs[index]
+                        states[index] = seq, enc_src[batch_no, : len(seq)]
+                enc_key_values = self.model.decoder.project_encoder(enc_src)
+                # A single step from the start token needs no causal mask.
                 input = src[:, 0].unsqueeze(1)
-
-                trg_pad_mask, trg_causal_mask = self.model.make_trg_mask(input)
                 output, _ = self.model.decoder(
-                    input, enc_src, trg_pad_mask, trg_causal_mask, src_mask
+                    input,
+                    enc_src,
+                    input == self.model.trg_pad_idx,
+                    None,
+                    src_mask,
+                    enc_key_values=enc_key_values,
                 )
                 likelihoods = output.topk(1, dim=2).values[:, 0]
 
@@ -96,17 +160,37 @@ class WindowFinder:
                     normalized_likelihood = likelihoods[batch_no, 0].item()
                     preds.append(normalized_likelihood)
 
-            # print(preds)
+        scores = [None] * len(list_of_seqs)
+        for index, pred in zip(order, preds, strict=True):
+            scores[index] = pred
+        return scores
 
-            # find first index over 25
-            magic_number = first_index_above_threshold(preds, 25)
+    def keep_states(self, states):
+        """
+        Keep the encoder outputs of selected sequences in `encoder_states`, from their
+        `states` as put by `score`.
+        """
+        for seq, enc_src in states:
+            src = seq.unsqueeze(0).to(self.device)
+            self.encoder_states.add(
+                src, torch.zeros_like(src, dtype=torch.bool), enc_src.unsqueeze(0)
+            )
+
+    @staticmethod
+    def select(preds, fallback: bool = False):
+        """
+        The index of the first score above 25, else of the first above 15.  If there
+        is neither, the index of the highest score with `fallback`, else `None`.
+        """
+        # find first index over 25
+        magic_number = first_index_above_threshold(preds, 25)
 
-            # if nothing is over 25 then drop the threshold to 15 - next best.
-            if not magic_number:
-                magic_number = first_index_above_threshold(preds, 15)
+        # if nothing is over 25 then drop the threshold to 15 - next best.
+        if not magic_number:
+            magic_number = first_index_above_threshold(preds, 15)
 
-            if magic_number is not None:
-                return magic_number
-            else:
-                # Must be in window mode, the return max scoring window....
-                return preds.index(max(preds)) if fallback else None
+        if magic_number is not None:
+            return magic_number
+        else:
+            # Must be in window mode, the return max scoring window....
+            return preds.index(max(preds)) if fallback else None
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import numpy as np
+
+# The framework anchors of a V domain after Cys23, as (residues, first and last offset
+# from Cys23, weight).  The offsets span the CDR1 and CDR2 lengths of antibody, TCR
+# and shark (VNAR) domains, and CDR3 lengths up to about 30 residues.
+ANCHORS = [
+    # Trp41.
+    ("W", 10, 18, 1.0),
+    # Cys104.
+    ("C", 60, 88, 1.0),
+    # The J-region F/W-G-x-G motif of 118–121.
+    ("FGxG", 68, 112, 1.0),
+]
+# A candidate Cys23 needs anchors weighing at least this much, with its own weight of 1.
+MIN_ANCHOR_SCORE = 3.0
+# The number of residues of a V domain before Cys23, without gaps, i.e. with IMGT 10
+# as in kappa domains.  Most VH domains lack IMGT 10, so their start is proposed one
+# residue early.  That is intended: a window that starts one residue early only adds
+# a residue that is numbered as <SKIP>, whereas a window that starts one residue late
+# loses the first residue of the domain.
+CYS23_OFFSET = 22
+
+
+def _anchor_hits(seq: np.ndarray, anchor: str) -> np.ndarray:
+    """Where each residue of `seq` (as ASCII codes) is, or starts, the anchor."""
+    if anchor == "FGxG":
+        n = max(len(seq) - 3, 0)
+        hits = np.zeros(len(seq), dtype=bool)
+        hits[:n] = (
+            np.isin(seq[:n], [ord("F"), ord("W")])
+            & (seq[1 : 1 + n] == ord("G"))
+            & (seq[3 : 3 + n] == ord("G"))
+        )
+        return hits
+
+    return seq == ord(anchor)
+
+
+def anchor_scores(sequence: str) -> np.ndarray:
+    """
+    Score every residue of a sequence as the Cys23 of a V domain: 1 for a cysteine,
+    plus the weight of each other anchor found in its range of offsets, see
+    `ANCHORS`.  Residues other than cysteine score 0.
+    """
+    seq = np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)
+    positions = np.arange(len(seq))
+    is_cys23 = seq == ord("C")
+    scores = is_cys23.astype(float)
+
+    for anchor, first, last, weight in ANCHORS:
+        # The number of hits in any range of positions, by cumulative sums.
+        cumulative = np.concatenate([[0], np.cumsum(_anchor_hits(seq, anchor))])
+        start = np.clip(positions + first, 0, len(seq))
+        end = np.clip(positions + last + 1, 0, len(seq))
+        scores += weight * (cumulative[end] > cumulative[start])
+
+    return np.where(is_cys23, scores, 0.0)
+
+
+def anchor_starts(sequence: str, max_candidates: int = 4) -> list[int]:
+    """
+    The likely starts of V domains in a sequence, from its best-scoring candidates
+    for Cys23 (see `anchor_scores`), at most `max_candidates`, in sequence order.
+    """
+    scores = anchor_scores(sequence)
+    best = np.argsort(-scores, kind="stable")[:max_candidates]
+    best = best[scores[best] >= MIN_ANCHOR_SCORE]
+
+    return sorted(max(int(i) - CYS23_OFFSET, 0) for i in best)
+
+
+def anchor_start_between(scores: np.ndarray, first: int, last: int) -> int | None:
+    """
+    The start of the best-scoring V domain (see `anchor_scores`) that starts between
+    positions `first` and `last` of a sequence, or None if no candidate for its
+    Cys23 scores at least `MIN_ANCHOR_SCORE`.
+    """
+    lo = max(first + CYS23_OFFSET, 0)
+    hi = min(last + CYS23_OFFSET + 1, len(scores))
+    if lo >= hi:
+        return None
+
+    best = lo + int(np.argmax(scores[lo:hi]))
+    if scores[best] < MIN_ANCHOR_SCORE:
+        return None
+    return max(best - CYS23_OFFSET, 0)
@@ -3,11 +3,17 @@ import re
 import torch
 
 from anarcii.inference.model_runner import ModelRunner
-from anarcii.inference.window_selector import WindowFinder
+from anarcii.inference.window_selector import WindowFinder, detect_peaks
 from anarcii.input_data_processing import TokenisedSequence
 from anarcii.input_data_processing.tokeniser import Tokeniser
 
-from .utils import pick_windows, split_seq
+from .anchors import anchor_scores, anchor_start_between
+from .utils import (
+    pick_windows_batched,
+    score_groups,
+    search_windows_batched,
+    split_seq,
+)
 
 # A regex pattern to match no more than 200 residues, containing a 'CWC' pattern
 # (cysteine followed by 5–25 residues followed by a tryptophan followed by 50–80
@@ -32,6 +38,13 @@ cwc_pattern = re.compile(
     re.VERBOSE,
 )
 
+# In multi-domain mode, the V domains of a sequence are taken to start at least this
+# many residues apart.
+MIN_DOMAIN_SPACING = 100
+# In multi-domain mode, each domain is re-anchored at a Cys23 that puts its start
+# within this many residues of the start of its best window.
+DOMAIN_ANCHOR_RANGE = (-40, 60)
+
 
 class SequenceProcessor:
     """
@@ -62,6 +75,8 @@ class SequenceProcessor:
         model: ModelRunner,
         window_model: WindowFinder,
         verbose: bool,
+        window_search: str = "exhaustive",
+        multi_domain: bool = False,
     ):
         """
         Args:
@@ -71,11 +86,18 @@ class SequenceProcessor:
             a one step decoder to get get a single logit value representing
             score for the input window (sequence fragment).
             verbose (bool): Whether to print detailed logs.
+            window_search (str): How long sequences without a CWC pattern are
+            searched for a window, see `search_windows_batched`.
+            multi_domain (bool): Whether to number every V domain of long sequences,
+            see `_split_domains`.
         """
-        self.seqs: dict[str, str] = seqs
+        # A copy, as long sequences are replaced by their windows.
+        self.seqs: dict[str, str] = dict(seqs)
         self.model: ModelRunner = model
         self.window_model: WindowFinder = window_model
         self.verbose: bool = verbose
+        self.window_search: str = window_search
+        self.multi_domain: bool = multi_domain
         self.offsets: dict[str, int] = {}
 
     def process_sequences(self):
@@ -94,35 +116,51 @@ class SequenceProcessor:
 
         if long_seqs and self.verbose:
             print(
-                f"\n {len(long_seqs)} Long sequences detected - running in sliding "
-                "window. This is slow."
+                f"\n {len(long_seqs)} Long sequences detected - scoring windows of all "
+                "of them in batches."
             )
 
-        for key, sequence in long_seqs.items():
-            # first try a simple regex to look for cwc
-            cwc_matches = list(cwc_pattern.finditer(sequence))
-            seq_strings = [m.group("start") + m.group("end") for m in cwc_matches]
-            cwc_strings = [m.group("cwc") for m in cwc_matches]
-
-            if cwc_matches:
-                # Output the integer index of a high scoring window
-                cwc_winner = pick_windows(cwc_strings, self.window_model)
-
-                if cwc_winner is not None:
-                    # Append the start offset
-                    self.offsets[key] = cwc_matches[cwc_winner].start()
-                    # Replace the input sequence
-                    self.seqs[key] = seq_strings[cwc_winner]
-                    # print(seq_strings[cwc_winner])
-                    continue
-
-            # No CWC match found proceed to window
-            # If no cwc pattern is found, use the sliding window approach.
-            # Split the sequence into 90-residue chunks and pick the best.
-            windows = split_seq(sequence, n_jump=n_jump)
-
-            best_window = pick_windows(windows, model=self.window_model, fallback=True)
-
+        if self.multi_domain:
+            self._split_domains(long_seqs, n_jump)
+            return
+
+        # First try a simple regex to look for CWC patterns.  The candidates of all
+        # long sequences are scored together.
+        cwc_matches = {
+            key: matches
+            for key, sequence in long_seqs.items()
+            if (matches := list(cwc_pattern.finditer(sequence)))
+        }
+        cwc_winners = pick_windows_batched(
+            [[m.group("cwc") for m in matches] for matches in cwc_matches.values()],
+            self.window_model,
+        )
+
+        windowed = set()
+        for (key, matches), cwc_winner in zip(
+            cwc_matches.items(), cwc_winners, strict=True
+        ):
+            if cwc_winner is not None:
+                match = matches[cwc_winner]
+                # Append the start offset
+                self.offsets[key] = match.start()
+                # Replace the input sequence
+                self.seqs[key] = match.group("start") + match.group("end")
+                windowed.add(key)
+
+        # No CWC match found proceed to window
+        # If no cwc pattern is found, use the sliding window approach.
+        # Split the sequence into 90-residue chunks and pick the best.
+        remaining = [key for key in long_seqs if key not in windowed]
+        best_windows = search_windows_batched(
+            [long_seqs[key] for key in remaining],
+            self.window_model,
+            n_jump,
+            self.window_search,
+            verbose=self.verbose,
+        )
+
+        for key, best_window in zip(remaining, best_windows, strict=True):
             # Ensures start_index is at least 0.
             start_index = max((best_window * n_jump) - 40, 0)
             end_index = (best_window * n_jump) + 160
@@ -130,11 +168,60 @@ class SequenceProcessor:
             # Append the start offset
             self.offsets[key] = start_index
             # Replace the input sequence
-            self.seqs[key] = sequence[start_index:end_index]
+            self.seqs[key] = long_seqs[key][start_index:end_index]
 
         if long_seqs and self.verbose:
             print("Max probability windows selected.\n")
 
+    def _split_domains(self, long_seqs, n_jump):
+        """
+        Replace each long sequence with a window at each of its V domains, e.g. both
+        domains of an scFv.  The sliding windows of all long sequences are scored in
+        one batched pass, and a window taken at each peak of the scores (see
+        `detect_peaks`), or at the best window if there is no peak.  The domains are
+        keyed `name|domain-N`, from the N-terminus.
+
+        A peak window often starts in the tail of the domain before, so each domain
+        starts at its Cys23 anchors (see `anchor_start_between`) if found near the
+        window, and no less than `MIN_DOMAIN_SPACING` after the domain before.
+        """
+        names = list(long_seqs)
+        windows = [split_seq(long_seqs[name], n_jump=n_jump) for name in names]
+
+        for name, scores in zip(
+            names, score_groups(windows, self.window_model), strict=True
+        ):
+            peaks = detect_peaks(
+                scores,
+                threshold=25,
+                min_distance=MIN_DOMAIN_SPACING // n_jump,
+                verbose=self.verbose,
+            )
+            if not peaks:
+                peaks = [self.window_model.select(scores, fallback=True)]
+
+            sequence = self.seqs.pop(name)
+            scores = anchor_scores(sequence)
+            previous_start = None
+            for n, peak in enumerate(peaks, 1):
+                key = f"{name}|domain-{n}"
+                window_start = peak * n_jump
+                start_index = anchor_start_between(
+                    scores,
+                    window_start + DOMAIN_ANCHOR_RANGE[0],
+                    window_start + DOMAIN_ANCHOR_RANGE[1],
+                )
+                if start_index is None:
+                    # Ensures start_index is at least 0.
+                    start_index = max(window_start - 40, 0)
+                if previous_start is not None:
+                    start_index = max(start_index, previous_start + MIN_DOMAIN_SPACING)
+                end_index = start_index + 200
+
+                self.offsets[key] = start_index
+                self.seqs[key] = sequence[start_index:end_index]
+                previous_start = start_index
+
     def _sort_sequences_by_length(self):
         self.seqs = dict(sorted(self.seqs.items(), key=lambda x: len(x[1])))
 
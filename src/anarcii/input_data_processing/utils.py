@@ -4,6 +4,13 @@ import torch
 
 from anarcii.inference.window_selector import WindowFinder
 
+from .anchors import anchor_starts
+
+# The coarse window search first scores every `COARSE_STEP`th window.
+COARSE_STEP = 5
+# Window scores change by less than this over `COARSE_STEP` windows.
+REFINE_MARGIN = 8
+
 
 def split_seq(seq: str, n_jump: int, window_size: int = 90) -> list[str]:
     jump = n_jump
@@ -12,10 +19,7 @@ def split_seq(seq: str, n_jump: int, window_size: int = 90) -> list[str]:
     return ls
 
 
-def pick_windows(
-    seqs: list[str], model: WindowFinder, fallback: bool = False
-) -> list[int] | int | None:
-    # Find the index of the highest scoring window
+def tokenise_windows(seqs: list[str], model: WindowFinder) -> list[torch.Tensor]:
     aa = model.sequence_tokeniser
     tokenised_seqs = []
 
@@ -28,4 +32,159 @@ def pick_windows(
             print(f"Sequence could not be numbered. Contains an invalid residue: {e}")
             tokenised_seqs.append([])
 
-    return model(tokenised_seqs, fallback)
+    return tokenised_seqs
+
+
+def pick_windows_batched(
+    groups: list[list[str]], model: WindowFinder, fallback: bool = False
+) -> list[int | None]:
+    """
+    Pick the highest scoring window of each group of windows, see
+    `WindowFinder.select`, scoring the windows of all groups (e.g. of all long
+    sequences) in one batched pass.
+    """
+    return [model.select(scores, fallback) for scores in score_groups(groups, model)]
+
+
+def score_groups(
+    groups: list[list[str]], model: WindowFinder, states: dict | None = None
+) -> list[list[float]]:
+    """
+    Score the windows of all groups in one batched pass, returned by group.  With
+    `states`, see `WindowFinder.score`, windows are indexed across all groups.
+    """
+    if not groups:
+        return []
+
+    scores = model.score(
+        tokenise_windows([w for g in groups for w in g], model), states
+    )
+
+    grouped, start = [], 0
+    for group in groups:
+        grouped.append(scores[start : start + len(group)])
+        start += len(group)
+    return grouped
+
+
+def search_windows_batched(
+    seqs: list[str],
+    model: WindowFinder,
+    n_jump: int,
+    strategy: str = "exhaustive",
+    verbose: bool = False,
+) -> list[int]:
+    """
+    Pick the best `split_seq` window of each sequence, as `pick_windows_batched` with
+    `fallback`.
+
+    strategy: "exhaustive" scores every window.  "coarse" scores every `COARSE_STEP`th
+              window, then only the windows between those that score near the
+              thresholds of `WindowFinder.select` before they are first crossed, or
+              near the highest score, for a fraction of the encoder passes.
+              "anchors" scores only the sequence that would be numbered for each
+              domain start proposed by the framework anchors (see `anchor_starts`),
+              and every window of sequences where none of those is selected.
+    """
+    if strategy == "anchors":
+        return _search_anchor_windows(seqs, model, n_jump, verbose)
+
+    windows = [split_seq(seq, n_jump=n_jump) for seq in seqs]
+
+    if strategy == "exhaustive":
+        return pick_windows_batched(windows, model, fallback=True)
+    if strategy != "coarse":
+        raise ValueError(
+            "Invalid window search strategy. Choose either 'exhaustive', 'coarse' or "
+            "'anchors'."
+        )
+
+    coarse = [list(range(0, len(w), COARSE_STEP)) for w in windows]
+    coarse_scores = score_groups(
+        [[w[i] for i in indices] for w, indices in zip(windows, coarse, strict=True)],
+        model,
+    )
+
+    # Refine the gaps between coarse windows that could hold the window selection
+    # would pick: up to the first coarse window above each threshold, and around the
+    # highest, wherever either end scores within `REFINE_MARGIN` of that level.
+    fine = []
+    for w, indices, scores in zip(windows, coarse, coarse_scores, strict=True):
+        # Each gap, as the range of its windows and the higher score of its ends.
+        gaps = [
+            (start + 1, end, max(scores[k], scores[min(k + 1, len(scores) - 1)]))
+            for k, (start, end) in enumerate(
+                zip(indices, [*indices[1:], len(w)], strict=True)
+            )
+        ]
+
+        refined = set()
+        for level, first_above in ((25, True), (15, True), (max(scores), False)):
+            for k, (start, end, score) in enumerate(gaps):
+                if score > level - REFINE_MARGIN:
+                    refined.update(range(start, end))
+                # The first window above a threshold is before the first coarse
+                # window above it.
+                if first_above and k + 1 < len(scores) and scores[k + 1] > level:
+                    break
+        fine.append(sorted(refined))
+    fine_scores = score_groups(
+        [[w[i] for i in indices] for w, indices in zip(windows, fine, strict=True)],
+        model,
+    )
+
+    picks = []
+    for coarse_indices, fine_indices, scores, refined in zip(
+        coarse, fine, coarse_scores, fine_scores, strict=True
+    ):
+        # Select as from all windows, in order, of those scored.
+        scored = sorted(
+            zip(coarse_indices + fine_indices, scores + refined, strict=True)
+        )
+        best = model.select([score for _, score in scored], fallback=True)
+        picks.append(scored[best][0])
+    return picks
+
+
+def _search_anchor_windows(
+    seqs: list[str], model: WindowFinder, n_jump: int, verbose: bool = False
+) -> list[int]:
+    # The windows at each proposed start, which start at multiples of `n_jump`.
+    candidates = [
+        sorted({start // n_jump for start in anchor_starts(seq)}) for seq in seqs
+    ]
+    # Score each window as what `SequenceProcessor` numbers for it, so that the
+    # encoder output of the picked window can be reused.
+    groups = [
+        [seq[max(i * n_jump - 40, 0) : i * n_jump + 160] for i in seq_windows]
+        for seq, seq_windows in zip(seqs, candidates, strict=True)
+    ]
+    states = {} if model.encoder_states is not None else None
+    picks = [model.select(scores) for scores in score_groups(groups, model, states)]
+
+    if states is not None:
+        offsets = [0]
+        for group in groups[:-1]:
+            offsets.append(offsets[-1] + len(group))
+        model.keep_states(
+            states[offset + pick]
+            for offset, pick in zip(offsets, picks, strict=True)
+            if pick is not None
+        )
+
+    windows = [
+        None if pick is None else seq_windows[pick]
+        for pick, seq_windows in zip(picks, candidates, strict=True)
+    ]
+
+    missed = [i for i, window in enumerate(windows) if window is None]
+    if missed and verbose:
+        print(
+            f"Framework anchors found no domain in {len(missed)} of {len(seqs)} long "
+            "sequences, scoring all of their windows instead."
+        )
+
+    fallback = search_windows_batched([seqs[i] for i in missed], model, n_jump)
+    for i, window in zip(missed, fallback, strict=True):
+        windows[i] = window
+    return windows
@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import heapq
 import shutil
 import sys
+import tempfile
 import time
 import uuid
+from contextlib import ExitStack
 from itertools import chain, count, repeat
+from operator import itemgetter
 from pathlib import Path
+from typing import BinaryIO
 
 import gemmi
 import msgpack
 
 from anarcii.classifii import Classifii
+from anarcii.inference.drafts import NumberingDrafts
+from anarcii.inference.encoder_states import EncoderStates
 from anarcii.inference.model_runner import CUTOFF_SCORE, ModelRunner
 from anarcii.inference.window_selector import WindowFinder
 from anarcii.input_data_processing import Input, coerce_input, split_sequences
@@ -45,6 +52,11 @@ mmcif_output_groups = gemmi.MmcifOutputGroups(True, auth_all=True)
 pdb_write_options = gemmi.PdbWriteOptions(preserve_serial=True, conect_records=True)
 
 
+def map32_header(n: int) -> bytes:
+    """A MessagePack map header of `n` entries, always in the 32-bit format."""
+    return b"\xdf" + n.to_bytes(4, "big")
+
+
 def format_timediff(timediff: int | float) -> str:
     """
     Format a time difference in seconds as hours, minutes and seconds strings.
@@ -65,6 +77,79 @@ def format_timediff(timediff: int | float) -> str:
     return f"{hours}{mins}{secs}"
 
 
+def length_sorted_chunks(seqs: dict[str, str], chunk_size: int):
+    """
+    Split sequences into chunks of similar length, from the shortest to the longest.
+
+    Only the lengths are sorted, in one pass over the input, so that every chunk
+    gives well-packed batches however the input is ordered.
+
+    Args:
+        seqs:        The sequences, keyed by name.
+        chunk_size:  The number of sequences per chunk.
+
+    Yields:
+        The input positions of the sequences of each chunk, and the chunk.
+    """
+    items = list(seqs.items())
+    order = sorted(range(len(items)), key=lambda i: len(items[i][1]))
+
+    for positions in batched(order, chunk_size):
+        yield positions, dict(items[i] for i in positions)
+
+
+def input_position(key, positions: dict) -> tuple[int, int]:
+    """
+    The position of a numbered sequence in the input, given the `positions` of the
+    input names.  The domains of a sequence numbered in multi-domain mode, keyed
+    `name|domain-N`, follow in order.
+    """
+    if key in positions:
+        return positions[key], 0
+    name, n = key.rsplit("|domain-", 1)
+    return positions[name], int(n)
+
+
+def restore_input_order(numbered: dict, chunk: dict) -> dict:
+    """Order numbered sequences as their input, `chunk`, see `input_position`."""
+    positions = {key: i for i, key in enumerate(chunk)}
+    return dict(sorted(numbered.items(), key=lambda x: input_position(x[0], positions)))
+
+
+def spill(numbered: dict, positions: dict, path: Path):
+    """
+    Write the results of a chunk to a spill file, as (input position, name, result)
+    records in input order, to be merged with `merge_spills`.  `positions` are the
+    input positions of the names of the chunk, see `input_position`.
+    """
+    records = sorted(
+        (
+            (input_position(key, positions), key, value)
+            for key, value in numbered.items()
+        ),
+        key=itemgetter(0),
+    )
+
+    with path.open("wb") as f:
+        for record in records:
+            f.write(packer.pack(record))
+
+
+def merge_spills(paths, f: BinaryIO):
+    """
+    Stream the results in spill files to the file object `f` as key-value pairs of
+    a MessagePack map, in input order, holding one record per file in memory.
+    """
+    with ExitStack() as stack:
+        spills = [
+            msgpack.Unpacker(stack.enter_context(path.open("rb")), use_list=False)
+            for path in paths
+        ]
+        for _, key, value in heapq.merge(*spills, key=itemgetter(0)):
+            f.write(packer.pack(key))
+            f.write(packer.pack(value))
+
+
 class Anarcii:
     """
     This class instantiates the models based on user input.
@@ -100,6 +185,22 @@ class Anarcii:
         ncpu: int = -1,
         verbose: bool = False,
         max_seqs_len=1024 * 100,
+        max_trailing_skips: int | None = None,
+        max_tokens: int | None = None,
+        bucket_width: int | None = None,
+        precision: str = "fp32",
+        compile: bool = False,
+        compile_cache_dir: str | Path | None = None,
+        backend: str = "torch",
+        onnx_dir: str | Path | None = None,
+        dtype: str = "float32",
+        draft_cache: bool = False,
+        constrained: bool = False,
+        score_gate: float | None = None,
+        packed: bool = False,
+        global_sort: bool = False,
+        window_search: str = "exhaustive",
+        multi_domain: bool = False,
     ):
         self.seq_type = seq_type.lower()
 
@@ -110,9 +211,43 @@ class Anarcii:
         self.mode = mode.lower()
         self.batch_size = batch_size
         self.verbose = verbose
-        self.cpu = cpu
+        self.precision = precision.lower()
+        # Run the numbering models with PyTorch or onnxruntime (from ONNX files).
+        self.backend = backend.lower()
+        self.onnx_dir = onnx_dir
+        # Run the numbering models in reduced precision (bfloat16) under autocast.
+        # Sequences scoring near the cutoff are re-run in float32.
+        self.dtype = dtype.lower()
+        # Dynamically quantised int8 models and onnxruntime only run on CPU.
+        self.cpu = cpu or self.precision == "int8" or self.backend == "onnxruntime"
+        # Compile the numbering models with torch.compile, caching kernels on disk.
+        self.compile = compile
+        self.compile_cache_dir = compile_cache_dir
         self.max_seqs_len = max_seqs_len
-
+        # Stop decoding a sequence after this many <SKIP>s beyond IMGT 127/128.
+        self.max_trailing_skips = max_trailing_skips
+        # Batch by a budget of padded tokens (batch × longest length), not batch_size.
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        # Draft numbering from earlier sequences with the same length and framework
+        # anchors, checked in one teacher-forced pass, per sequence type.
+        self.draft_cache = draft_cache
+        self._drafts: dict[str, NumberingDrafts] = {}
+        # Only predict tokens that continue a valid numbering.
+        self.constrained = constrained
+        # Stop decoding sequences whose chain token scores below the cutoff by more
+        # than this margin.
+        self.score_gate = score_gate
+        # Run the encoder on the tokens that are not padding only.
+        self.packed = packed
+        # Chunk serialised input by length rather than input order, see
+        # `length_sorted_chunks`.
+        self.global_sort = global_sort
+        # Score every sliding window of long sequences without a CWC pattern, search
+        # coarse-to-fine, or only at framework anchors.
+        self.window_search = window_search.lower()
+        # Number every V domain of long sequences, keyed `name|domain-N`.
+        self.multi_domain = multi_domain
         self._last_numbered_output: dict | Path | None = None
         # Has a conversion to a new number scheme occured?
         self._last_converted_output = None
@@ -126,10 +261,24 @@ class Anarcii:
     def print_initial_configuration(self):
         """Print initial configuration details if verbose mode is enabled."""
         if self.verbose:
+            if self.precision == "int8":
+                print("Precision: int8 (dynamically quantised linear layers, CPU)")
+
+            if self.max_tokens:
+                print(f"Token budget per batch: {self.max_tokens}")
+                if self.bucket_width:
+                    print(f"Length bucket width: {self.bucket_width}")
+                print(
+                    "\tSequences are sorted by length and packed into batches of at "
+                    "most this many padded tokens (batch size × longest length).\n"
+                )
+                return
+
             print(f"Batch size: {self.batch_size}")
             print(
                 "\tSpeed is a balance of batch size and length diversity. "
-                "Adjust accordingly. For a full explanation see:\n",
+                "Adjust accordingly, or set a token budget with max_tokens. "
+                "For a full explanation see:\n",
                 "\twiki/FAQs#recommended-batch-sizes\n",
                 "\tSeqs all similar length (+/-5), increase batch size. "
                 "Mixed lengths (+/-30), reduce.\n",
@@ -154,6 +303,8 @@ class Anarcii:
             # individually.
             seqs: dict[str, str] = split_sequences(seqs, self.verbose)
         n_seqs = len(seqs)
+        # Structures are renumbered per chain, so are numbered one domain per chain.
+        multi_domain = self.multi_domain and not structure
 
         if self.verbose:
             print(f"Length of sequence list: {n_seqs}")
@@ -166,7 +317,13 @@ class Anarcii:
             begin = time.time()
 
         if self.seq_type == "unknown":
-            classifii_seqs = Classifii(batch_size=self.batch_size, device=self.device)
+            classifii_seqs = Classifii(
+                batch_size=self.batch_size,
+                device=self.device,
+                max_tokens=self.max_tokens,
+                bucket_width=self.bucket_width,
+                precision=self.precision,
+            )
 
         # If there is more than one chunk, we will need to serialise the output.
         if serialise := n_seqs > self.max_seqs_len:
@@ -184,11 +341,27 @@ class Anarcii:
             # can later stream the key value pairs, rather than needing to create a
             # separate MessagePack map for each chunk.
             with self._last_numbered_output.open("wb") as f:
-                f.write(packer.pack_map_header(n_seqs))
-
-        for i, chunk in enumerate(batched(seqs.items(), self.max_seqs_len), 1):
-            chunk = dict(chunk)
+                if multi_domain:
+                    # The number of domains is only known at the end.  Reserve the
+                    # header of a map of up to 2**32 - 1 entries, to complete then.
+                    f.write(map32_header(n_seqs))
+                else:
+                    f.write(packer.pack_map_header(n_seqs))
+            n_numbered = 0
+
+        # Chunk the whole input by sequence length, so that every chunk is well
+        # batched.  Results are spilled to disk per chunk, then merged in input order.
+        if global_sort := serialise and self.global_sort and not structure:
+            chunks = length_sorted_chunks(seqs, self.max_seqs_len)
+            spill_dir = tempfile.TemporaryDirectory(prefix="anarcii-")
+            spills = []
+        else:
+            chunks = (
+                (None, dict(chunk))
+                for chunk in batched(seqs.items(), self.max_seqs_len)
+            )
 
+        for i, (positions, chunk) in enumerate(chunks, 1):
             if self.verbose:
                 print(f"Processing chunk {i} of {n_chunks}.")
 
@@ -205,13 +378,15 @@ class Anarcii:
                 # Combine the numbered sequences.
                 numbered = {}
                 for seq_type, sequences in classified.items():
-                    numbered.update(self.number_with_type(sequences, seq_type))
+                    numbered.update(
+                        self.number_with_type(sequences, seq_type, multi_domain)
+                    )
 
             else:
-                numbered = self.number_with_type(chunk, self.seq_type)
+                numbered = self.number_with_type(chunk, self.seq_type, multi_domain)
 
             # Restore the original input order to the numbered sequences.
-            numbered = {key: numbered[key] for key in chunk}
+            numbered = restore_input_order(numbered, chunk)
 
             # If the sequences came from a PDB(x) file, renumber them in the associated
             # data structure.
@@ -222,7 +397,10 @@ class Anarcii:
                     if numbered_sequence_qa(numbering, self.verbose):
                         renumber_pdbx(structure, model_index, chain_id, numbering)
 
-            if serialise:
+            if global_sort:
+                spills.append(Path(spill_dir.name) / f"chunk-{i}.msgpack")
+                spill(numbered, dict(zip(chunk, positions, strict=True)), spills[-1])
+            elif serialise:
                 # Stream the key-value pairs of the results dict to the previously
                 # initialised MessagePack map.
                 with self._last_numbered_output.open("ab") as f:
@@ -231,6 +409,18 @@ class Anarcii:
             else:
                 self._last_numbered_output = numbered
 
+            if serialise:
+                n_numbered += len(numbered)
+
+        if global_sort:
+            with self._last_numbered_output.open("ab") as f:
+                merge_spills(spills, f)
+            spill_dir.cleanup()
+
+        if serialise and multi_domain:
+            with self._last_numbered_output.open("r+b") as f:
+                f.write(map32_header(n_numbered))
+
         if self.verbose:
             end = time.time()
             print(f"Numbered {n_seqs} seqs in {format_timediff(end - begin)}.\n")
@@ -365,13 +555,86 @@ class Anarcii:
                     f"Last output saved to {file_path} in scheme: {self._alt_scheme}."
                 )
 
-    def number_with_type(self, seqs: dict[str, str], seq_type):
-        model = ModelRunner(
-            seq_type, self.mode, self.batch_size, self.device, self.verbose
+    def warmup(self):
+        """
+        Compile the numbering models ahead of time, e.g. before a server takes
+        traffic.  Only has an effect with `compile=True`.
+        """
+        if self.seq_type == "unknown":
+            seq_types = ["antibody", "tcr"]
+        else:
+            seq_types = [self.seq_type]
+
+        for seq_type in seq_types:
+            self._model_runner(seq_type).warmup()
+
+    def _model_runner(self, seq_type, encoder_states=None):
+        return ModelRunner(
+            seq_type,
+            self.mode,
+            self.batch_size,
+            self.device,
+            self.verbose,
+            max_trailing_skips=self.max_trailing_skips,
+            max_tokens=self.max_tokens,
+            bucket_width=self.bucket_width,
+            precision=self.precision,
+            compile=self.compile,
+            compile_cache_dir=self.compile_cache_dir,
+            backend=self.backend,
+            onnx_dir=self.onnx_dir,
+            dtype=self.dtype,
+            drafts=self._numbering_drafts(seq_type),
+            constrained=self.constrained,
+            score_gate=self.score_gate,
+            packed=self.packed,
+            encoder_states=encoder_states,
+        )
+
+    def _numbering_drafts(self, seq_type):
+        if not self.draft_cache:
+            return None
+        if seq_type not in self._drafts:
+            self._drafts[seq_type] = NumberingDrafts(seq_type)
+        return self._drafts[seq_type]
+
+    def number_with_type(
+        self, seqs: dict[str, str], seq_type, multi_domain: bool = False
+    ):
+        # Windows selected at framework anchors are numbered as they were scored, so
+        # keep their encoder outputs for numbering.
+        encoder_states = None
+        if (
+            self.window_search == "anchors"
+            and self.backend == "torch"
+            and not self.compile
+        ):
+            encoder_states = EncoderStates()
+
+        model = self._model_runner(seq_type, encoder_states)
+        window_model = WindowFinder(
+            seq_type,
+            self.mode,
+            self.batch_size,
+            self.device,
+            max_tokens=self.max_tokens,
+            bucket_width=self.bucket_width,
+            precision=self.precision,
+            # Score windows with the numbering model, rather than another copy.
+            model=model.model,
+            encoder_states=encoder_states,
+            # The shared model is compiled for length buckets.
+            compile=self.compile,
         )
-        window_model = WindowFinder(seq_type, self.mode, self.batch_size, self.device)
 
-        processor = SequenceProcessor(seqs, model, window_model, self.verbose)
+        processor = SequenceProcessor(
+            seqs,
+            model,
+            window_model,
+            self.verbose,
+            window_search=self.window_search,
+            multi_domain=multi_domain,
+        )
         tokenised_seqs, offsets = processor.process_sequences()
 
         # Perform numbering.
@@ -0,0 +1,65 @@
+"""
+Compare int8 (dynamically quantised) numbering against fp32 numbering, on CPU, for
+each of the test FASTA files, and write the agreement report.
+"""
+
+from pathlib import Path
+
+from anarcii import Anarcii
+
+data = Path(__file__).resolve().parent.parent / "data"
+
+test_files = [
+    ("antibody", "sabdab_filtered.fa"),
+    ("antibody", "100_seqs.fa"),
+    ("antibody", "window_cwc.fa"),
+    ("tcr", "tcr_check.fa"),
+    ("shark", "shark_check.fa"),
+    ("unknown", "unknown.fa"),
+]
+
+lines = []
+for seq_type, fasta in test_files:
+    results = {}
+    for precision in ["fp32", "int8"]:
+        for mode in ["speed", "accuracy"]:
+            if seq_type == "shark" and mode == "speed":
+                # There is only one shark model.
+                continue
+            model = Anarcii(
+                seq_type=seq_type,
+                batch_size=128,
+                cpu=True,
+                ncpu=4,
+                mode=mode,
+                precision=precision,
+            )
+            results[precision, mode] = model.number(data / "raw_data" / fasta)
+
+    for mode in ["speed", "accuracy"]:
+        if ("fp32", mode) not in results:
+            continue
+        fp32, int8 = results["fp32", mode], results["int8", mode]
+
+        same_chain = same_numbering = 0
+        score_diffs = []
+        for name, expected in fp32.items():
+            test = int8[name]
+            same_chain += expected["chain_type"] == test["chain_type"]
+            same_numbering += expected["numbering"] == test["numbering"]
+            score_diffs.append(abs(expected["score"] - test["score"]))
+
+        n_seqs = len(fp32)
+        lines.append(
+            f"{fasta}\t{seq_type}\t{mode}\t{n_seqs} seqs\t"
+            f"chain agreement {same_chain / n_seqs:.2%}\t"
+            f"numbering agreement {same_numbering / n_seqs:.2%}\t"
+            f"mean |score diff| {sum(score_diffs) / n_seqs:.3f}\t"
+            f"max |score diff| {max(score_diffs):.3f}"
+        )
+
+report = "\n".join(lines)
+print(report)
+
+with open(data / "expected_data" / "int8_agreement.txt", "w") as f:
+    f.write(report + "\n")
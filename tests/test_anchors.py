@@ -0,0 +1,56 @@
+from anarcii.input_data_processing.anchors import (
+    anchor_scores,
+    anchor_start_between,
+    anchor_starts,
+)
+
+# Trastuzumab VH and VL, as an scFv with a signal peptide, a (G4S)3 linker and the
+# start of the CH1 domain.
+SIGNAL = "MKHLWFFLLLVAAPRWVLS"
+VH = (
+    "EVQLVESGGGLVQPGGSLRLSCAASGFNIKDTYIHWVRQAPGKGLEWVARIYPTNGYTRYADSVKGRFTISADTSKNTA"
+    "YLQMNSLRAEDTAVYYCSRWGGDGFYAMDYWGQGTLVTVSS"
+)
+VL = (
+    "DIQMTQSPSSLSASVGDRVTITCRASQDVNTAVAWYQQKPGKAPKLLIYSASFLYSGVPSRFSGSRSGTDFTLTISSLQ"
+    "PEDFATYYCQQHYTTPPTFGQGTKVEIK"
+)
+CH1 = "ASTKGPSVFPLAPSSKSTSGGTAALGCLVKDYFPEPVTVSWNSGALTSGVHTFPAVLQSSGLYSLSSVVTVPSS"
+
+
+def test_anchor_scores():
+    scores = anchor_scores(VH)
+
+    # Cys23 of the VH has every anchor, Cys104 only the J-region motif.
+    assert scores[21] == 4
+    assert scores[95] == 2
+    assert scores[:21].sum() == 0
+
+
+def test_anchor_starts():
+    sequence = SIGNAL + VH + "GGGGS" * 3 + VL + CH1
+    vh_start = len(SIGNAL)
+    vl_start = len(SIGNAL + VH) + 15
+
+    starts = anchor_starts(sequence)
+
+    assert len(starts) <= 4
+    assert starts == sorted(starts)
+    # The VH lacks IMGT 10, so its start is proposed one residue early, see
+    # CYS23_OFFSET.  The VL (kappa) has IMGT 10.
+    assert vh_start - 1 in starts
+    assert vh_start not in starts
+    assert vl_start in starts
+
+
+def test_anchor_start_between():
+    sequence = SIGNAL + VH + "GGGGS" * 3 + VL
+    scores = anchor_scores(sequence)
+    vl_start = len(SIGNAL + VH) + 15
+
+    assert anchor_start_between(scores, vl_start - 40, vl_start + 60) == vl_start
+    assert anchor_start_between(scores, 0, len(SIGNAL) - 5) is None
+
+
+def test_no_anchors():
+    assert anchor_starts("GGGGS" * 50) == []
@@ -0,0 +1,47 @@
+import torch
+
+from anarcii.inference.model import KeyValueCache, incremental_causal_mask
+
+
+def test_key_value_cache():
+    cache = KeyValueCache(3, 2, 6, 4, "cpu")
+    keys, values = torch.randn(2, 3, 2, 6, 4)
+
+    key, value = cache.update(keys[:, :, :2], values[:, :, :2])
+    assert cache.length == 2
+    assert torch.equal(key, keys[:, :, :2])
+    assert torch.equal(value, values[:, :, :2])
+
+    key, value = cache.update(keys[:, :, 2:3], values[:, :, 2:3])
+    assert torch.equal(key, keys[:, :, :3])
+    assert torch.equal(value, values[:, :, :3])
+
+    # Finished sequences are dropped from the batch.
+    cache.select(torch.tensor([0, 2]))
+    key, value = cache.update(keys[[0, 2], :, 3:5], values[[0, 2], :, 3:5])
+    assert torch.equal(key, keys[[0, 2], :, :5])
+    assert torch.equal(value, values[[0, 2], :, :5])
+
+    # Rejected drafts are overwritten by the next tokens.
+    cache.truncate(4)
+    assert cache.length == 4
+    cache.truncate(10)
+    assert cache.length == 4
+    key, _ = cache.update(keys[[0, 2], :, 5:], values[[0, 2], :, 5:])
+    assert torch.equal(key[:, :, :4], keys[[0, 2], :, :4])
+    assert torch.equal(key[:, :, 4:], keys[[0, 2], :, 5:])
+
+
+def test_incremental_causal_mask():
+    assert incremental_causal_mask(5, 1, "cpu") is None
+
+    # Without a cache, the usual causal mask.
+    mask = incremental_causal_mask(0, 4, "cpu")
+    assert torch.equal(mask, ~torch.ones(4, 4, dtype=torch.bool).tril())
+
+    # New tokens attend to every cached token, and causally to each other.
+    mask = incremental_causal_mask(3, 2, "cpu")
+    assert mask.tolist() == [
+        [False, False, False, False, True],
+        [False, False, False, False, False],
+    ]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+
+from anarcii.inference.drafts import NumberingDrafts
+from anarcii.input_data_processing.tokeniser import NumberingTokeniser
+
+
+def tokenise(seqs):
+    tokeniser = NumberingTokeniser("protein_antibody")
+    length = max(len(seq) for seq in seqs) + 2
+    src = np.zeros((len(seqs), length), dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        src[i, : len(seq) + 2] = tokeniser.encode(["<SOS>", *seq, "<EOS>"])
+    return torch.from_numpy(src)
+
+
+def test_numbering_drafts():
+    drafts = NumberingDrafts("antibody", max_size=2)
+    src = tokenise(["QCAW", "QVCAWG"])
+    # Predictions run past the position after the input <EOS>.
+    max_input = torch.arange(100, 100 + 2 * 9).view(2, 9)
+    drafts.add(src, max_input)
+
+    # Drafted for the same length and anchor positions, whatever the other residues.
+    test = tokenise(["ECSW", "QCWA", "QVCAW", "EVCSWGG"])
+    tracks, found = drafts.lookup(test, pad_id=0)
+
+    assert found.tolist() == [True, False, False, False]
+    assert tracks.shape == (4, test.shape[1] + 1)
+    assert tracks[0].tolist() == [100, 101, 102, 103, 104, 105, 106, 0, 0, 0]
+    assert not tracks[1:].any()
+
+    tracks, found = drafts.lookup(tokenise(["QVCTWG"]), pad_id=0)
+    assert found.tolist() == [True]
+    assert tracks[0].tolist() == list(range(109, 118))
+
+    # The least recently used are dropped.
+    drafts.add(tokenise(["CC"]), torch.zeros(1, 4, dtype=torch.long))
+    _, found = drafts.lookup(src, pad_id=0)
+    assert found.tolist() == [False, True]
+
+
+def test_numbering_drafts_sequence_type():
+    with pytest.raises(ValueError, match="Invalid model type"):
+        NumberingDrafts("unknown")
@@ -0,0 +1,32 @@
+import torch
+
+from anarcii.inference.encoder_states import EncoderStates
+
+
+def test_encoder_states():
+    torch.manual_seed(0)
+    src = torch.tensor([[1, 5, 6, 2, 0], [1, 7, 8, 9, 2]])
+    src_mask = src == 0
+    enc_src = torch.randn(2, 5, 8)
+
+    # Room for both sequences (of 4 and 5 tokens) but not a third.
+    states = EncoderStates(max_bytes=(4 + 5) * 8 * 4)
+    states.add(src, src_mask, enc_src)
+    assert states.n_bytes == (4 + 5) * 8 * 4
+
+    # Found in another batch, with other padding.
+    other = torch.tensor([[1, 4, 2, 0, 0, 0], [1, 5, 6, 2, 0, 0]])
+    found_src, found = states.lookup(other, other == 0)
+
+    assert found.tolist() == [False, True]
+    assert found_src.shape == (2, 6, 8)
+    assert torch.equal(found_src[1, :4], enc_src[0, :4])
+    assert not found_src[1, 4:].any()
+    assert not found_src[0].any()
+
+    # The least recently used are dropped.
+    states.add(other[:1], other[:1] == 0, torch.randn(1, 6, 8))
+    _, found = states.lookup(src, src_mask)
+    assert found.tolist() == [True, False]
+
+    assert states.lookup(other[:1, :3] + 10, other[:1, :3] == 0)[0] is None
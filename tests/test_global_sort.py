@@ -0,0 +1,35 @@
+import msgpack
+
+from anarcii.pipeline import length_sorted_chunks, merge_spills, spill
+from anarcii.utils import from_msgpack_map
+
+
+def test_length_sorted_chunks():
+    seqs = {"a": "QVQLV", "b": "Q", "c": "QVQLVQSG", "d": "QV", "e": "QVQ"}
+
+    chunks = list(length_sorted_chunks(seqs, 2))
+
+    assert [positions for positions, _ in chunks] == [(1, 3), (4, 0), (2,)]
+    assert [list(chunk) for _, chunk in chunks] == [["b", "d"], ["e", "a"], ["c"]]
+
+
+def test_merge_spills(tmp_path):
+    seqs = {"a": "QVQLV", "b": "Q", "c": "QVQLVQS", "d": "QV", "e": "QVQ", "f": "QV"}
+
+    spills = []
+    for i, (positions, chunk) in enumerate(length_sorted_chunks(seqs, 3)):
+        spills.append(tmp_path / f"{i}.msgpack")
+        spill(
+            {key: len(seq) for key, seq in chunk.items()},
+            dict(zip(chunk, positions, strict=True)),
+            spills[-1],
+        )
+
+    path = tmp_path / "merged.msgpack"
+    with path.open("wb") as f:
+        f.write(msgpack.Packer().pack_map_header(len(seqs)))
+        merge_spills(spills, f)
+
+    (merged,) = from_msgpack_map(path)
+    assert merged == {key: len(seq) for key, seq in seqs.items()}
+    assert list(merged) == list(seqs)
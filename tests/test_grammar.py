@@ -0,0 +1,63 @@
+import torch
+
+from anarcii.inference.grammar import NumberingGrammar
+from anarcii.input_data_processing.tokeniser import NumberingTokeniser
+
+
+def test_numbering_grammar():
+    nt = NumberingTokeniser("number_antibody")
+    grammar = NumberingGrammar(nt, "cpu")
+    pad, start, end, skip, x, heavy = (
+        nt.char_to_int[c] for c in ("<PAD>", "<SOS>", "<EOS>", "<SKIP>", "X", "H")
+    )
+
+    def allowed(state):
+        return set(torch.nonzero(grammar.mask(state)[0]).squeeze(1).tolist())
+
+    def number(n):
+        return nt.char_to_int[n]
+
+    numbers = {number(n) for n in range(1, 129)}
+
+    # A prediction starts with a chain token.
+    state = grammar.initial_state(1, "cpu")
+    assert allowed(state) == set(range(x + 1, len(nt.tokens)))
+
+    # Then <SKIP> for residues before the domain, or a number.
+    state = grammar.update(state, torch.tensor([heavy]))
+    assert allowed(state) == {skip, end, *numbers}
+    state = grammar.update(state, torch.tensor([skip]))
+    assert allowed(state) == {skip, end, *numbers}
+
+    # Numbers strictly increase, with insertions only where they are allowed.
+    state = grammar.update(state, torch.tensor([number(32)]))
+    assert allowed(state) == {skip, end, x, *(number(n) for n in range(33, 129))}
+    state = grammar.update(state, torch.tensor([x]))
+    assert allowed(state) == {skip, end, x, *(number(n) for n in range(33, 129))}
+    state = grammar.update(state, torch.tensor([number(33)]))
+    assert x not in allowed(state)
+    assert number(33) not in allowed(state)
+
+    # <SKIP> after the numbered region is only followed by <SKIP> or <EOS>.
+    state = grammar.update(state, torch.tensor([skip]))
+    assert allowed(state) == {skip, end}
+
+    # Completed sequences are padded.
+    for token in [pad, end]:
+        completed = grammar.update(state, torch.tensor([token]))
+        assert {pad, end} <= allowed(completed)
+
+
+def test_numbering_grammar_batch():
+    nt = NumberingTokeniser("number_tcr")
+    grammar = NumberingGrammar(nt, "cpu")
+
+    state = grammar.initial_state(2, "cpu")
+    state = grammar.update(state, torch.tensor([nt.char_to_int["A"]] * 2))
+    state = grammar.update(state, torch.tensor([nt.char_to_int[n] for n in (1, 100)]))
+
+    mask = grammar.mask(state)
+    assert mask.shape == (2, len(nt.tokens))
+    assert mask[0, nt.char_to_int[2]]
+    assert not mask[1, nt.char_to_int[2]]
+    assert mask[1, nt.char_to_int[101]]
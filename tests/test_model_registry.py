@@ -0,0 +1,54 @@
+import torch
+
+from anarcii.inference.model_loader import (
+    ModelRegistry,
+    load_model,
+    model_registry,
+    set_max_models,
+)
+
+
+def test_registry_evicts_least_recently_used():
+    registry = ModelRegistry(max_models=2)
+    loads = []
+
+    def loader(key):
+        def load():
+            loads.append(key)
+            return key
+
+        return load
+
+    for key in ["a", "b", "a", "c", "a", "b"]:
+        assert registry.get(key, loader(key)) == key
+
+    # "b" was dropped for "c", as "a" had been used more recently.
+    assert loads == ["a", "b", "c", "b"]
+    assert list(registry.models) == ["a", "b"]
+
+
+def test_numbering_models_are_loaded_once():
+    device = torch.device("cpu")
+
+    speed = load_model("antibody", "speed", device)
+    assert load_model("antibody", "speed", device) is speed
+    # Speculative mode verifies with the accuracy model.
+    accuracy = load_model("antibody", "accuracy", device)
+    assert load_model("antibody", "speculative", device) is accuracy
+    assert accuracy is not speed
+
+
+def test_set_max_models():
+    device = torch.device("cpu")
+    load_model("antibody", "speed", device)
+    load_model("antibody", "accuracy", device)
+
+    try:
+        set_max_models(1)
+        assert len(model_registry.models) == 1
+        load_model("tcr", "speed", device)
+        assert list(model_registry.models) == [
+            ("numbering", "tcr", "speed", "cpu", "fp32", False)
+        ]
+    finally:
+        set_max_models(None)
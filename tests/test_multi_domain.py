@@ -0,0 +1,126 @@
+import pytest
+
+from anarcii import Anarcii
+from anarcii.inference.model_runner import CUTOFF_SCORE
+from anarcii.pipeline import restore_input_order
+from anarcii.utils import from_msgpack_map
+
+# Trastuzumab VH and VL, as an scFv with a (G4S)3 linker.
+VH = (
+    "EVQLVESGGGLVQPGGSLRLSCAASGFNIKDTYIHWVRQAPGKGLEWVARIYPTNGYTRYADSVKGRFTISADTSKNTA"
+    "YLQMNSLRAEDTAVYYCSRWGGDGFYAMDYWGQGTLVTVSS"
+)
+VL = (
+    "DIQMTQSPSSLSASVGDRVTITCRASQDVNTAVAWYQQKPGKAPKLLIYSASFLYSGVPSRFSGSRSGTDFTLTISSLQ"
+    "PEDFATYYCQQHYTTPPTFGQGTKVEIK"
+)
+# A VHH, from 8TZU.
+VHH = (
+    "QVQLQESGGGLVQAGGSLRLSCAASVRTFSNYAMGWFRQAPGKEREFVAAISWSGDGPYYADSVKGRFTISRDNAKNTV"
+    "YLQMNSLKPEDTAVYYCAASYLSLNFPDDLRGQGTQVTVSS"
+)
+LINKER = "GGGGS" * 3
+SCFV = VH + LINKER + VL
+
+# Constructs whose later domains start just after the tail of the domain before, as
+# (N-terminal residues, [(domain, chain type), ...]).
+CONSTRUCTS = {
+    "vl_vh": ("", [(VL, "K"), (VH, "H")]),
+    "met_vl_vh": ("M", [(VL, "K"), (VH, "H")]),
+    "vhh_vhh_vhh": ("", [(VHH, "H")] * 3),
+}
+
+
+def test_restore_input_order():
+    chunk = {"a|b": "", "c": "", "d": ""}
+    numbered = {"d": 3, "a|b|domain-2": 2, "c": 4, "a|b|domain-1": 1}
+
+    assert list(restore_input_order(numbered, chunk)) == [
+        "a|b|domain-1",
+        "a|b|domain-2",
+        "c",
+        "d",
+    ]
+
+
+@pytest.fixture(scope="session")
+def numbered():
+    model = Anarcii(
+        seq_type="antibody",
+        batch_size=8,
+        cpu=True,
+        ncpu=4,
+        mode="accuracy",
+        verbose=False,
+        multi_domain=True,
+    )
+    return model.number({"scfv": SCFV, "vh": VH})
+
+
+def test_multi_domain(numbered):
+    assert list(numbered) == ["scfv|domain-1", "scfv|domain-2", "vh"]
+
+    vh, vl = numbered["scfv|domain-1"], numbered["scfv|domain-2"]
+    assert vh["chain_type"] == "H"
+    assert vl["chain_type"] == "K"
+    assert vh["score"] > CUTOFF_SCORE
+    assert vl["score"] > CUTOFF_SCORE
+
+    assert vh["query_start"] < len(VH)
+    assert vl["query_start"] >= len(VH)
+
+
+def test_multi_domain_global_sort(numbered):
+    model = Anarcii(
+        seq_type="antibody",
+        batch_size=8,
+        cpu=True,
+        ncpu=4,
+        mode="accuracy",
+        verbose=False,
+        multi_domain=True,
+        global_sort=True,
+        max_seqs_len=1,
+    )
+    # Longest first, so that length order differs from input order.
+    (serialised,) = from_msgpack_map(model.number({"scfv": SCFV, "vh": VH}))
+    serialised_path = model._last_numbered_output
+    serialised_path.unlink()
+
+    assert list(serialised) == list(numbered)
+    for name, result in serialised.items():
+        assert result["numbering"] == tuple(numbered[name]["numbering"]), name
+        assert result["query_start"] == numbered[name]["query_start"], name
+
+
+@pytest.fixture(scope="session")
+def numbered_constructs():
+    model = Anarcii(
+        seq_type="antibody",
+        batch_size=8,
+        cpu=True,
+        ncpu=4,
+        mode="accuracy",
+        verbose=False,
+        multi_domain=True,
+    )
+    return model.number(
+        {
+            name: prefix + LINKER.join(domain for domain, _ in domains)
+            for name, (prefix, domains) in CONSTRUCTS.items()
+        }
+    )
+
+
+@pytest.mark.parametrize("name", CONSTRUCTS)
+def test_multi_domain_constructs(name, numbered_constructs):
+    prefix, domains = CONSTRUCTS[name]
+
+    start = len(prefix)
+    for n, (domain, chain_type) in enumerate(domains, 1):
+        result = numbered_constructs[f"{name}|domain-{n}"]
+        assert result["error"] is None
+        assert result["chain_type"] == chain_type
+        assert result["query_start"] == start
+
+        start += len(domain) + len(LINKER)
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from anarcii import Anarcii
+from anarcii.inference.onnx_export import export_onnx
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.fixture(scope="session")
+def anarcii_model(pytestconfig, tmp_path_factory):
+    onnx_dir = tmp_path_factory.mktemp("onnx")
+    export_onnx(onnx_dir, "antibody", "speed")
+
+    model = Anarcii(
+        seq_type="antibody",
+        batch_size=64,
+        cpu=True,
+        ncpu=8,
+        mode="speed",
+        verbose=False,
+        backend="onnxruntime",
+        onnx_dir=onnx_dir,
+    )
+    seqs = pytestconfig.rootpath / "tests" / "data" / "raw_data" / "100_seqs.fa"
+
+    model.number(seqs)
+
+    return model
+
+
+def test_files_are_identical(anarcii_model, pytestconfig):
+    expected_file = (
+        pytestconfig.rootpath / "tests" / "data/expected_data/batch_expected_1.json"
+    )
+
+    test = list(anarcii_model.to_scheme("imgt").values())
+
+    with open(expected_file) as f1:
+        expected = json.load(f1)
+
+    # Ensure both lists have the same length
+    assert len(expected) == len(test), (
+        f"Expected list length {len(expected)} but got {len(test)}"
+    )
+
+    for expected_item, test_item in zip(expected, test, strict=True):
+        expected_number, expected_data = expected_item
+        test_number, test_data = test_item["numbering"], test_item
+
+        # The json files currently drop all tuples, so we need to undo this.
+        expected_number = [((x[0][0], x[0][1]), x[1]) for x in expected_number]
+
+        assert expected_number == test_number, (
+            f"Numbering for {expected_data['query_name']} is different! "
+            f"Expected: {expected_number}, Got: {test_number}"
+        )
+        reference = pytest.approx(expected_data["score"], abs=0.5)
+        assert test_data["score"] == reference, (
+            f"Scores differ more than 0.5 for {expected_data['query_name']}! "
+            f"Expected: {expected_data['score']}, Got: {test_data['score']}"
+        )
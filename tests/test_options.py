@@ -0,0 +1,236 @@
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from anarcii import Anarcii
+from anarcii.inference.model_runner import CASCADE_MARGIN, CUTOFF_SCORE, GATED_ERROR
+from anarcii.input_data_processing import coerce_input
+from anarcii.utils import from_msgpack_map
+
+# Each option is compared against numbering without it, on the same input.
+DEFAULTS = {
+    "seq_type": "antibody",
+    "batch_size": 64,
+    "cpu": True,
+    "ncpu": 12,
+    "mode": "speed",
+    "verbose": False,
+}
+
+# Errors that constrained decoding rules out.
+GRAMMAR_ERRORS = ["duplicate numbers", "Forbidden cdr insertion"]
+
+
+@pytest.fixture(scope="session")
+def inputs(pytestconfig):
+    raw_data = pytestconfig.rootpath / "tests" / "data" / "raw_data"
+
+    seqs, _ = coerce_input(raw_data / "sabdab_filtered.fa")
+    # Random protein sequences, which are not antibody domains.
+    rng = np.random.default_rng(0)
+    for i in range(50):
+        seqs[f"random-{i}"] = "".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), 120))
+
+    return {
+        "sabdab": raw_data / "sabdab_filtered.fa",
+        "100_seqs": raw_data / "100_seqs.fa",
+        "window_cwc": raw_data / "window_cwc.fa",
+        "tcr": raw_data / "tcr_check.fa",
+        "shark": raw_data / "shark_check.fa",
+        "sabdab_and_random": seqs,
+    }
+
+
+@pytest.fixture(scope="session")
+def number(inputs):
+    results = {}
+
+    def number(seqs, passes=1, **options):
+        # Cached, as the default numbering of an input is shared by several options.
+        key = (seqs, passes, *sorted(options.items()))
+        if key not in results:
+            model = Anarcii(**(DEFAULTS | options))
+            for _ in range(passes):
+                numbered = model.number(inputs[seqs])
+            if isinstance(numbered, Path):
+                (numbered,) = from_msgpack_map(numbered)
+                model._last_numbered_output.unlink()
+            results[key] = numbered
+
+        return results[key]
+
+    return number
+
+
+def check_int8(fp32, int8, min_chain=0.98, min_numbering=0.95):
+    # Quantisation changes the result for some sequences, see int8_agreement.txt.
+    same_chain = sum(
+        int8[name]["chain_type"] == expected["chain_type"]
+        for name, expected in fp32.items()
+    )
+    same_numbering = sum(
+        int8[name]["numbering"] == expected["numbering"]
+        for name, expected in fp32.items()
+    )
+    assert same_chain / len(fp32) >= min_chain
+    assert same_numbering / len(fp32) >= min_numbering
+
+
+def check_bfloat16(fp32, bf16):
+    # Sequences near the cutoff are re-run in float32, so pass/fail calls are stable.
+    same_call = sum(
+        (bf16[name]["error"] is None) == (expected["error"] is None)
+        for name, expected in fp32.items()
+    )
+    same_numbering = sum(
+        bf16[name]["numbering"] == expected["numbering"]
+        for name, expected in fp32.items()
+    )
+    assert same_call / len(fp32) >= 0.99
+    assert same_numbering / len(fp32) >= 0.95
+
+
+def check_same_numbering(expected, test):
+    # The option only changes floating-point rounding.
+    for name, result in test.items():
+        assert result["numbering"] == expected[name]["numbering"], name
+        assert result["chain_type"] == expected[name]["chain_type"], name
+        assert result["score"] == pytest.approx(expected[name]["score"], abs=1e-3), name
+
+
+def check_constrained(unconstrained, constrained):
+    for name, result in constrained.items():
+        error = result["error"] or ""
+        assert not any(e in error for e in GRAMMAR_ERRORS), name
+
+    # Predictions that were already valid are almost all unchanged.
+    numbered_names = [n for n, r in unconstrained.items() if r["error"] is None]
+    same_numbering = sum(
+        constrained[name]["numbering"] == unconstrained[name]["numbering"]
+        for name in numbered_names
+    )
+    assert same_numbering / len(numbered_names) >= 0.99
+
+    n_failed = sum(r["chain_type"] == "F" for r in constrained.values())
+    assert n_failed <= sum(r["chain_type"] == "F" for r in unconstrained.values())
+
+
+def check_score_gate(ungated, gated):
+    for name, result in gated.items():
+        if name.startswith("random-"):
+            assert result["chain_type"] == "F", name
+        elif result["error"] != GATED_ERROR:
+            # Sequences that pass the gate are numbered as before.
+            assert result["numbering"] == ungated[name]["numbering"], name
+            assert result["score"] == pytest.approx(ungated[name]["score"]), name
+        else:
+            # The gate only rejects sequences that fail without it.
+            assert ungated[name]["chain_type"] == "F", name
+
+
+def check_cascade(speed, accuracy, cascade):
+    for name, result in cascade.items():
+        if result["model"] == "speed":
+            # Kept from the speed model: numbered well above the cutoff.
+            assert result["error"] is None, name
+            assert result["score"] >= CUTOFF_SCORE + CASCADE_MARGIN, name
+            assert result["numbering"] == speed[name]["numbering"], name
+        else:
+            assert result["model"] == "accuracy", name
+            assert result["numbering"] == accuracy[name]["numbering"], name
+
+
+@pytest.mark.parametrize(
+    ("seqs", "options", "check"),
+    [
+        pytest.param("sabdab", [{}, {"precision": "int8"}], check_int8, id="int8"),
+        pytest.param(
+            "100_seqs",
+            [{}, {"precision": "int8"}],
+            partial(check_int8, min_numbering=0.9),
+            id="int8-100_seqs",
+        ),
+        pytest.param(
+            "100_seqs",
+            [{"mode": "accuracy"}, {"mode": "accuracy", "precision": "int8"}],
+            partial(check_int8, min_numbering=0.85),
+            id="int8-100_seqs-accuracy",
+        ),
+        pytest.param(
+            "window_cwc",
+            [{}, {"precision": "int8"}],
+            partial(check_int8, min_chain=0.9, min_numbering=0.6),
+            id="int8-window_cwc",
+        ),
+        pytest.param(
+            "tcr",
+            [{"seq_type": "tcr"}, {"seq_type": "tcr", "precision": "int8"}],
+            partial(check_int8, min_numbering=0.9),
+            id="int8-tcr",
+        ),
+        pytest.param(
+            "shark",
+            [
+                {"seq_type": "shark", "mode": "accuracy"},
+                {"seq_type": "shark", "mode": "accuracy", "precision": "int8"},
+            ],
+            partial(check_int8, min_numbering=0.7),
+            id="int8-shark",
+        ),
+        pytest.param(
+            "sabdab", [{}, {"dtype": "bfloat16"}], check_bfloat16, id="bfloat16"
+        ),
+        pytest.param(
+            "100_seqs",
+            [
+                {"mode": "accuracy", "batch_size": 32},
+                {"mode": "speculative", "batch_size": 32},
+            ],
+            check_same_numbering,
+            id="speculative",
+        ),
+        pytest.param(
+            "sabdab",
+            # Number twice, so that the second pass is drafted from the first.
+            [{}, {"draft_cache": True, "passes": 2}],
+            check_same_numbering,
+            id="draft_cache",
+        ),
+        pytest.param(
+            "sabdab", [{}, {"constrained": True}], check_constrained, id="constrained"
+        ),
+        pytest.param(
+            "sabdab_and_random",
+            [{}, {"score_gate": 5.0}],
+            check_score_gate,
+            id="score_gate",
+        ),
+        pytest.param(
+            "sabdab",
+            [{}, {"mode": "accuracy"}, {"mode": "cascade"}],
+            check_cascade,
+            id="cascade",
+        ),
+        pytest.param(
+            "100_seqs", [{}, {"packed": True}], check_same_numbering, id="packed"
+        ),
+        pytest.param(
+            "100_seqs",
+            [
+                {"batch_size": 8, "max_seqs_len": 20},
+                {"batch_size": 8, "max_seqs_len": 20, "global_sort": True},
+            ],
+            check_same_numbering,
+            id="global_sort",
+        ),
+    ],
+)
+def test_option(number, seqs, options, check):
+    results = [number(seqs, **kwargs) for kwargs in options]
+
+    for result in results[1:]:
+        assert list(result) == list(results[0])
+
+    check(*results)
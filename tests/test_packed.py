@@ -0,0 +1,31 @@
+import torch
+
+from anarcii.inference.model import Decoder, Encoder
+
+
+def test_packed_encoder():
+    torch.manual_seed(0)
+    encoder = Encoder(24, 32, 2, 4, 128, 0.1, "cpu").eval()
+    decoder = Decoder(20, 32, 2, 4, 128, 0.1, "cpu").eval()
+
+    lengths = torch.tensor([3, 11, 7, 1])
+    src = torch.randint(3, 24, (len(lengths), 11))
+    src_mask = torch.arange(11) >= lengths[:, None]
+    src[src_mask] = 0
+
+    with torch.no_grad():
+        padded = encoder(src, src_mask)
+        packed = encoder(src, src_mask, packed=True)
+        padded_kv = decoder.project_encoder(padded)
+        packed_kv = decoder.project_encoder(packed, src_mask)
+
+    tokens = ~src_mask
+    assert torch.allclose(packed[tokens], padded[tokens], atol=1e-5)
+    assert not packed[src_mask].any()
+    for (k, v), (packed_k, packed_v) in zip(padded_kv, packed_kv, strict=True):
+        assert torch.allclose(
+            packed_k.transpose(1, 2)[tokens], k.transpose(1, 2)[tokens], atol=1e-5
+        )
+        assert torch.allclose(
+            packed_v.transpose(1, 2)[tokens], v.transpose(1, 2)[tokens], atol=1e-5
+        )
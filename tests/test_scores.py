@@ -0,0 +1,41 @@
+import json
+
+import pytest
+import torch
+
+from anarcii import Anarcii
+from anarcii.inference.model_runner import ModelRunner
+
+
+@pytest.fixture(scope="session")
+def expected(pytestconfig):
+    path = pytestconfig.rootpath / "tests" / "data/expected_data/batch_expected_1.json"
+    with open(path) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("batch_size", [1, 32])
+def test_scores_match_baseline(batch_size, expected, pytestconfig):
+    model = Anarcii(
+        seq_type="antibody",
+        batch_size=batch_size,
+        cpu=True,
+        mode="speed",
+        verbose=False,
+    )
+    seqs = pytestconfig.rootpath / "tests" / "data" / "raw_data" / "100_seqs.fa"
+    results = list(model.number(seqs).values())
+
+    assert len(results) == len(expected)
+    for result, (_, expected_data) in zip(results, expected, strict=True):
+        # Every position that is scored must have been decoded, including the one
+        # after the <EOS> of the input.
+        reference = pytest.approx(expected_data["score"], abs=1e-3)
+        assert result["score"] == reference, expected_data["query_name"]
+
+
+def test_max_trailing_skips_at_least_one():
+    with pytest.raises(ValueError, match="max_trailing_skips"):
+        ModelRunner(
+            "antibody", "speed", 32, torch.device("cpu"), False, max_trailing_skips=0
+        )
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+import torch
+
+from anarcii import Anarcii
+from anarcii.inference.utils import pad_to_length_bucket, token_budget_batches
+
+
+@pytest.fixture(scope="session")
+def anarcii_model(pytestconfig):
+    model = Anarcii(
+        seq_type="antibody",
+        cpu=False,
+        ncpu=8,
+        mode="speed",
+        verbose=False,
+        # Small enough to give batches of varied size for the 101 test seqs.
+        max_tokens=2048,
+        bucket_width=16,
+    )
+    seqs = pytestconfig.rootpath / "tests" / "data" / "raw_data" / "100_seqs.fa"
+
+    model.number(seqs)
+
+    return model
+
+
+def test_token_budget_batches():
+    lengths = [5, 5, 5, 6, 6, 10, 10, 10, 30]
+
+    assert token_budget_batches(lengths, 20) == [[0, 1, 2], [3, 4], [5, 6], [7], [8]]
+    assert token_budget_batches(lengths, 60, bucket_width=8) == [
+        [0, 1, 2, 3, 4],
+        [5, 6, 7],
+        [8],
+    ]
+
+
+def test_token_budget_batches_edge_cases():
+    assert token_budget_batches([], 20) == []
+    # A sequence longer than the budget gets a batch of its own.
+    assert token_budget_batches([4, 25, 4], 20) == [[0], [1], [2]]
+    # A batch is padded to its longest sequence, whatever the order.
+    assert token_budget_batches([10, 2, 2], 20) == [[0, 1], [2]]
+    # A budget of exactly the padded size is filled.
+    assert token_budget_batches([5] * 4, 20) == [[0, 1, 2, 3]]
+    # Sequences are batched by length bucket, 4-7 then 8-11.
+    assert token_budget_batches([5, 6, 7, 8], 100, bucket_width=4) == [[0, 1, 2], [3]]
+
+
+def test_pad_to_length_bucket():
+    src = torch.ones(2, 9, dtype=torch.long)
+
+    padded = pad_to_length_bucket(src, 8, 20)
+    assert padded.shape == (2, 16)
+    assert torch.equal(padded[:, :9], src)
+    assert not padded[:, 9:].any()
+
+    assert pad_to_length_bucket(src, 8, 12).shape == (2, 12)
+    # Never truncated, even beyond the longest length.
+    assert pad_to_length_bucket(src, 8, 6).shape == (2, 9)
+    assert pad_to_length_bucket(src[:, :8], 8, 20).shape == (2, 8)
+
+
+def test_files_are_identical(anarcii_model, pytestconfig):
+    expected_file = (
+        pytestconfig.rootpath / "tests" / "data/expected_data/batch_expected_1.json"
+    )
+
+    test = list(anarcii_model.to_scheme("imgt").values())
+
+    with open(expected_file) as f1:
+        expected = json.load(f1)
+
+    # Ensure both lists have the same length
+    assert len(expected) == len(test), (
+        f"Expected list length {len(expected)} but got {len(test)}"
+    )
+
+    for expected_item, test_item in zip(expected, test, strict=True):
+        expected_number, expected_data = expected_item
+        test_number, test_data = test_item["numbering"], test_item
+
+        # The json files currently drop all tuples, so we need to undo this.
+        expected_number = [((x[0][0], x[0][1]), x[1]) for x in expected_number]
+
+        assert expected_number == test_number, (
+            f"Numbering for {expected_data['query_name']} is different! "
+            f"Expected: {expected_number}, Got: {test_number}"
+        )
+        reference = pytest.approx(expected_data["score"], abs=0.5)
+        assert test_data["score"] == reference, (
+            f"Scores differ more than 0.5 for {expected_data['query_name']}! "
+            f"Expected: {expected_data['score']}, Got: {test_data['score']}"
+        )
@@ -0,0 +1,82 @@
+import pytest
+from torch.nn.utils.rnn import pad_sequence
+
+from anarcii.inference.encoder_states import EncoderStates
+from anarcii.inference.window_selector import WindowFinder
+from anarcii.input_data_processing import coerce_input
+from anarcii.input_data_processing.utils import (
+    pick_windows_batched,
+    search_windows_batched,
+    split_seq,
+    tokenise_windows,
+)
+
+
+@pytest.fixture(scope="session")
+def window_finder():
+    return WindowFinder("antibody", "accuracy", batch_size=32, device="cpu")
+
+
+@pytest.fixture(scope="session")
+def long_seqs(pytestconfig):
+    path = pytestconfig.rootpath / "tests" / "data" / "raw_data" / "window_cwc.fa"
+    seqs, _ = coerce_input(path)
+    return [seq for seq in seqs.values() if len(seq) > 200]
+
+
+def test_pick_windows_batched(window_finder, long_seqs):
+    groups = [split_seq(seq, n_jump=3) for seq in long_seqs]
+
+    batched = pick_windows_batched(groups, window_finder, fallback=True)
+
+    # As if each sequence's windows were scored on their own.
+    assert batched == [
+        window_finder(tokenise_windows(windows, window_finder), fallback=True)
+        for windows in groups
+    ]
+
+
+def test_coarse_window_search(window_finder, long_seqs):
+    exhaustive = search_windows_batched(long_seqs, window_finder, n_jump=3)
+    coarse = search_windows_batched(
+        long_seqs, window_finder, n_jump=3, strategy="coarse"
+    )
+
+    assert coarse == exhaustive
+
+
+def test_window_scores_with_length_buckets(window_finder, long_seqs):
+    # Scoring as for a compiled model pads inputs to length buckets.
+    bucketed = WindowFinder(
+        "antibody", "accuracy", batch_size=32, device="cpu", compile=True
+    )
+    windows = tokenise_windows(split_seq(long_seqs[0], n_jump=3), window_finder)
+
+    assert bucketed.score(windows) == pytest.approx(
+        window_finder.score(windows), abs=1e-3
+    )
+
+
+def test_anchor_search_keeps_picked_states(window_finder, long_seqs):
+    encoder_states = EncoderStates()
+    finder = WindowFinder(
+        "antibody",
+        "accuracy",
+        batch_size=32,
+        device="cpu",
+        model=window_finder.model,
+        encoder_states=encoder_states,
+    )
+
+    windows = search_windows_batched(long_seqs, finder, n_jump=3, strategy="anchors")
+
+    # Only the encoder outputs of the picked windows are kept, as numbered.
+    crops = [
+        seq[max(window * 3 - 40, 0) : window * 3 + 160]
+        for seq, window in zip(long_seqs, windows, strict=True)
+    ]
+    src = pad_sequence(tokenise_windows(crops, finder), batch_first=True)
+    _, found = encoder_states.lookup(src, src == 0)
+
+    assert 0 < len(encoder_states.states) <= len(long_seqs)
+    assert int(found.sum()) == len(encoder_states.states)